@@ -0,0 +1,194 @@
+import typing
+import asyncio
+
+from dbus_next import Message, MessageType, DBusError
+from dbus_next.aio.message_bus import MessageBus
+from dbus_next.constants import BusType
+from dbus_next.signature import Variant
+from dbus_next.service import ServiceInterface, method
+
+from .sdp import service_record
+from .config import BTHIDConfig
+from .util import daemon_logger
+
+logger = daemon_logger(__name__)
+
+BLUEZ = 'org.bluez' # BlueZ's well-known bus name
+
+
+class BTHIDAgent(ServiceInterface):
+    """ This dbus Service Interface handles replying "yes" to incoming pairing requests """
+
+    @method()
+    async def Release(self):
+        logger.info("Agent: Release -- Unregistered")
+
+    @method()
+    async def RequestPinCode(self, device: 'o') -> 's': # type: ignore
+        # Return a PIN code here; '0000' is a placeholder
+        pin = "0000"
+        logger.info(f"Agent: Pin Code Requested. Providing {pin}")
+        return pin
+
+    @method()
+    async def DisplayPinCode(self, device: 'o', pincode: 's'): # type: ignore
+        logger.info(f"Agent: Pin Code for {device}: {pincode}")
+
+    @method()
+    async def RequestPasskey(self, device: 'o') -> 'u': # type: ignore
+        passkey = 123456
+        logger.info(f"Agent: Passkey Requested. Providing {passkey}")
+        return passkey
+
+    @method()
+    async def DisplayPasskey(self, device: 'o', passkey: 'u', entered: 'q'): # type: ignore
+        logger.info(f"Agent: Passkey for {device}: {passkey}, entered: {entered}")
+
+    @method()
+    async def RequestConfirmation(self, device: 'o', passkey: 'u'): # type: ignore
+        logger.info(f"Agent: Auto-Confirm passkey for {device}: {passkey} -- YES")
+        # Automatically confirm without additional action
+
+    @method()
+    async def RequestAuthorization(self, device: 'o'): # type: ignore
+        # Automatically authorize without additional action
+        logger.info(f"Agent: Authorization requested; Authorizing")
+
+    @method()
+    async def AuthorizeService(self, device: 'o', uuid: 's'): # type: ignore
+        # Automatically authorize the service without additional action
+        logger.info(f"Agent: Service authorization requested; Authorizing")
+
+    @method()
+    async def Cancel(self):
+        logger.info(f"Agent: Cancelled")
+
+
+class Adapter(typing.NamedTuple):
+    name: str # e.g. hci0
+    path: str # dbus object path
+    address: str # Bluetooth address
+
+
+async def call(
+    bus: MessageBus, 
+    path: str, 
+    interface: str, 
+    member: str, 
+    signature: str = '', 
+    body: typing.Sequence[typing.Any] = ()
+) -> typing.List[typing.Any]:
+    """ Call a BlueZ method directly; unlike proxy objects, this needs no introspection round trip """
+    reply = await bus.call(Message(
+        destination = BLUEZ,
+        path = path,
+        interface = interface,
+        member = member,
+        signature = signature,
+        body = list(body),
+    ))
+    assert reply is not None
+    if reply.message_type == MessageType.ERROR:
+        raise DBusError(reply.error_name, reply.body[0] if reply.body else '', reply)
+    return reply.body
+
+
+async def set_property(bus: MessageBus, path: str, interface: str, name: str, value: Variant) -> None:
+    await call(bus, path, 'org.freedesktop.DBus.Properties', 'Set', 'ssv', [interface, name, value])
+
+
+async def find_adapters(bus: MessageBus, selected: typing.Sequence[str] = ()) -> typing.List[Adapter]:
+    """ Enumerate BlueZ adapters, optionally only those selected by name (hci0) or address """
+    objects, = await call(bus, '/', 'org.freedesktop.DBus.ObjectManager', 'GetManagedObjects')
+
+    selected = [s.upper() for s in selected]
+    adapters = []
+    for path, interfaces in sorted(objects.items()):
+        properties = interfaces.get("org.bluez.Adapter1")
+        if properties is None:
+            continue
+        adapter = Adapter(path.rsplit('/', 1)[-1], path, properties["Address"].value)
+        if selected and adapter.name.upper() not in selected and adapter.address.upper() not in selected:
+            continue
+        adapters.append(adapter)
+
+    found = {a.name.upper() for a in adapters} | {a.address.upper() for a in adapters}
+    for missing in [s for s in selected if s not in found]:
+        logger.warning(f'Bluetooth adapter {missing} not found')
+    if not adapters:
+        raise RuntimeError('No Bluetooth adapters found')
+    return adapters
+
+
+async def setup_adapter(bus: MessageBus, adapter: Adapter) -> None:
+    """ Make sure adapter is discoverable and pairable forever """
+    # await set_property(bus, adapter.path, "org.bluez.Adapter1", "Powered", Variant('b', True))
+    # Timeouts first, so the adapter is never discoverable with the default timeout
+    await asyncio.gather(
+        set_property(bus, adapter.path, "org.bluez.Adapter1", "DiscoverableTimeout", Variant('u', 0)),
+        set_property(bus, adapter.path, "org.bluez.Adapter1", "PairableTimeout", Variant('u', 0)),
+    )
+    await asyncio.gather(
+        set_property(bus, adapter.path, "org.bluez.Adapter1", "Pairable", Variant('b', True)),
+        set_property(bus, adapter.path, "org.bluez.Adapter1", "Discoverable", Variant('b', True)),
+    )
+    logger.info(f'Bluetooth adapter {adapter.name} ({adapter.address}): discoverable')
+
+
+async def register_profile(bus: MessageBus, config: BTHIDConfig) -> None:
+    """ Create the HID bluetooth profile / SDP record """
+    await call(bus, '/org/bluez', 'org.bluez.ProfileManager1', 'RegisterProfile', 'osa{sv}', [
+        config.bluetooth_profile, 
+        config.bluetooth_uuid, 
+        {
+            "Role": Variant('s', "server"),
+            "RequireAuthentication": Variant('b', False),
+            "RequireAuthorization": Variant('b', False),
+            "AutoConnect": Variant('b', True),
+            "ServiceRecord": Variant('s', service_record(config.max_contacts)),
+        }
+    ])
+    logger.info(f'HID Profile {config.bluetooth_profile}: Registered')
+
+
+async def register_agent(bus: MessageBus, config: BTHIDConfig) -> None:
+    """ Register a dbus agent to handle automatic pairing """
+    agent = BTHIDAgent('org.bluez.Agent1')
+    bus.export(config.bluetooth_agent, agent)
+
+    # We must tell dbus that we can confirm to pair
+    await call(bus, '/org/bluez', 'org.bluez.AgentManager1', 'RegisterAgent', 'os', [config.bluetooth_agent, 'DisplayYesNo'])
+    await call(bus, '/org/bluez', 'org.bluez.AgentManager1', 'RequestDefaultAgent', 'o', [config.bluetooth_agent])
+
+    logger.info(f'Pairing Agent {config.bluetooth_agent}: Registered')
+
+
+async def setup_adapters(bus: MessageBus, config: BTHIDConfig) -> typing.List[Adapter]:
+    adapters = await find_adapters(bus, config.bluetooth_adapters)
+    await asyncio.gather(*[setup_adapter(bus, adapter) for adapter in adapters])
+    return adapters
+
+
+async def setup_bluez(
+    config: BTHIDConfig, 
+    bus_address: typing.Optional[str] = None
+) -> typing.Tuple[MessageBus, typing.List[Adapter]]:
+    """ Use dbus to register the HID profile with BlueZ, make the configured adapters
+    (default: all of them) discoverable, and register a pairing agent.  These are 
+    independent, so they happen concurrently.  Returns the bus (keep it connected to 
+    keep the profile and agent registered) and the adapters.  bus_address overrides 
+    the system bus (e.g. for a stand-in BlueZ on a session bus) """
+
+    bus = await MessageBus(
+        bus_address = bus_address,
+        bus_type = BusType.SYSTEM,
+        negotiate_unix_fd = True,
+    ).connect()
+
+    _, adapters, _ = await asyncio.gather(
+        register_profile(bus, config),
+        setup_adapters(bus, config),
+        register_agent(bus, config),
+    )
+
+    return bus, adapters
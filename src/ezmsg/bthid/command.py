@@ -1,29 +1,52 @@
 import os
 import typing
-import asyncio
 
 from pathlib import Path
 
-from .server import BTHIDServer
-from .server_sync import BTHIDServer as BTHIDServerSync
-from .config import CONFIG_PATH
-from .install import install, uninstall
+# Subsystems (servers, device modules, dbus, install) are imported by the commands
+# that use them, so the CLI starts quickly and install/uninstall don't need dbus
+from .config import CONFIG_PATH, EVENT_LOOPS, BTHIDConfig
 
 class Args:
     command: str
     config: typing.Optional[Path]
+    loop: typing.Optional[str]
+    record: typing.Optional[Path]
+    recording: typing.Optional[Path]
+    speed: float
     yes: bool
 
 async def serve(args: type[Args]) -> None:
     assert os.geteuid() == 0, "This won't work without root"
-    server = await BTHIDServer.start(args.config)
+    from .server import BTHIDServer
+    server = await BTHIDServer.start(args.config, record_path = args.record)
     await server.serve_forever()
 
 async def serve_sync(args: type[Args]) -> None:
     assert os.geteuid() == 0, "This won't work without root"
+    from .server_sync import BTHIDServer as BTHIDServerSync
     server = BTHIDServerSync(args.config)
     await server.serve_forever()
 
+async def replay(args: type[Args]) -> None:
+    """ Send a recording's reports to the daemon at the recorded timing (scaled by speed) """
+    import asyncio
+    from .protocol import BINARY_HANDSHAKE
+    from .recording import Recording
+    assert args.recording is not None, 'replay needs a recording'
+    host, port = BTHIDConfig(args.config).server_addr
+    with Recording(args.recording) as recording:
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(BINARY_HANDSHAKE)
+            if await reader.readexactly(len(BINARY_HANDSHAKE)) != BINARY_HANDSHAKE:
+                raise ConnectionError('ezmsg-bthid daemon does not support binary protocol')
+            async for frames in recording.play(args.speed):
+                writer.write(frames)
+                await writer.drain()
+        finally:
+            writer.close()
+
 def cmdline() -> None:
 
     import argparse 
@@ -32,7 +55,15 @@ def cmdline() -> None:
 
     parser.add_argument(
         'command',
-        choices = ['serve', 'install', 'uninstall', 'serve_sync']
+        choices = ['serve', 'install', 'uninstall', 'serve_sync', 'replay']
+    )
+
+    parser.add_argument(
+        'recording',
+        nargs = '?',
+        type = lambda x: Path(x),
+        default = None,
+        help = 'recording to replay (see --record)'
     )
 
     parser.add_argument(
@@ -42,6 +73,27 @@ def cmdline() -> None:
         help = f'config file for ezmsg-bthid settings. default: {CONFIG_PATH}',
     )
 
+    parser.add_argument(
+        '--loop',
+        choices = EVENT_LOOPS,
+        default = None,
+        help = 'event loop implementation for serve. default: [server] event_loop from config'
+    )
+
+    parser.add_argument(
+        '--record',
+        type = lambda x: Path(x),
+        default = None,
+        help = 'record reports received by serve to this file, for replay. default: [server] record_path from config'
+    )
+
+    parser.add_argument(
+        '--speed',
+        type = float,
+        default = 1.0,
+        help = 'replay speed relative to the recording; 0 replays as fast as possible. default: 1.0'
+    )
+
     parser.add_argument(
         '--yes', '-y',
         action = 'store_true',
@@ -51,12 +103,22 @@ def cmdline() -> None:
     args = parser.parse_args(namespace = Args)
     
     if args.command == 'serve':
+        import asyncio
+        from .util import set_event_loop_policy, daemon_logger
+        event_loop = args.loop or BTHIDConfig(args.config).event_loop
+        daemon_logger(__name__).info(f'Using {set_event_loop_policy(event_loop)} event loop')
         asyncio.run(serve(args))
     elif args.command == 'serve_sync':
+        import asyncio
         asyncio.run(serve_sync(args))
+    elif args.command == 'replay':
+        import asyncio
+        asyncio.run(replay(args))
     elif args.command == 'install':
+        from .install import install
         install(yes = args.yes)
     elif args.command == 'uninstall':
+        from .install import uninstall
         uninstall(yes = args.yes)
     else:
         raise ValueError('Unknown Command')
@@ -1,6 +1,5 @@
 import os
 import typing
-import asyncio
 
 from configparser import ConfigParser
 
@@ -9,6 +8,21 @@ from pathlib import Path
 CONFIG_ENV = 'EZMSG_BTHID_CONFIG'
 CONFIG_PATH = Path(os.environ.get(CONFIG_ENV, '/etc/ezmsg-bthid.conf'))
 
+# What the daemon does when a Bluetooth host's report queue is full
+QUEUE_DROP_OLDEST = 'drop-oldest' # discard the oldest queued report to make room
+QUEUE_DROP_NEWEST = 'drop-newest' # discard the incoming report
+QUEUE_BLOCK = 'block' # stop reading from the producer until there's room (tcp backpressure)
+QUEUE_POLICIES = (QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_BLOCK)
+
+# Event loop implementation the async daemon runs on
+EVENT_LOOP_AUTO = 'auto' # uvloop if it's installed, otherwise asyncio
+EVENT_LOOP_ASYNCIO = 'asyncio'
+EVENT_LOOP_UVLOOP = 'uvloop' # pip install ezmsg-bthid[uvloop]
+EVENT_LOOPS = (EVENT_LOOP_AUTO, EVENT_LOOP_ASYNCIO, EVENT_LOOP_UVLOOP)
+
+if typing.TYPE_CHECKING:
+    from .transport import Transport
+
 
 class BTHIDConfig:
 
@@ -40,7 +54,158 @@ class BTHIDConfig:
         bt_host = self.parser.get('server', 'host', fallback = BTHIDConfig.DEFAULT_HOST)
         bt_port = int(self.parser.get('server', 'port', fallback = str(BTHIDConfig.DEFAULT_PORT)))
         return bt_host, bt_port
-    
+
+    @property
+    def unix_path(self) -> typing.Optional[Path]:
+        """ Path of an optional AF_UNIX ingest socket for producers on the same machine """
+        path = self.parser.get('server', 'unix_path', fallback = '')
+        return Path(path) if path else None
+
+    @property
+    def shm_path(self) -> typing.Optional[Path]:
+        """ Path of an optional AF_UNIX socket where producers on the same machine attach shared memory rings """
+        path = self.parser.get('server', 'shm_path', fallback = '')
+        return Path(path) if path else None
+
+    # Anyone on the machine can already reach the tcp port on localhost
+    DEFAULT_UNIX_MODE = 0o666
+
+    @property
+    def unix_mode(self) -> int:
+        """ File permissions (octal) of the unix (and shm) ingest sockets """
+        return int(self.parser.get('server', 'unix_mode', fallback = f'{BTHIDConfig.DEFAULT_UNIX_MODE:o}'), 8)
+
+    @property
+    def unix_group(self) -> typing.Optional[str]:
+        """ Group that owns the unix (and shm) ingest sockets; combine with unix_mode = 660 to restrict access """
+        return self.parser.get('server', 'unix_group', fallback = None) or None
+
+    DEFAULT_UDP_PORT = 0
+
+    @property
+    def udp_port(self) -> int:
+        """ Port for datagram (UDP) ingest on the server host; 0 disables """
+        return int(self.parser.get('server', 'udp_port', fallback = str(BTHIDConfig.DEFAULT_UDP_PORT)))
+
+    DEFAULT_UDP_SOURCE_TIMEOUT = 1.0
+
+    @property
+    def udp_source_timeout(self) -> float:
+        """ Seconds after which a quiet datagram producer's sequence number is forgotten """
+        return float(self.parser.get('server', 'udp_source_timeout', fallback = str(BTHIDConfig.DEFAULT_UDP_SOURCE_TIMEOUT)))
+
+    DEFAULT_EVENT_LOOP = EVENT_LOOP_AUTO
+
+    @property
+    def event_loop(self) -> str:
+        loop = self.parser.get('server', 'event_loop', fallback = BTHIDConfig.DEFAULT_EVENT_LOOP)
+        if loop not in EVENT_LOOPS:
+            raise ValueError(f'Unknown event_loop: {loop}; expected one of {EVENT_LOOPS}')
+        return loop
+
+    DEFAULT_STATS_INTERVAL = 0.0
+
+    @property
+    def stats_interval(self) -> float:
+        """ Seconds between per-adapter connection/throughput log messages; 0 disables """
+        return float(self.parser.get('server', 'stats_interval', fallback = str(BTHIDConfig.DEFAULT_STATS_INTERVAL)))
+
+    DEFAULT_METRICS_PORT = 0
+
+    @property
+    def metrics_port(self) -> int:
+        """ Port on the server host serving Prometheus text format metrics over http; 0 disables """
+        return int(self.parser.get('server', 'metrics_port', fallback = str(BTHIDConfig.DEFAULT_METRICS_PORT)))
+
+    @property
+    def record_path(self) -> typing.Optional[Path]:
+        """ File to record every report received from tcp (and unix) producers to, for replay; see recording """
+        path = self.parser.get('server', 'record_path', fallback = '')
+        return Path(path) if path else None
+
+    DEFAULT_SCHEDULE_HORIZON = 1.0
+
+    @property
+    def schedule_horizon(self) -> float:
+        """ Furthest ahead (seconds) a producer can schedule a report; later deadlines are brought forward """
+        return float(self.parser.get('server', 'schedule_horizon', fallback = str(BTHIDConfig.DEFAULT_SCHEDULE_HORIZON)))
+
+    DEFAULT_QUEUE_SIZE = 256
+
+    @property
+    def queue_size(self) -> int:
+        """ Maximum number of reports queued per Bluetooth host; 0 for unbounded """
+        return int(self.parser.get('server', 'queue_size', fallback = str(BTHIDConfig.DEFAULT_QUEUE_SIZE)))
+
+    DEFAULT_QUEUE_POLICY = QUEUE_DROP_OLDEST
+
+    @property
+    def queue_policy(self) -> str:
+        policy = self.parser.get('server', 'queue_policy', fallback = BTHIDConfig.DEFAULT_QUEUE_POLICY)
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'Unknown queue_policy: {policy}; expected one of {QUEUE_POLICIES}')
+        return policy
+
+    @property
+    def suppress_duplicates(self) -> bool:
+        """ Don't send a host a report identical to the last one it was sent with the same report ID """
+        return self.parser.getboolean('server', 'suppress_duplicates', fallback = False)
+
+    DEFAULT_IDLE_INTERVAL = 0.0
+
+    @property
+    def idle_interval(self) -> float:
+        """ Seconds after which a suppressed duplicate is sent anyway, as a keepalive; 0 never resends """
+        return float(self.parser.get('server', 'idle_interval', fallback = str(BTHIDConfig.DEFAULT_IDLE_INTERVAL)))
+
+    DEFAULT_LATENCY_INTERVAL = 0.0
+
+    @property
+    def latency_interval(self) -> float:
+        """ Seconds between latency statistics log messages; 0 disables latency tracking """
+        return float(self.parser.get('server', 'latency_interval', fallback = str(BTHIDConfig.DEFAULT_LATENCY_INTERVAL)))
+
+    DEFAULT_TRANSPORT = 'l2cap'
+
+    @property
+    def transport_type(self) -> str:
+        """ What Bluetooth hosts connect over; see transport.TRANSPORTS """
+        from .transport import TRANSPORTS
+        transport = self.parser.get('transport', 'type', fallback = BTHIDConfig.DEFAULT_TRANSPORT)
+        if transport not in TRANSPORTS:
+            raise ValueError(f'Unknown transport type: {transport}; expected one of {TRANSPORTS}')
+        return transport
+
+    DEFAULT_TRANSPORT_PATH = '/run/ezmsg-bthid'
+    DEFAULT_TRANSPORT_NAME = 'ezmsg-bthid'
+
+    def transport(self, address: typing.Optional[str] = None, name: typing.Optional[str] = None) -> 'Transport':
+        """ Build the configured transport; address (and name) are the Bluetooth adapter's for l2cap """
+        from .transport import L2CAPTransport, UnixTransport, MemoryTransport, TRANSPORT_UNIX, TRANSPORT_MEMORY
+        transport = self.transport_type
+        if transport == TRANSPORT_UNIX:
+            return UnixTransport(self.parser.get('transport', 'path', fallback = BTHIDConfig.DEFAULT_TRANSPORT_PATH))
+        elif transport == TRANSPORT_MEMORY:
+            return MemoryTransport(self.parser.get('transport', 'name', fallback = BTHIDConfig.DEFAULT_TRANSPORT_NAME))
+        if address is None:
+            raise ValueError('l2cap transport requires a Bluetooth adapter address')
+        return L2CAPTransport(address, name)
+
+    @property
+    def bluetooth_adapters(self) -> typing.List[str]:
+        """ Names (hci0) or addresses of the Bluetooth adapters to serve hosts on; empty for all of them """
+        adapters = self.parser.get('bluetooth', 'adapters', fallback = '')
+        return [adapter.strip() for adapter in adapters.replace(',', ' ').split()]
+
+    @property
+    def max_contacts(self) -> int:
+        """ Fingers the MultiTouch digitizer reports at once; producers must use MultiTouch.with_max_contacts to match """
+        from .device.multitouch import DEFAULT_MAX_CONTACTS, MAX_CONTACTS_LIMIT
+        max_contacts = int(self.parser.get('bluetooth', 'max_contacts', fallback = str(DEFAULT_MAX_CONTACTS)))
+        if not 1 <= max_contacts <= MAX_CONTACTS_LIMIT:
+            raise ValueError(f'max_contacts must be between 1 and {MAX_CONTACTS_LIMIT}')
+        return max_contacts
+
     DEFAULT_UUID = "00001124-0000-1000-8000-00805f9b34fb"
 
     @property
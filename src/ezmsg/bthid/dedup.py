@@ -0,0 +1,55 @@
+import typing
+
+from .device import DEVICE_CLASSES
+from .protocol import REPORT_HEADER
+
+# Report bytes holding relative values, keyed by report ID (see HID.RELATIVE_PAYLOAD)
+RELATIVE_REPORT = {
+    cls.Message.REPORT_ID: slice(
+        cls.RELATIVE_PAYLOAD.start + REPORT_HEADER.size,
+        cls.RELATIVE_PAYLOAD.stop + REPORT_HEADER.size
+    )
+    for cls in DEVICE_CLASSES
+    if cls.RELATIVE_PAYLOAD.stop > cls.RELATIVE_PAYLOAD.start
+}
+
+
+class DuplicateFilter:
+    """ Suppresses reports identical to the last one sent to a host with the same
+    report ID, resending an unchanged report every idle_interval seconds (if nonzero)
+    like HID SET_IDLE.  Check reports as they're sent rather than as they're queued,
+    so a state change (e.g. a key release) is never compared against a report the
+    host didn't actually receive.  Reports with nonzero relative values (movement)
+    always go through. """
+
+    last: typing.Dict[int, typing.Tuple[bytes, int]] # report id -> (report, time.monotonic_ns when sent)
+    suppressed: int
+
+    def __init__(self, idle_interval: float = 0.0) -> None:
+        self.last = {}
+        self.suppressed = 0
+        self._idle = int(idle_interval * 1e9)
+
+    def redundant(self, report: bytes, now: int) -> bool:
+        """ True (and counted as suppressed) if report shouldn't be sent at now (time.monotonic_ns) """
+        last = self.last.get(report[1])
+        if last is None or last[0] != report:
+            return False
+        relative = RELATIVE_REPORT.get(report[1])
+        if relative is not None and any(report[relative]):
+            return False
+        if self._idle and now - last[1] >= self._idle:
+            return False
+        self.suppressed += 1
+        return True
+
+    def sent(self, report: bytes, now: int) -> None:
+        """ Record that report was sent at now """
+        self.last[report[1]] = (report, now)
+
+    def check(self, report: bytes, now: int) -> bool:
+        """ True if report, about to be sent at now, should be sent; records it if so """
+        if self.redundant(report, now):
+            return False
+        self.sent(report, now)
+        return True
@@ -4,12 +4,20 @@ from .hid import HID, HIDMessage
 from .keyboard import Keyboard
 from .mouse import Mouse
 from .touch import Touch
+from .multitouch import MultiTouch, DEFAULT_MAX_CONTACTS
 
 
 DEVICE_CLASSES: typing.List[type[HID]] = [
     Keyboard,
     Mouse,
-    Touch
+    Touch,
+    MultiTouch,
 ]
 
-REPORT_DESCRIPTION = b''.join([d.REPORT_DESCRIPTION for d in DEVICE_CLASSES])
\ No newline at end of file
+REPORT_DESCRIPTION = b''.join([d.REPORT_DESCRIPTION for d in DEVICE_CLASSES])
+
+
+def report_description(max_contacts: int = DEFAULT_MAX_CONTACTS) -> bytes:
+    """ REPORT_DESCRIPTION, with the MultiTouch digitizer reporting up to max_contacts fingers """
+    multitouch = MultiTouch.with_max_contacts(max_contacts)
+    return b''.join([multitouch.REPORT_DESCRIPTION if d is MultiTouch else d.REPORT_DESCRIPTION for d in DEVICE_CLASSES])
\ No newline at end of file
@@ -1,8 +1,15 @@
-import asyncio
+import struct
+import typing
 
+from functools import partial
 from abc import ABC, abstractmethod
 
+from ..protocol import HID_INPUT_REPORT, REPORT_HEADER, FRAME_HEADER, encode_frame
+
+T = typing.TypeVar('T')
+
 class HIDMessage(ABC):
+    __slots__ = ()
 
     @property
     @abstractmethod
@@ -11,25 +18,100 @@ class HIDMessage(ABC):
 
     @property
     def report(self) -> bytes:
-        return bytes([0xA1, 0xFF & self.report_id]) + self.payload
+        return bytes([HID_INPUT_REPORT, 0xFF & self.report_id]) + self.payload
     
     @property
     @abstractmethod
     def payload(self) -> bytes:
         raise NotImplementedError
     
+    def pack_into(self, buffer: bytearray, offset: int = 0) -> int:
+        """ Write report into buffer at offset; returns the offset just past the report """
+        report = self.report
+        end = offset + len(report)
+        buffer[offset:end] = report
+        return end
+
+    def pack_frame_into(self, buffer: bytearray, offset: int = 0) -> int:
+        """ Write binary stream frame into buffer at offset; returns the offset just past the frame """
+        frame = self.frame()
+        end = offset + len(frame)
+        buffer[offset:end] = frame
+        return end
+
+    def accumulate(self, other: "HIDMessage") -> typing.Optional["HIDMessage"]:
+        """ Combine this message with a newer message of the same type into one
+        message with the same effect on the host, if possible; otherwise None """
+        return None
+
     # Stream encoding: Hex + newline
     def encode(self) -> bytes:
         return self.report.hex().encode() + b'\n'
+    
+    # Stream encoding: Binary (report id, length, payload)
+    def frame(self) -> bytes:
+        return encode_frame(self.report_id, self.payload)
+
 
+class StructMessage(HIDMessage):
+    """ HIDMessage with a fixed payload layout described by a struct format string.
+    Report and frame codecs are precompiled per subclass, so encoding a message is 
+    a single struct.pack call with no intermediate bytes objects. """
+    __slots__ = ()
 
-# Stream decoding: Hex + newline
-def decode_report(report: bytes) -> bytes:
-    return bytes.fromhex(report.decode()[:-1]) if report else report
+    REPORT_ID: typing.ClassVar[int]
+    PAYLOAD_FORMAT: typing.ClassVar[str] # little-endian struct format, without byte order prefix
+
+    # The report header (0xA1, report id) and the binary frame header (report id, length) 
+    # are both two bytes, so one codec serves for reports and frames
+    assert REPORT_HEADER.size == FRAME_HEADER.size
+    _codec: typing.ClassVar[struct.Struct]
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        payload_format = cls.__dict__.get('PAYLOAD_FORMAT')
+        if payload_format is not None:
+            cls._codec = struct.Struct('<BB' + payload_format)
+
+    @abstractmethod
+    def _pack(self, pack: typing.Callable[..., T], header0: int, header1: int) -> T:
+        """ Call pack with the two header bytes followed by the payload field values, 
+        in PAYLOAD_FORMAT order, and return its result """
+        raise NotImplementedError
+
+    @property
+    def report_id(self) -> int:
+        return self.REPORT_ID
+
+    @property
+    def report(self) -> bytes:
+        return self._pack(self._codec.pack, HID_INPUT_REPORT, self.REPORT_ID)
+
+    @property
+    def payload(self) -> bytes:
+        return self.report[REPORT_HEADER.size:]
+
+    def pack_into(self, buffer: bytearray, offset: int = 0) -> int:
+        codec = self._codec
+        self._pack(partial(codec.pack_into, buffer, offset), HID_INPUT_REPORT, self.REPORT_ID)
+        return offset + codec.size
+
+    def pack_frame_into(self, buffer: bytearray, offset: int = 0) -> int:
+        codec = self._codec
+        self._pack(partial(codec.pack_into, buffer, offset), self.REPORT_ID, codec.size - FRAME_HEADER.size)
+        return offset + codec.size
+
+    def frame(self) -> bytes:
+        codec = self._codec
+        return self._pack(codec.pack, self.REPORT_ID, codec.size - FRAME_HEADER.size)
 
 
 class HID(ABC):
     REPORT_DESCRIPTION: bytes
 
+    # Payload bytes holding relative (Rel) values; repeating a report with any of
+    # these nonzero has an effect on the host, so it's never a redundant duplicate
+    RELATIVE_PAYLOAD: typing.ClassVar[slice] = slice(0, 0)
+
     class Message(HIDMessage):
         ...
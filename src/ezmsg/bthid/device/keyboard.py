@@ -1,6 +1,9 @@
-from dataclasses import dataclass
+import typing
 
-from .hid import HID, HIDMessage
+from functools import lru_cache
+
+from ..util import message_dataclass
+from .hid import T, HID, StructMessage
 
 # This report ID cannot conflict with any other devices
 KEYBOARD_ID = 0x01 
@@ -179,8 +182,23 @@ class Keyboard(HID):
     KEYCODE_MEDIA_PLAY_PAUSE = 0xe8
     KEYCODE_REFRESH = 0xfa
 
-    @dataclass
-    class Message(HIDMessage):
+    @classmethod
+    def compile_text(cls, text: str, layout: str = 'us', release_each: bool = False) -> typing.Tuple["Keyboard.Message", ...]:
+        """ Compile text into the sequence of reports that types it, ending with all keys released.
+        A key is only released between characters when it's pressed twice in a row, unless 
+        release_each is set.  Results are cached, so treat the returned messages as read-only. """
+        return _compile_text(text, layout, release_each)
+
+    @classmethod
+    def compile_text_frames(cls, text: str, layout: str = 'us', release_each: bool = False) -> bytes:
+        """ Binary stream frames for compile_text; see HIDOutput.INPUT_FRAMES """
+        return _compile_text_frames(text, layout, release_each)
+
+    @message_dataclass
+    class Message(StructMessage):
+        REPORT_ID = KEYBOARD_ID
+        PAYLOAD_FORMAT = 'BxBBBBBB' # modifiers, reserved, 6x keycodes
+
         mod_keys: int = 0
 
         # Descriptor supports up to 6 simultaneous keycodes
@@ -191,19 +209,89 @@ class Keyboard(HID):
         key5: int = 0
         key6: int = 0
 
-        @property
-        def report_id(self) -> int:
-            return KEYBOARD_ID
-
-        @property
-        def payload(self) -> bytes:
-            return bytes([
+        def _pack(self, pack: typing.Callable[..., T], header0: int, header1: int) -> T:
+            return pack(
+                header0,
+                header1,
                 0xFF & self.mod_keys, 
-                0x00, 
                 0xFF & self.key1,
                 0xFF & self.key2,
                 0xFF & self.key3,
                 0xFF & self.key4,
                 0xFF & self.key5,
                 0xFF & self.key6,
-            ])
\ No newline at end of file
+            )
+
+
+_SHIFT = Keyboard.MODIFIER_LEFT_SHIFT
+
+# Character -> (modifiers, keycode) for a US QWERTY layout
+_US_LAYOUT: typing.Dict[str, typing.Tuple[int, int]] = {
+    **{chr(ord('a') + i): (0, Keyboard.KEYCODE_A + i) for i in range(26)},
+    **{chr(ord('A') + i): (_SHIFT, Keyboard.KEYCODE_A + i) for i in range(26)},
+    **{str((i + 1) % 10): (0, Keyboard.KEYCODE_NUMBER_1 + i) for i in range(10)},
+    **{c: (_SHIFT, Keyboard.KEYCODE_NUMBER_1 + i) for i, c in enumerate('!@#$%^&*()')},
+    '\n': (0, Keyboard.KEYCODE_ENTER),
+    '\t': (0, Keyboard.KEYCODE_TAB),
+    ' ': (0, Keyboard.KEYCODE_SPACEBAR),
+    '-': (0, Keyboard.KEYCODE_MINUS),
+    '_': (_SHIFT, Keyboard.KEYCODE_MINUS),
+    '=': (0, Keyboard.KEYCODE_EQUAL_SIGN),
+    '+': (_SHIFT, Keyboard.KEYCODE_EQUAL_SIGN),
+    '[': (0, Keyboard.KEYCODE_LEFT_BRACKET),
+    '{': (_SHIFT, Keyboard.KEYCODE_LEFT_BRACKET),
+    ']': (0, Keyboard.KEYCODE_RIGHT_BRACKET),
+    '}': (_SHIFT, Keyboard.KEYCODE_RIGHT_BRACKET),
+    '\\': (0, Keyboard.KEYCODE_BACKSLASH),
+    '|': (_SHIFT, Keyboard.KEYCODE_BACKSLASH),
+    ';': (0, Keyboard.KEYCODE_SEMICOLON),
+    ':': (_SHIFT, Keyboard.KEYCODE_SEMICOLON),
+    "'": (0, Keyboard.KEYCODE_SINGLE_QUOTE),
+    '"': (_SHIFT, Keyboard.KEYCODE_SINGLE_QUOTE),
+    '`': (0, Keyboard.KEYCODE_ACCENT_GRAVE),
+    '~': (_SHIFT, Keyboard.KEYCODE_ACCENT_GRAVE),
+    ',': (0, Keyboard.KEYCODE_COMMA),
+    '<': (_SHIFT, Keyboard.KEYCODE_COMMA),
+    '.': (0, Keyboard.KEYCODE_PERIOD),
+    '>': (_SHIFT, Keyboard.KEYCODE_PERIOD),
+    '/': (0, Keyboard.KEYCODE_FORWARD_SLASH),
+    '?': (_SHIFT, Keyboard.KEYCODE_FORWARD_SLASH),
+}
+
+KEYBOARD_LAYOUTS: typing.Dict[str, typing.Dict[str, typing.Tuple[int, int]]] = {
+    'us': _US_LAYOUT,
+}
+
+_RELEASE = Keyboard.Message()
+
+@lru_cache(maxsize = 256)
+def _compile_text(text: str, layout: str, release_each: bool) -> typing.Tuple[Keyboard.Message, ...]:
+    try:
+        table = KEYBOARD_LAYOUTS[layout]
+    except KeyError:
+        raise ValueError(f'Unknown keyboard layout: {layout}')
+
+    reports: typing.List[Keyboard.Message] = []
+    last_keycode = Keyboard.KEYCODE_NONE
+    for character in text:
+        try:
+            mod_keys, keycode = table[character]
+        except KeyError:
+            raise ValueError(f'Character {character!r} has no key in keyboard layout {layout!r}')
+
+        # The host only sees a new keypress if the key was released first
+        if release_each or keycode == last_keycode:
+            if last_keycode != Keyboard.KEYCODE_NONE:
+                reports.append(_RELEASE)
+
+        reports.append(Keyboard.Message(mod_keys = mod_keys, key1 = keycode))
+        last_keycode = keycode
+
+    if last_keycode != Keyboard.KEYCODE_NONE:
+        reports.append(_RELEASE)
+
+    return tuple(reports)
+
+@lru_cache(maxsize = 256)
+def _compile_text_frames(text: str, layout: str, release_each: bool) -> bytes:
+    return b''.join(msg.frame() for msg in _compile_text(text, layout, release_each))
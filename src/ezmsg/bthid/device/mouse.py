@@ -1,9 +1,7 @@
 import typing
 
-from dataclasses import dataclass
-
-from ..util import float_to_signed_bytes
-from .hid import HID, HIDMessage
+from ..util import message_dataclass, ArrayLike
+from .hid import T, HID, HIDMessage, StructMessage
 
 # This report ID cannot conflict with any other devices
 MOUSE_ID = 0x02
@@ -43,8 +41,39 @@ class Mouse(HID):
 
     ])
 
-    @dataclass
-    class Message(HIDMessage):
+    RELATIVE_PAYLOAD = slice(1, 4) # x, y, wheel
+
+    @classmethod
+    def encode_batch(cls, buttons: ArrayLike, rel_x: ArrayLike, rel_y: ArrayLike, wheel: ArrayLike = 0.0) -> bytes:
+        """ Vectorized equivalent of b''.join(Mouse.Message(...).frame() for ...) 
+        buttons is a bitmask per report (bit0 = left, bit1 = right). Arguments are 
+        broadcast against each other; returns binary stream frames (requires numpy) """
+        import numpy as np
+
+        buttons, rel_x, rel_y, wheel = np.broadcast_arrays(buttons, rel_x, rel_y, wheel)
+        frames = np.zeros(buttons.size, dtype = np.dtype([
+            ('report_id', 'u1'), 
+            ('length', 'u1'), 
+            ('buttons', 'u1'), 
+            ('x', 'i1'), 
+            ('y', 'i1'), 
+            ('wheel', 'i1'), 
+            ('padding', 'V2'),
+        ]))
+        frames['report_id'] = MOUSE_ID
+        frames['length'] = frames.itemsize - 2
+        frames['buttons'] = buttons.ravel().astype(np.int64) & 0x03
+        # astype truncates toward zero like int()
+        frames['x'] = np.clip(rel_x.ravel(), -1.0, 1.0) * 127
+        frames['y'] = np.clip(rel_y.ravel(), -1.0, 1.0) * 127
+        frames['wheel'] = np.clip(wheel.ravel(), -1.0, 1.0) * 127
+        return frames.tobytes()
+
+    @message_dataclass
+    class Message(StructMessage):
+        REPORT_ID = MOUSE_ID
+        PAYLOAD_FORMAT = 'Bbbb2x' # buttons, x, y, wheel, padding
+
         left_button: bool = False
         right_button: bool = False
         rel_x: float = 0.0 # (-1.0, 1.0)
@@ -60,21 +89,33 @@ class Mouse(HID):
         def buttons(self) -> bytes:
             return _buttons_lut[(self.left_button, self.right_button)]
 
-        @property
-        def report_id(self) -> int:
-            return MOUSE_ID
-
-        @property
-        def payload(self) -> bytes:
-            return ( 
-                self.buttons +
-                float_to_signed_bytes(self.rel_x) + 
-                float_to_signed_bytes(self.rel_y) + 
-                float_to_signed_bytes(self.wheel) + 
-                b'\x00\x00'
+        def _pack(self, pack: typing.Callable[..., T], header0: int, header1: int) -> T:
+            return pack(
+                header0,
+                header1,
+                bool(self.left_button) | (bool(self.right_button) << 1),
+                int(self.rel_x * 127),
+                int(self.rel_y * 127),
+                int(self.wheel * 127),
             )
 
-# This lookup table (lut) accelerates payload generation
+        def accumulate(self, other: HIDMessage) -> typing.Optional["Mouse.Message"]:
+            # Button transitions must reach the host, so only merge movement
+            if not isinstance(other, Mouse.Message) or \
+                (self.left_button, self.right_button) != (other.left_button, other.right_button):
+                return None
+            
+            rel_x = self.rel_x + other.rel_x
+            rel_y = self.rel_y + other.rel_y
+            wheel = self.wheel + other.wheel
+
+            # Don't lose movement to clamping
+            if max(abs(rel_x), abs(rel_y), abs(wheel)) > 1.0:
+                return None
+
+            return Mouse.Message(self.left_button, self.right_button, rel_x, rel_y, wheel)
+
+# This lookup table (lut) accelerates Message.buttons
 # Key: (left_button, right_button)
 _buttons_lut: typing.Dict[typing.Tuple[bool, bool], bytes] = {
     (False, False): b'\x00',
@@ -0,0 +1,137 @@
+import typing
+
+from functools import lru_cache
+
+from ..util import message_dataclass
+from .hid import T, HID, StructMessage
+
+# This report ID cannot conflict with any other devices
+MULTITOUCH_ID = 0x04
+_MAX_TOUCH = 10000
+_LOGICAL_MAX = _MAX_TOUCH.to_bytes(2, 'little', signed = True)
+
+CONTACT_FORMAT = 'BBhh' # tip, contact id, x, y
+CONTACT_SIZE = 6
+
+DEFAULT_MAX_CONTACTS = 5
+# Binary frame payloads are at most 255 bytes: a contact count, then every contact
+MAX_CONTACTS_LIMIT = (0xFF - 1) // CONTACT_SIZE
+
+
+class Contact(typing.NamedTuple):
+    """ One finger on a MultiTouch digitizer """
+    id: int # identifies the finger for as long as it's down (0 - 255)
+    tip: bool = True # touching; report a lifted finger once with tip = False
+    x: float = 0.0 # (0.0, 1.0)
+    y: float = 0.0 # (0.0, 1.0)
+
+
+def _contact_description() -> typing.List[int]:
+    return [
+        0x05, 0x0D,                    #   Usage Page (Digitizer)
+        0x09, 0x22,                    #   Usage (Finger)
+        0xA1, 0x02,                    #   Collection (Logical)
+
+        # Finger up/down, then pad out the rest of the byte
+        0x09, 0x42,                    #     Usage (Tip Switch)
+        0x15, 0x00,                    #     Logical Minimum (0)
+        0x25, 0x01,                    #     Logical Maximum (1)
+        0x75, 0x01,                    #     Report Size (1)
+        0x95, 0x01,                    #     Report Count (1)
+        0x81, 0x02,                    #     Input (Data,Var,Abs)
+        0x75, 0x07,                    #     Report Size (7)
+        0x81, 0x03,                    #     Input (Cnst,Var,Abs)
+
+        # Which finger this is, so the host can track it from report to report
+        0x09, 0x51,                    #     Usage (Contact Identifier)
+        0x26, 0xFF, 0x00,              #     Logical Maximum (255)
+        0x75, 0x08,                    #     Report Size (8)
+        0x81, 0x02,                    #     Input (Data,Var,Abs)
+
+        # Absolute X and Y of 16 bit each, like Touch
+        0x05, 0x01,                    #     Usage Page (Generic Desktop)
+        0x09, 0x30,                    #     Usage (X)
+        0x09, 0x31,                    #     Usage (Y)
+        0x26, *_LOGICAL_MAX,           #     Logical Maximum (_MAX_TOUCH)
+        0x75, 0x10,                    #     Report Size (16)
+        0x95, 0x02,                    #     Report Count (2)
+        0x81, 0x02,                    #     Input (Data,Var,Abs)
+        0xC0,                          #   End Collection
+    ]
+
+
+def multitouch_description(max_contacts: int) -> bytes:
+    """ Report descriptor of a touch screen reporting up to max_contacts fingers at once """
+    if not 1 <= max_contacts <= MAX_CONTACTS_LIMIT:
+        raise ValueError(f'max_contacts must be between 1 and {MAX_CONTACTS_LIMIT}')
+    return bytes([
+        0x05, 0x0D,                    # Usage Page (Digitizer)
+        0x09, 0x04,                    # Usage (Touch Screen)
+        0xA1, 0x01,                    # Collection (Application)
+        0x85, MULTITOUCH_ID,           #   Report ID
+
+        # Number of valid contacts in this report; the rest are zeroed
+        0x09, 0x54,                    #   Usage (Contact Count)
+        0x15, 0x00,                    #   Logical Minimum (0)
+        0x25, max_contacts,            #   Logical Maximum (max_contacts)
+        0x75, 0x08,                    #   Report Size (8)
+        0x95, 0x01,                    #   Report Count (1)
+        0x81, 0x02,                    #   Input (Data,Var,Abs)
+
+        *_contact_description() * max_contacts,
+        0xC0,                          # End Collection
+    ])
+
+
+class MultiTouch(HID):
+    """ Absolute multi-touch digitizer (touch screen): every finger that's down goes
+    in one report, so a multi-finger gesture costs one report per frame rather than
+    one per finger.  Reports up to MAX_CONTACTS fingers; other maximums are available
+    from MultiTouch.with_max_contacts, and must match the daemon's [bluetooth] max_contacts """
+
+    MAX_CONTACTS: typing.ClassVar[int] = DEFAULT_MAX_CONTACTS
+    REPORT_DESCRIPTION = multitouch_description(DEFAULT_MAX_CONTACTS)
+
+    Contact = Contact
+
+    @message_dataclass
+    class Message(StructMessage):
+        REPORT_ID = MULTITOUCH_ID
+        PAYLOAD_FORMAT = 'B' + CONTACT_FORMAT * DEFAULT_MAX_CONTACTS # contact count, contacts
+        MAX_CONTACTS: typing.ClassVar[int] = DEFAULT_MAX_CONTACTS
+
+        contacts: typing.Sequence[Contact] = ()
+
+        def __post_init__(self) -> None:
+            if len(self.contacts) > self.MAX_CONTACTS:
+                raise ValueError(f'{len(self.contacts)} contacts; this device reports at most {self.MAX_CONTACTS}')
+
+        def _pack(self, pack: typing.Callable[..., T], header0: int, header1: int) -> T:
+            fields = [header0, header1, len(self.contacts)]
+            for contact in self.contacts:
+                fields += (
+                    1 if contact.tip else 0,
+                    contact.id & 0xFF,
+                    int(max(min(contact.x, 1.0), 0.0) * _MAX_TOUCH),
+                    int(max(min(contact.y, 1.0), 0.0) * _MAX_TOUCH),
+                )
+            fields += (0,) * (len(CONTACT_FORMAT) * (self.MAX_CONTACTS - len(self.contacts)))
+            return pack(*fields)
+
+    @staticmethod
+    @lru_cache(maxsize = None)
+    def with_max_contacts(max_contacts: int) -> typing.Type['MultiTouch']:
+        """ MultiTouch reporting up to max_contacts fingers at once """
+        if max_contacts == DEFAULT_MAX_CONTACTS:
+            return MultiTouch
+        description = multitouch_description(max_contacts)
+        message = message_dataclass(type('Message', (MultiTouch.Message,), {
+            '__qualname__': f'MultiTouch{max_contacts}.Message',
+            'PAYLOAD_FORMAT': 'B' + CONTACT_FORMAT * max_contacts,
+            'MAX_CONTACTS': max_contacts,
+        }))
+        return type(f'MultiTouch{max_contacts}', (MultiTouch,), {
+            'MAX_CONTACTS': max_contacts,
+            'REPORT_DESCRIPTION': description,
+            'Message': message,
+        })
@@ -1,6 +1,7 @@
-from dataclasses import dataclass
+import typing
 
-from .hid import HID, HIDMessage
+from ..util import message_dataclass, ArrayLike
+from .hid import T, HID, HIDMessage, StructMessage
 
 # This report ID cannot conflict with any other devices
 TOUCH_ID = 0x03
@@ -55,8 +56,32 @@ class Touch(HID):
         0xc0                           # END_COLLECTION
     ])
 
-    @dataclass
-    class Message(HIDMessage):
+    @classmethod
+    def encode_batch(cls, touch: ArrayLike, abs_x: ArrayLike, abs_y: ArrayLike) -> bytes:
+        """ Vectorized equivalent of b''.join(Touch.Message(t, x, y).frame() for t, x, y in ...)
+        Arguments are broadcast against each other; returns binary stream frames (requires numpy) """
+        import numpy as np
+
+        touch, abs_x, abs_y = np.broadcast_arrays(touch, abs_x, abs_y)
+        frames = np.empty(touch.size, dtype = np.dtype([
+            ('report_id', 'u1'), 
+            ('length', 'u1'), 
+            ('touch', 'u1'), 
+            ('x', '<i2'), 
+            ('y', '<i2')
+        ]))
+        frames['report_id'] = TOUCH_ID
+        frames['length'] = frames.itemsize - 2
+        frames['touch'] = touch.ravel().astype(np.int64) & 0xFF
+        frames['x'] = np.clip(abs_x.ravel(), 0.0, 1.0) * _MAX_TOUCH # astype truncates like int()
+        frames['y'] = np.clip(abs_y.ravel(), 0.0, 1.0) * _MAX_TOUCH
+        return frames.tobytes()
+
+    @message_dataclass
+    class Message(StructMessage):
+        REPORT_ID = TOUCH_ID
+        PAYLOAD_FORMAT = 'Bhh' # touch, x, y
+
         touch: int = 0x00 # Individual buttons (3x) [bit0 = up/down, bit1 = in range]
         abs_x: float = 0.0 # (0.0, 1.0)
         abs_y: float = 0.0 # (0.0, 1.0)
@@ -65,12 +90,17 @@ class Touch(HID):
             self.abs_x = max(min(self.abs_x, 1.0), 0.0)
             self.abs_y = max(min(self.abs_y, 1.0), 0.0)
 
-        @property
-        def report_id(self) -> int:
-            return TOUCH_ID
+        def _pack(self, pack: typing.Callable[..., T], header0: int, header1: int) -> T:
+            return pack(
+                header0,
+                header1,
+                self.touch & 0xFF, 
+                int(self.abs_x * _MAX_TOUCH), 
+                int(self.abs_y * _MAX_TOUCH),
+            )
 
-        @property
-        def payload(self) -> bytes:
-            x = int(self.abs_x * _MAX_TOUCH).to_bytes(2, 'little', signed = True)
-            y = int(self.abs_y * _MAX_TOUCH).to_bytes(2, 'little', signed = True)
-            return bytes([self.touch & 0xFF, *x, *y])
+        def accumulate(self, other: HIDMessage) -> typing.Optional["Touch.Message"]:
+            # Positions are absolute, so the newest wins, but touch down/up must reach the host
+            if not isinstance(other, Touch.Message) or self.touch != other.touch:
+                return None
+            return other
@@ -9,7 +9,7 @@ from ezmsg.bthid.device import Keyboard
 
 class GhostWriterSettings(ez.Settings):
     message: str
-    pub_rate: float = 3 # Hz
+    pub_rate: float = 6 # Hz; reports per second
 
 class GhostWriter(ez.Unit):
     SETTINGS = GhostWriterSettings
@@ -18,42 +18,9 @@ class GhostWriter(ez.Unit):
 
     @ez.publisher(OUTPUT)
     async def push_buttons(self) -> typing.AsyncGenerator:
-        for character in self.SETTINGS.message:
-            control_keys = 0x00
-            keycode = 0x00
-
-            if character.isdigit():
-                keycode = ord(character) - ord('0') + Keyboard.KEYCODE_NUMBER_1
-            elif character.isalpha():
-                keycode = ord(character.lower()) - ord('a') + Keyboard.KEYCODE_A
-                if character.isupper():
-                    control_keys |= Keyboard.MODIFIER_LEFT_SHIFT
-            elif character == ' ':
-                keycode = Keyboard.KEYCODE_SPACEBAR
-            elif character == ',':
-                keycode = Keyboard.KEYCODE_COMMA
-            elif character == '.':
-                keycode = Keyboard.KEYCODE_PERIOD
-            else: # ?
-                keycode = Keyboard.KEYCODE_FORWARD_SLASH
-                control_keys |= Keyboard.MODIFIER_LEFT_SHIFT
-            
-            yield self.OUTPUT, Keyboard.Message(
-                mod_keys = control_keys, 
-                key1 = keycode
-            )
-
-            yield self.OUTPUT, Keyboard.Message() # Release keys
-
+        for msg in Keyboard.compile_text(self.SETTINGS.message + '\n'):
+            yield self.OUTPUT, msg
             await asyncio.sleep(1.0 / self.SETTINGS.pub_rate)
-        
-        yield self.OUTPUT, Keyboard.Message(
-            key1 = Keyboard.KEYCODE_ENTER
-        )
-
-        yield self.OUTPUT, Keyboard.Message() # Release key
-
-        await asyncio.sleep(1.0 / self.SETTINGS.pub_rate)
 
         raise ez.Complete
 
@@ -83,7 +50,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '--message', '-m',
         type = str,
-        help = 'message to type (keep it alphanumeric)',
+        help = 'message to type (printable US ASCII)',
         default = 'Wake up, Neo...'
     )
 
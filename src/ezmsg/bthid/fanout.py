@@ -0,0 +1,104 @@
+import typing
+
+from collections import deque
+
+# Fanout of reports from producers to Bluetooth hosts in the async daemon.
+#
+# Broadcast reports are appended once to a shared Ring of immutable packets, and
+# every connected host reads them through its own Cursor, so fanning a report out
+# to N hosts costs no copies and no per-host queue operations.  Reports targeted
+# at one host go into that host's cursor instead, tagged with the ring position
+# they arrived at so they're interleaved with broadcasts in arrival order.
+# Packets are released once every cursor has moved past them.
+
+T = typing.TypeVar('T')
+
+# Number of appends between attempts to release packets every cursor has read
+TRIM_INTERVAL = 64
+
+
+class Ring(typing.Generic[T]):
+    """ Shared log of packets broadcast to every Cursor """
+
+    packets: typing.Deque[T]
+    base: int # position of packets[0]
+    cursors: typing.Set['Cursor[T]']
+
+    def __init__(self) -> None:
+        self.packets = deque()
+        self.base = 0
+        self.cursors = set()
+        self._trim_at = TRIM_INTERVAL
+
+    @property
+    def head(self) -> int:
+        """ Position the next packet will be appended at """
+        return self.base + len(self.packets)
+
+    def append(self, packet: T) -> None:
+        packets = self.packets
+        packets.append(packet)
+        if len(packets) >= self._trim_at:
+            self.trim()
+            self._trim_at = len(packets) + TRIM_INTERVAL
+
+    def trim(self) -> None:
+        """ Release packets every cursor has read """
+        oldest = min((cursor.position for cursor in self.cursors), default = self.head)
+        packets = self.packets
+        while self.base < oldest:
+            packets.popleft()
+            self.base += 1
+
+    def cursor(self) -> 'Cursor[T]':
+        """ A new reader that receives packets appended from now on """
+        cursor = Cursor(self)
+        self.cursors.add(cursor)
+        return cursor
+
+    def remove(self, cursor: 'Cursor[T]') -> None:
+        self.cursors.discard(cursor)
+
+
+class Cursor(typing.Generic[T]):
+    """ One reader's position in a Ring, plus packets meant only for this reader """
+
+    ring: Ring[T]
+    position: int # next ring position to read
+    private: typing.Deque[typing.Tuple[int, T]] # (ring position it arrived at, packet)
+    skipped: typing.Set[int] # ring positions this reader won't read (e.g. dropped)
+
+    def __init__(self, ring: Ring[T]) -> None:
+        self.ring = ring
+        self.position = ring.head
+        self.private = deque()
+        self.skipped = set()
+
+    def pending(self) -> int:
+        """ Number of packets waiting to be read """
+        return self.ring.head - self.position - len(self.skipped) + len(self.private)
+
+    def push(self, packet: T) -> None:
+        """ Add a packet for this reader only, after everything appended to the ring so far """
+        self.private.append((self.ring.head, packet))
+
+    def skip(self, position: int) -> None:
+        """ Don't read the ring packet at position (which may not be appended yet) """
+        self.skipped.add(position)
+
+    def pop(self) -> typing.Optional[T]:
+        """ Next packet in arrival order, if any """
+        private = self.private
+        ring = self.ring
+        skipped = self.skipped
+        while True:
+            if private and private[0][0] <= self.position:
+                return private.popleft()[1]
+            position = self.position
+            if position >= ring.head:
+                return None
+            self.position = position + 1
+            if skipped and position in skipped:
+                skipped.discard(position)
+                continue
+            return ring.packets[position - ring.base]
@@ -1,19 +1,159 @@
+import time
 import asyncio
+import typing
+
+from collections import deque
 
 import ezmsg.core as ez
 
 from .config import BTHIDConfig
 from .device.hid import HIDMessage
+from .device.keyboard import KEYBOARD_ID
+from .device.mouse import MOUSE_ID
+from .device.touch import TOUCH_ID
+from .protocol import (
+    PROTOCOL_BINARY, 
+    PROTOCOL_HEX, 
+    BINARY_HANDSHAKE, 
+    frames_to_hex, 
+    encode_timestamp, 
+    encode_deadline,
+    encode_clock,
+    clock_offset,
+    encode_target,
+    encode_datagram, 
+    pack_datagrams,
+    split_each_frame,
+    MAX_DATAGRAM_SIZE,
+    CLOCK_REPLY_FRAME,
+    CLOCK_UNSCHEDULED,
+    ProtocolError,
+)
+
+if typing.TYPE_CHECKING:
+    from .shmring import RingWriter
+
+# Queue policies determine what happens to reports that are still waiting 
+# to be sent to the daemon when a newer report of the same type is written
+QUEUE_FIFO = 'fifo' # send every report, in order
+QUEUE_LATEST = 'latest' # only send the newest pending report
+QUEUE_ACCUMULATE = 'accumulate' # merge into the pending report (see HIDMessage.accumulate)
+QUEUE_POLICIES = (QUEUE_FIFO, QUEUE_LATEST, QUEUE_ACCUMULATE)
+
+# Clock requests sent on connect; the one with the shortest round trip sets the clock offset
+CLOCK_SAMPLES = 4
+
+# Messages, or pre-encoded binary frames (e.g. from Touch.encode_batch)
+QueueItem = typing.Union[HIDMessage, bytes]
+
+
+def encode_binary(msg: QueueItem) -> bytes:
+    return msg if isinstance(msg, bytes) else msg.frame()
+
+
+def encode_hex(msg: QueueItem) -> bytes:
+    return frames_to_hex(msg) if isinstance(msg, bytes) else msg.encode()
+
+
+def encode_stamped(msg: QueueItem, stamp: bytes) -> bytes:
+    """ Binary encoding with stamp (control frames that apply to the next report, e.g. 
+    timestamp and deadline) ahead of every frame, so each frame of a batch gets them """
+    if isinstance(msg, bytes):
+        return b''.join(stamp + frame for frame in split_each_frame(msg))
+    return stamp + msg.frame()
+
+
+class HIDQueue:
+    """ An asyncio.Queue-like container for HIDMessages that applies a queue policy 
+    per report ID.  Coalesced reports keep the position of the pending report they 
+    were merged into, so ordering relative to other devices is preserved, and the 
+    number of pending reports for non-FIFO devices stays bounded under backpressure.
+    Pre-encoded binary frames (bytes) are always queued FIFO. 
+    After a get, `enqueued` holds the time.monotonic_ns() at which the returned
+    item was last written to the queue. """
+
+    enqueued: int
+
+    def __init__(self, policies: typing.Dict[int, str]) -> None:
+        for policy in policies.values():
+            if policy not in QUEUE_POLICIES:
+                raise ValueError(f'Unknown queue policy: {policy}')
+        self._policies = policies
+        self._pending: typing.Deque[typing.List[typing.Any]] = deque()
+        self._tails: typing.Dict[int, typing.List[typing.Any]] = {}
+        self.enqueued = 0
+        self._nonempty = asyncio.Event()
+
+    def qsize(self) -> int:
+        return len(self._pending)
+
+    def empty(self) -> bool:
+        return not self._pending
+
+    def put_nowait(self, msg: QueueItem) -> None:
+        if isinstance(msg, bytes):
+            report_id, policy = None, QUEUE_FIFO
+        else:
+            report_id = msg.report_id
+            policy = self._policies.get(report_id, QUEUE_FIFO)
+
+        if policy != QUEUE_FIFO:
+            # Slots are [message, enqueue time] lists so pending messages can be swapped in-place
+            tail = self._tails.get(report_id)
+            if tail is not None:
+                merged = msg if policy == QUEUE_LATEST else tail[0].accumulate(msg) # type: ignore
+                if merged is not None:
+                    tail[0] = merged
+                    tail[1] = time.monotonic_ns()
+                    return
+            
+        slot = [msg, time.monotonic_ns()]
+        self._pending.append(slot)
+        if report_id is not None and policy != QUEUE_FIFO:
+            self._tails[report_id] = slot
+        self._nonempty.set()
+
+    def get_nowait(self) -> QueueItem:
+        if not self._pending:
+            raise asyncio.QueueEmpty
+        slot = self._pending.popleft()
+        msg, self.enqueued = slot
+        if not isinstance(msg, bytes) and self._tails.get(msg.report_id) is slot:
+            del self._tails[msg.report_id]
+        if not self._pending:
+            self._nonempty.clear()
+        return msg
+
+    async def get(self) -> QueueItem:
+        while not self._pending:
+            await self._nonempty.wait()
+        return self.get_nowait()
 
 
 class HIDOutputSettings(ez.Settings):
     host: str = BTHIDConfig.DEFAULT_HOST
     port: int = BTHIDConfig.DEFAULT_PORT
+    unix_path: typing.Optional[str] = None # connect to the daemon's unix socket (see BTHIDConfig.unix_path) instead of host/port
+    shm_path: typing.Optional[str] = None # write reports to a shared memory ring attached at BTHIDConfig.shm_path instead
     reconnect_timeout: float = 0 # sec; if 0, don't attempt to reconnect
+    protocol: str = PROTOCOL_BINARY # PROTOCOL_BINARY falls back to PROTOCOL_HEX for older daemons
+    handshake_timeout: float = 1.0 # sec; how long to wait for the daemon to accept PROTOCOL_BINARY
+    max_batch: int = 64 # maximum number of queued reports coalesced into a single write; 1 disables batching
+    batch_latency: float = 0.0 # sec; how long to wait for more reports to fill a batch after the first arrives
+    timestamps: bool = False # stamp reports with their enqueue time for daemon latency stats (binary protocol only)
+    keyboard_policy: str = QUEUE_FIFO # Every keypress/release matters
+    mouse_policy: str = QUEUE_ACCUMULATE # Sum pending movement; button changes are preserved
+    touch_policy: str = QUEUE_ACCUMULATE # Only the newest absolute position matters; touch changes are preserved
+    udp_port: int = 0 # send udp_report_ids to the daemon's datagram port (BTHIDConfig.udp_port) on host; 0 disables
+    udp_report_ids: typing.Tuple[int, ...] = (TOUCH_ID,) # loss-tolerant reports; everything else stays on the stream connection
+    target: typing.Optional[str] = None # address of the one Bluetooth host to send reports to (binary protocol only); None for every host
+    schedule_delay: float = 0.0 # sec; have the daemon send each report this long after it was written, smoothing out network jitter (binary protocol only); 0 sends right away
 
 
 class HIDOutputState(ez.State):
-    queue: asyncio.Queue[HIDMessage]
+    queue: HIDQueue
+    udp_queue: typing.Optional[HIDQueue] = None
+    protocol: str
     dead: bool = False
 
 
@@ -23,21 +163,101 @@ class HIDOutput(ez.Unit):
     STATE = HIDOutputState
 
     INPUT_HID = ez.InputStream(HIDMessage)
+    INPUT_FRAMES = ez.InputStream(bytes) # Binary stream frames; e.g. from Touch.encode_batch
 
     async def initialize(self) -> None:
-        self.STATE.queue = asyncio.Queue()
+        policies = {
+            KEYBOARD_ID: self.SETTINGS.keyboard_policy,
+            MOUSE_ID: self.SETTINGS.mouse_policy,
+            TOUCH_ID: self.SETTINGS.touch_policy,
+        }
+        self.STATE.queue = HIDQueue(policies)
+        if self.SETTINGS.udp_port:
+            self.STATE.udp_queue = HIDQueue(policies)
+        # Shared memory rings are new enough to always speak the binary protocol
+        self.STATE.protocol = PROTOCOL_BINARY if self.SETTINGS.shm_path is not None else self.SETTINGS.protocol
+
+    async def negotiate(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """ Request the binary protocol; returns False if the daemon doesn't acknowledge it.
+        Raises ConnectionResetError if the connection drops first, which says nothing
+        about the protocols the daemon supports """
+        writer.write(BINARY_HANDSHAKE)
+        await writer.drain()
+        try:
+            ack = await asyncio.wait_for(
+                reader.readexactly(len(BINARY_HANDSHAKE)), 
+                timeout = self.SETTINGS.handshake_timeout
+            )
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionResetError('ezmsg-bthid daemon closed the connection during the binary handshake') from e
+        return ack == BINARY_HANDSHAKE
+
+    async def sync_clock(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> typing.Optional[int]:
+        """ Estimate the offset (ns) from our time.monotonic_ns() to the daemon's; None if
+        the daemon doesn't reply or can't schedule reports """
+        best: typing.Optional[typing.Tuple[int, int]] = None # (round trip, offset)
+        for _ in range(CLOCK_SAMPLES):
+            writer.write(encode_clock(time.monotonic_ns()))
+            await writer.drain()
+            try:
+                reply = await asyncio.wait_for(
+                    reader.readexactly(CLOCK_REPLY_FRAME.size), 
+                    timeout = self.SETTINGS.handshake_timeout
+                )
+                offset, round_trip = clock_offset(reply, time.monotonic_ns())
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ProtocolError):
+                return None
+            if CLOCK_REPLY_FRAME.unpack(reply)[-1] == CLOCK_UNSCHEDULED:
+                return None
+            if best is None or round_trip < best[0]:
+                best = (round_trip, offset)
+        assert best is not None
+        return best[1]
+
+    async def next_batch(self, queue: typing.Optional[HIDQueue] = None) -> typing.List[typing.Tuple[QueueItem, int]]:
+        """ Wait for a message, then collect everything else that is already queued 
+        (or arrives within batch_latency) up to max_batch messages, with enqueue times """
+        if queue is None:
+            queue = self.STATE.queue
+        batch = [(await queue.get(), queue.enqueued)]
+        deadline = time.monotonic() + self.SETTINGS.batch_latency
+
+        while len(batch) < self.SETTINGS.max_batch:
+            try:
+                batch.append((queue.get_nowait(), queue.enqueued))
+            except asyncio.QueueEmpty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                try:
+                    msg = await asyncio.wait_for(queue.get(), timeout = remaining)
+                    batch.append((msg, queue.enqueued))
+                except asyncio.TimeoutError:
+                    break
+
+        return batch
+
+    async def open_connection(self) -> typing.Tuple[typing.Optional[asyncio.StreamReader], typing.Union[asyncio.StreamWriter, 'RingWriter']]:
+        """ Connect to the daemon; shared memory rings have no reader, and always use the binary protocol """
+        if self.SETTINGS.shm_path is not None:
+            from .shmring import open_ring_connection # Linux only; producers elsewhere use tcp
+            return None, await open_ring_connection(self.SETTINGS.shm_path)
+        if self.SETTINGS.unix_path is not None:
+            return await asyncio.open_unix_connection(self.SETTINGS.unix_path)
+        return await asyncio.open_connection(
+            host = self.SETTINGS.host, 
+            port = self.SETTINGS.port
+        )
 
     @ez.task
     async def handle_connection(self) -> None:
 
         while True:
             try:
-                _, writer = await asyncio.open_connection(
-                    host = self.SETTINGS.host, 
-                    port = self.SETTINGS.port
-                )
+                reader, writer = await self.open_connection()
 
-            except ConnectionRefusedError:
+            except (ConnectionRefusedError, FileNotFoundError):
                 if self.SETTINGS.reconnect_timeout:
                     ez.logger.info('Attempting reconnection to ezmsg-bthid daemon...')
                     await asyncio.sleep(self.SETTINGS.reconnect_timeout)
@@ -46,15 +266,57 @@ class HIDOutput(ez.Unit):
                     ez.logger.info('ezmsg-bthid daemon not reachable')
                     break
 
-            ez.logger.info('Connected to ezmsg-bthid daemon!')
-
             try:
+                if reader is not None and self.STATE.protocol == PROTOCOL_BINARY:
+                    if not await self.negotiate(reader, writer): # type: ignore
+                        # Older daemons only speak hex; they've already consumed part 
+                        # of our handshake, so we need a fresh connection
+                        ez.logger.info('ezmsg-bthid daemon does not support binary protocol; using hex')
+                        self.STATE.protocol = PROTOCOL_HEX
+                        continue
+
+                ez.logger.info(f'Connected to ezmsg-bthid daemon! ({self.STATE.protocol} protocol)')
+                binary = self.STATE.protocol == PROTOCOL_BINARY
+                encode = encode_binary if binary else encode_hex
+                timestamps = binary and self.SETTINGS.timestamps
+
+                # Reports are scheduled at enqueue time + schedule_delay, on the daemon's clock
+                deadline_offset: typing.Optional[int] = None
+                if self.SETTINGS.schedule_delay > 0:
+                    if binary and reader is not None:
+                        offset = await self.sync_clock(reader, writer) # type: ignore
+                        if offset is None:
+                            ez.logger.warning('ezmsg-bthid daemon does not support scheduled reports; sending right away')
+                        else:
+                            deadline_offset = offset + int(self.SETTINGS.schedule_delay * 1e9)
+                    elif binary:
+                        # Shared memory producers share the daemon's clock
+                        deadline_offset = int(self.SETTINGS.schedule_delay * 1e9)
+                    else:
+                        ez.logger.warning(f'{self.STATE.protocol} protocol can not schedule reports; sending right away')
+
+                if self.SETTINGS.target is not None:
+                    if binary:
+                        # Targets last for the whole connection
+                        writer.write(encode_target(self.SETTINGS.target))
+                    else:
+                        ez.logger.warning(f'{self.STATE.protocol} protocol can not target {self.SETTINGS.target}; sending to every host')
+
                 while True:
-                    msg = await self.STATE.queue.get()
-                    writer.write(msg.encode())
+                    batch = await self.next_batch()
+                    if deadline_offset is not None:
+                        writer.writelines([
+                            encode_stamped(msg, (encode_timestamp(t) if timestamps else b'') + encode_deadline(t + deadline_offset)) 
+                            for msg, t in batch
+                        ])
+                    elif timestamps:
+                        writer.writelines([encode_stamped(msg, encode_timestamp(t)) for msg, t in batch])
+                    else:
+                        writer.writelines([encode(msg) for msg, _ in batch])
                     await writer.drain()
 
-            except ConnectionResetError:
+            except ConnectionError:
+                # Includes drops during the handshake; the daemon's protocols haven't changed
                 ez.logger.info('Disconnected from ezmsg-bthid daemon')
 
             finally:
@@ -62,8 +324,50 @@ class HIDOutput(ez.Unit):
 
         self.STATE.dead = True
 
+    @ez.task
+    async def handle_datagrams(self) -> None:
+        """ Send udp_report_ids to the daemon as datagrams; these are never retransmitted, 
+        and the daemon drops any that arrive out of order """
+        queue = self.STATE.udp_queue
+        if queue is None:
+            return
+
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            asyncio.DatagramProtocol,
+            remote_addr = (self.SETTINGS.host, self.SETTINGS.udp_port)
+        )
+        ez.logger.info(f'Sending datagrams to ezmsg-bthid daemon at {self.SETTINGS.host}:{self.SETTINGS.udp_port}/udp')
+
+        # Every datagram is independent, so each one carries the target
+        target = encode_target(self.SETTINGS.target) if self.SETTINGS.target is not None else b''
+        sequence = 0
+        try:
+            while True:
+                batch = await self.next_batch(queue)
+                if self.SETTINGS.timestamps:
+                    frames = [encode_stamped(msg, encode_timestamp(t)) for msg, t in batch]
+                else:
+                    frames = [encode_binary(msg) for msg, _ in batch]
+                for payload in pack_datagrams(frames, MAX_DATAGRAM_SIZE - len(target)):
+                    transport.sendto(encode_datagram(sequence, target + payload))
+                    sequence += 1
+        finally:
+            transport.close()
+
+    def queue_for(self, report_id: int) -> HIDQueue:
+        udp_queue = self.STATE.udp_queue
+        if udp_queue is not None and report_id in self.SETTINGS.udp_report_ids:
+            return udp_queue
+        return self.STATE.queue
+
     @ez.subscriber(INPUT_HID)
     async def write(self, msg: HIDMessage) -> None:
         # Don't needlessly buffer messages that won't ever hit the daemon
         if not self.STATE.dead:
-            self.STATE.queue.put_nowait(msg)
+            self.queue_for(msg.report_id).put_nowait(msg)
+
+    @ez.subscriber(INPUT_FRAMES)
+    async def write_frames(self, frames: bytes) -> None:
+        # Batches of frames are routed by their first report ID
+        if not self.STATE.dead and frames:
+            self.queue_for(frames[0]).put_nowait(frames)
@@ -0,0 +1,30 @@
+import typing
+
+import ezmsg.core as ez
+
+from .recording import Recording
+
+
+class HIDReplaySettings(ez.Settings):
+    path: str # recording made by the daemon (see BTHIDConfig.record_path)
+    speed: float = 1.0 # relative to the recorded timing; 0 replays as fast as possible
+    repeat: bool = False # start over at the end of the recording
+
+
+class HIDReplay(ez.Unit):
+    """ Replays a recording as binary frames; connect OUTPUT_FRAMES to HIDOutput.INPUT_FRAMES
+    to drive the daemon with recorded traffic """
+
+    SETTINGS = HIDReplaySettings
+
+    OUTPUT_FRAMES = ez.OutputStream(bytes)
+
+    @ez.publisher(OUTPUT_FRAMES)
+    async def replay(self) -> typing.AsyncGenerator:
+        with Recording(self.SETTINGS.path) as recording:
+            while True:
+                async for frames in recording.play(self.SETTINGS.speed):
+                    yield self.OUTPUT_FRAMES, frames
+                if not self.SETTINGS.repeat:
+                    break
+        ez.logger.info(f'Finished replaying {self.SETTINGS.path}')
@@ -0,0 +1,129 @@
+import asyncio
+import typing
+
+# Prometheus text format metrics for the async daemon (see BTHIDServer.render_metrics).
+#
+# Counting a report is an attribute increment on an object the connection already
+# holds; everything else is computed when the endpoint is scraped.  Memory is fixed:
+# per-producer and per-host series only exist while they're connected, and their
+# counts are folded into daemon-wide totals when they disconnect.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds between event loop lag measurements
+LAG_INTERVAL = 0.1
+
+# Seconds a scraper gets to send its request
+SCRAPE_TIMEOUT = 5.0
+
+Labels = typing.Dict[str, str]
+Sample = typing.Tuple[Labels, float]
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+
+class ClientCounters:
+    """ Reports and bytes received from one producer connection """
+
+    name: str # unique among connected producers
+    reports: int
+    bytes: int
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.reports = 0
+        self.bytes = 0
+
+
+class Metrics:
+    """ Daemon-wide counters that outlive individual connections """
+
+    clients: typing.Dict[str, ClientCounters] # connected producers by name
+    connections: int # producers ever connected
+    received_reports: int # from disconnected producers
+    received_bytes: int
+    sent_reports: int # to disconnected hosts
+    sent_bytes: int
+    send_errors: int
+    dropped: int
+    suppressed: int
+    lag: float # seconds; most recent event loop lag measurement
+    lag_max: float # seconds; worst event loop lag since the last scrape
+
+    def __init__(self) -> None:
+        self.clients = {}
+        self.connections = 0
+        self.received_reports = 0
+        self.received_bytes = 0
+        self.sent_reports = 0
+        self.sent_bytes = 0
+        self.send_errors = 0
+        self.dropped = 0
+        self.suppressed = 0
+        self.lag = 0.0
+        self.lag_max = 0.0
+
+    def connect(self, name: str) -> ClientCounters:
+        """ Counters for a new producer connection, labelled name (made unique if need be) """
+        self.connections += 1
+        if not name or name in self.clients:
+            name = f'{name}#{self.connections}'
+        counters = ClientCounters(name)
+        self.clients[name] = counters
+        return counters
+
+    def disconnect(self, counters: ClientCounters) -> None:
+        """ Fold a departing producer's counts into the totals """
+        if self.clients.pop(counters.name, None) is counters:
+            self.received_reports += counters.reports
+            self.received_bytes += counters.bytes
+
+    async def monitor_lag(self, interval: float = LAG_INTERVAL) -> None:
+        """ Measure how late the event loop wakes up from a sleep of interval seconds """
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.lag = max(0.0, loop.time() - expected)
+            if self.lag > self.lag_max:
+                self.lag_max = self.lag
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def family(name: str, kind: str, description: str, samples: typing.Iterable[Sample]) -> typing.List[str]:
+    """ Text format lines for one metric family """
+    lines = [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+    for labels, value in samples:
+        if labels:
+            label_text = ','.join(f'{key}="{_escape(text)}"' for key, text in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}')
+        else:
+            lines.append(f'{name} {value}')
+    return lines
+
+
+async def handle_scrape(render: typing.Callable[[], str], reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """ Answer one HTTP request with render() """
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), SCRAPE_TIMEOUT)
+        method, path, _ = request.split(b' ', 2)
+        if method != b'GET':
+            status, body = '405 Method Not Allowed', ''
+        elif path.split(b'?')[0] not in (b'/', b'/metrics'):
+            status, body = '404 Not Found', ''
+        else:
+            status, body = '200 OK', render()
+        payload = body.encode()
+        writer.write(
+            f'HTTP/1.0 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+            f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode() + payload
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError, ConnectionError):
+        pass
+    finally:
+        writer.close()
@@ -0,0 +1,378 @@
+import struct
+import typing
+
+# Ingest protocols spoken between producers (e.g. HIDOutput) and the ezmsg-bthid daemon
+#
+# * hex: every report is hex encoded and terminated with a newline.  This is the
+#   original protocol and is assumed for any client that doesn't negotiate.
+# * binary: the client opens the connection by sending BINARY_HANDSHAKE, which
+#   the daemon echoes back.  Every report is then sent as a frame of
+#   [report id: u8][payload length: u8][payload: bytes]
+# * datagram: loss-tolerant producers (e.g. absolute pointer positions, where only
+#   the newest sample matters) can instead send UDP datagrams of
+#   [DATAGRAM_HEADER][binary frames], with no handshake.  The header carries a 
+#   per-producer sequence number; the daemon drops datagrams that arrive out of 
+#   order or late rather than waiting for anything lost along the way.
+PROTOCOL_HEX = 'hex'
+PROTOCOL_BINARY = 'binary'
+PROTOCOLS = (PROTOCOL_HEX, PROTOCOL_BINARY)
+
+# The first byte of this handshake can never start a hex-encoded line,
+# so the daemon can tell the two protocols apart from the first byte received
+BINARY_HANDSHAKE = b'\x00BTHID\x01'
+
+# DATA | Input; first byte of every report sent over the Bluetooth interrupt channel
+HID_INPUT_REPORT = 0xA1
+REPORT_HEADER = struct.Struct('<BB') # HID_INPUT_REPORT, report id; the payload follows
+
+# Longest hex protocol line (bytes, without the newline) the daemon accepts: twice the
+# longest report a binary frame can carry, so clients that never send a newline
+# can't grow the daemon's buffer without bound
+MAX_HEX_LINE = 2 * (REPORT_HEADER.size + 0xFF)
+
+FRAME_HEADER = struct.Struct('<BB') # report id, payload length
+
+# Report ID 0 is reserved by HID, so binary frames with that ID carry control
+# messages for the daemon instead of reports.  Their payload starts with a 
+# control type byte; timestamps and deadlines apply to the report that follows them, 
+# while a target applies to every following report on the connection (or in the datagram)
+CONTROL_FRAME = 0x00
+CONTROL_TIMESTAMP = 0x01 # u64: producer time.monotonic_ns() when the report was enqueued
+CONTROL_TARGET = 0x02 # utf-8 address of the Bluetooth host to send reports to; empty for every host
+CONTROL_DEADLINE = 0x03 # u64: daemon time.monotonic_ns() at which to send the report to hosts
+CONTROL_CLOCK = 0x04 # u64: producer time.monotonic_ns(); the daemon replies with a CLOCK_REPLY_FRAME
+
+CONTROL_HEADER = struct.Struct('<BBB') # CONTROL_FRAME, length, control type
+TIMESTAMP_FRAME = struct.Struct('<BBBQ')
+CLOCK_REPLY_FRAME = struct.Struct('<BBBQQ') # ..., producer time from the request, daemon time.monotonic_ns()
+
+# Producers that aren't on the daemon's machine (and so don't share its monotonic
+# clock) estimate the offset between the clocks by sending CONTROL_CLOCK frames
+# after the binary handshake: with the request sent at producer time t0 and the 
+# reply received at t1, daemon time ~= producer time + daemon_time - (t0 + t1) / 2.
+# The daemon only replies to clock frames on connections it can write to (tcp/unix).
+# Daemons that can't schedule reports (server_sync) reply with CLOCK_UNSCHEDULED
+# as their time, so producers needn't wait for a reply that will never come.
+CLOCK_UNSCHEDULED = 0
+
+DATAGRAM_VERSION = 0x01
+DATAGRAM_HEADER = struct.Struct('<BI') # DATAGRAM_VERSION, sequence number (u32, wraps)
+# Keep datagrams (header + frames) well under typical path MTUs to avoid IP fragmentation
+MAX_DATAGRAM_SIZE = 1200
+
+
+class ProtocolError(ValueError):
+    """ Raised when a client sends data that can't be decoded """
+
+
+def encode_frame(report_id: int, payload: bytes) -> bytes:
+    """ Binary stream encoding of a single report """
+    return FRAME_HEADER.pack(0xFF & report_id, len(payload)) + payload
+
+
+def encode_timestamp(timestamp: int) -> bytes:
+    """ Control frame stamping the next report with its enqueue time (time.monotonic_ns) """
+    return TIMESTAMP_FRAME.pack(CONTROL_FRAME, TIMESTAMP_FRAME.size - FRAME_HEADER.size, CONTROL_TIMESTAMP, timestamp)
+
+
+def encode_deadline(deadline: int) -> bytes:
+    """ Control frame asking the daemon to send the next report at deadline (daemon time.monotonic_ns) """
+    return TIMESTAMP_FRAME.pack(CONTROL_FRAME, TIMESTAMP_FRAME.size - FRAME_HEADER.size, CONTROL_DEADLINE, deadline)
+
+
+def encode_clock(timestamp: int) -> bytes:
+    """ Control frame requesting the daemon's clock, sent at timestamp (producer time.monotonic_ns) """
+    return TIMESTAMP_FRAME.pack(CONTROL_FRAME, TIMESTAMP_FRAME.size - FRAME_HEADER.size, CONTROL_CLOCK, timestamp)
+
+
+def encode_clock_reply(timestamp: int, now: int) -> bytes:
+    """ The daemon's reply to encode_clock(timestamp), at now (daemon time.monotonic_ns) """
+    return CLOCK_REPLY_FRAME.pack(CONTROL_FRAME, CLOCK_REPLY_FRAME.size - FRAME_HEADER.size, CONTROL_CLOCK, timestamp, now)
+
+
+def clock_offset(reply: bytes, received: int) -> typing.Tuple[int, int]:
+    """ (offset to add to producer times to get daemon times, round trip time) in ns,
+    from a clock reply frame received at received (producer time.monotonic_ns) """
+    report_id, length, control, sent, now = CLOCK_REPLY_FRAME.unpack(reply)
+    if report_id != CONTROL_FRAME or control != CONTROL_CLOCK or length != CLOCK_REPLY_FRAME.size - FRAME_HEADER.size:
+        raise ProtocolError(f'Invalid clock reply: {reply!r}')
+    return now - (sent + received) // 2, received - sent
+
+
+def encode_target(target: typing.Optional[str]) -> bytes:
+    """ Control frame routing the following reports to one Bluetooth host (None: every host) """
+    address = target.encode() if target else b''
+    if len(address) > 0xFF - (CONTROL_HEADER.size - FRAME_HEADER.size):
+        raise ValueError(f'Target address too long: {target}')
+    return CONTROL_HEADER.pack(CONTROL_FRAME, CONTROL_HEADER.size - FRAME_HEADER.size + len(address), CONTROL_TARGET) + address
+
+
+def iter_frames(frames: bytes) -> typing.Iterator[bytes]:
+    """ Reports contained in a buffer of complete binary frames """
+    view = memoryview(frames)
+    header_size = FRAME_HEADER.size
+    offset = 0
+    while offset < len(view):
+        if len(view) - offset < header_size:
+            raise ProtocolError('Truncated frame header')
+        report_id, length = FRAME_HEADER.unpack_from(view, offset)
+        end = offset + header_size + length
+        if end > len(view):
+            raise ProtocolError('Truncated frame')
+        if report_id != CONTROL_FRAME:
+            yield bytes((HID_INPUT_REPORT, report_id)) + view[offset + header_size:end]
+        offset = end
+
+
+def split_each_frame(frames: bytes) -> typing.Iterator[bytes]:
+    """ Every binary frame (header included, control frames too) in a buffer of complete binary frames """
+    view = memoryview(frames)
+    header_size = FRAME_HEADER.size
+    offset = 0
+    while offset < len(view):
+        if len(view) - offset < header_size:
+            raise ProtocolError('Truncated frame header')
+        end = offset + header_size + view[offset + 1]
+        if end > len(view):
+            raise ProtocolError('Truncated frame')
+        yield bytes(view[offset:end])
+        offset = end
+
+
+def split_frames(frames: bytes, max_size: int) -> typing.Iterator[bytes]:
+    """ Split a buffer of complete binary frames, at frame boundaries, into chunks of at most max_size bytes """
+    view = memoryview(frames)
+    header_size = FRAME_HEADER.size
+    start = offset = 0
+    while offset < len(view):
+        if len(view) - offset < header_size:
+            raise ProtocolError('Truncated frame header')
+        end = offset + header_size + view[offset + 1]
+        if end - start > max_size and offset > start:
+            yield bytes(view[start:offset])
+            start = offset
+        offset = end
+    if offset > len(view):
+        raise ProtocolError('Truncated frame')
+    if offset > start:
+        yield bytes(view[start:offset])
+
+
+def pack_datagrams(frames: typing.Iterable[bytes], max_size: int = MAX_DATAGRAM_SIZE) -> typing.Iterator[bytes]:
+    """ Coalesce buffers of binary frames into datagram payloads of at most max_size 
+    bytes (including DATAGRAM_HEADER), splitting buffers at frame boundaries if needed """
+    max_payload = max_size - DATAGRAM_HEADER.size
+    payload = bytearray()
+    for buffer in frames:
+        chunks = (buffer,) if len(buffer) <= max_payload else split_frames(buffer, max_payload)
+        for chunk in chunks:
+            if payload and len(payload) + len(chunk) > max_payload:
+                yield bytes(payload)
+                payload.clear()
+            payload += chunk
+    if payload:
+        yield bytes(payload)
+
+
+def encode_datagram(sequence: int, frames: bytes) -> bytes:
+    return DATAGRAM_HEADER.pack(DATAGRAM_VERSION, sequence & 0xFFFFFFFF) + frames
+
+
+def frames_to_hex(frames: bytes) -> bytes:
+    """ Re-encode a buffer of binary frames for the hex protocol """
+    return b''.join(report.hex().encode() + b'\n' for report in iter_frames(frames))
+
+
+class StreamDecoder:
+    """ Incremental decoder for report streams sent to the daemon.
+
+    Data received from a client is passed to `feed` in arbitrarily sized chunks;
+    complete reports (ready for the Bluetooth interrupt channel) are yielded as
+    soon as they have been fully received, and partial frames are kept until
+    the rest of the data arrives.  The protocol is detected from the first bytes
+    received; `on_binary` is called once if the client negotiates the binary
+    protocol so the caller can acknowledge the handshake.
+
+    Control frames are consumed by the decoder; while a report is being yielded,
+    attributes like `sent` and `target` describe that report.  `on_clock` is called 
+    with the producer's time from every clock request so the caller can reply.
+    """
+
+    protocol: typing.Optional[str]
+    buffer: bytearray
+    sent: int # producer enqueue timestamp (time.monotonic_ns) of the current report; 0 if unknown
+    deadline: int # when (daemon time.monotonic_ns) to send the current report; 0 for right away
+    target: typing.Optional[str] # address of the Bluetooth host the current report is for; None for every host
+
+    def __init__(
+        self, 
+        on_binary: typing.Optional[typing.Callable[[], None]] = None,
+        on_clock: typing.Optional[typing.Callable[[int], None]] = None,
+    ) -> None:
+        self.protocol = None
+        self.buffer = bytearray()
+        self.sent = 0
+        self.deadline = 0
+        self.target = None
+        self._next_sent = 0
+        self._next_deadline = 0
+        self._on_binary = on_binary
+        self._on_clock = on_clock
+
+    def feed(self, data: bytes) -> typing.Iterator[bytes]:
+        self.buffer += data
+        return self._decode()
+
+    def _decode(self) -> typing.Iterator[bytes]:
+        if self.protocol is None:
+            if not self._negotiate():
+                return
+
+        if self.protocol == PROTOCOL_BINARY:
+            yield from self._decode_binary()
+        else:
+            yield from self._decode_hex()
+
+    def _negotiate(self) -> bool:
+        buffer = self.buffer
+        if not buffer:
+            return False
+
+        if buffer[0] != BINARY_HANDSHAKE[0]:
+            self.protocol = PROTOCOL_HEX
+            return True
+
+        if len(buffer) < len(BINARY_HANDSHAKE):
+            return False
+
+        if buffer[:len(BINARY_HANDSHAKE)] != BINARY_HANDSHAKE:
+            raise ProtocolError(f'Invalid handshake: {bytes(buffer[:len(BINARY_HANDSHAKE)])!r}')
+
+        del buffer[:len(BINARY_HANDSHAKE)]
+        self.protocol = PROTOCOL_BINARY
+        if self._on_binary is not None:
+            self._on_binary()
+        return True
+
+    def _decode_hex(self) -> typing.Iterator[bytes]:
+        buffer = self.buffer
+        start = 0
+        try:
+            while True:
+                end = buffer.find(b'\n', start, start + MAX_HEX_LINE + 1)
+                if end < 0:
+                    if len(buffer) - start > MAX_HEX_LINE:
+                        raise ProtocolError(f'Hex report longer than {MAX_HEX_LINE} characters')
+                    break
+                line = buffer[start:end]
+                start = end + 1
+                if not line: continue
+                try:
+                    report = bytes.fromhex(line.decode())
+                except ValueError as e:
+                    raise ProtocolError(f'Invalid hex report: {bytes(line)!r}') from e
+                yield report
+        finally:
+            del buffer[:start]
+
+    def _decode_binary(self) -> typing.Iterator[bytes]:
+        buffer = self.buffer
+        header_size = FRAME_HEADER.size
+        start = 0
+        try:
+            while len(buffer) - start >= header_size:
+                report_id, length = FRAME_HEADER.unpack_from(buffer, start)
+                end = start + header_size + length
+                if len(buffer) < end: break
+                if report_id == CONTROL_FRAME:
+                    self._control(buffer, start, end)
+                    start = end
+                    continue
+                report = bytes((HID_INPUT_REPORT, report_id)) + buffer[start + header_size:end]
+                start = end
+                self.sent, self._next_sent = self._next_sent, 0
+                self.deadline, self._next_deadline = self._next_deadline, 0
+                yield report
+        finally:
+            del buffer[:start]
+
+    def _control(self, buffer: bytearray, start: int, end: int) -> None:
+        if end - start < CONTROL_HEADER.size:
+            raise ProtocolError('Empty control frame')
+        _, _, control = CONTROL_HEADER.unpack_from(buffer, start)
+        if control == CONTROL_TIMESTAMP and end - start == TIMESTAMP_FRAME.size:
+            self._next_sent = TIMESTAMP_FRAME.unpack_from(buffer, start)[-1]
+        elif control == CONTROL_DEADLINE and end - start == TIMESTAMP_FRAME.size:
+            self._next_deadline = TIMESTAMP_FRAME.unpack_from(buffer, start)[-1]
+        elif control == CONTROL_CLOCK and end - start == TIMESTAMP_FRAME.size:
+            if self._on_clock is not None:
+                self._on_clock(TIMESTAMP_FRAME.unpack_from(buffer, start)[-1])
+        elif control == CONTROL_TARGET:
+            try:
+                self.target = bytes(buffer[start + CONTROL_HEADER.size:end]).decode() or None
+            except UnicodeDecodeError as e:
+                raise ProtocolError('Invalid target address') from e
+        # Unknown control frames are ignored so newer clients can talk to older daemons
+
+
+class DatagramDecoder(StreamDecoder):
+    """ Decoder for the datagram protocol; every datagram holds complete frames.
+
+    Sequence numbers are tracked per source (e.g. (host, port)): a datagram that
+    isn't newer than the last one accepted from its source is discarded, as is
+    one that can't be decoded.  A source that has been quiet for longer than 
+    source_timeout seconds is forgotten, so restarted producers are accepted again.
+    Datagrams are independent, so a target only applies within the datagram carrying it.
+    """
+
+    sources: typing.Dict[typing.Any, typing.Tuple[int, int]] # source -> (sequence, time.monotonic_ns)
+    discarded: int # datagrams dropped for arriving out of order (or late)
+
+    def __init__(self, source_timeout: float = 1.0) -> None:
+        super().__init__()
+        self.protocol = PROTOCOL_BINARY
+        self.sources = {}
+        self.discarded = 0
+        self._timeout = int(source_timeout * 1e9)
+        self._next_prune = 0
+
+    def accept(self, data: bytes, source: typing.Any, now: int) -> bool:
+        """ Check the header of a datagram received at now (time.monotonic_ns) """
+        if len(data) < DATAGRAM_HEADER.size:
+            raise ProtocolError('Truncated datagram header')
+        version, sequence = DATAGRAM_HEADER.unpack_from(data)
+        if version != DATAGRAM_VERSION:
+            raise ProtocolError(f'Unsupported datagram version: {version}')
+
+        if now >= self._next_prune:
+            self._prune(now)
+
+        last = self.sources.get(source)
+        if last is not None and now - last[1] < self._timeout:
+            # Serial number arithmetic, so the sequence can wrap around
+            if not 0 < (sequence - last[0]) & 0xFFFFFFFF < 0x80000000:
+                self.discarded += 1
+                return False
+        self.sources[source] = (sequence, now)
+        return True
+
+    def feed_datagram(self, data: bytes, source: typing.Any, now: int) -> typing.Iterator[bytes]:
+        """ Reports contained in a datagram (none if it was out of order); 
+        like StreamDecoder.feed, `sent` and `deadline` describe the report being yielded """
+        if not self.accept(data, source, now):
+            return
+        self.buffer[:] = memoryview(data)[DATAGRAM_HEADER.size:]
+        self._next_sent = 0
+        self._next_deadline = 0
+        self.target = None
+        try:
+            yield from self._decode_binary()
+            if self.buffer:
+                raise ProtocolError('Truncated frame in datagram')
+        finally:
+            self.buffer.clear()
+
+    def _prune(self, now: int) -> None:
+        for source in [s for s, (_, t) in self.sources.items() if now - t >= self._timeout]:
+            del self.sources[source]
+        self._next_prune = now + self._timeout
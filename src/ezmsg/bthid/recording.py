@@ -0,0 +1,135 @@
+import os
+import mmap
+import time
+import asyncio
+import struct
+import typing
+
+from pathlib import Path
+
+from .protocol import FRAME_HEADER, REPORT_HEADER
+
+# Recordings of the reports producers send the daemon, for reproducing field
+# issues and replaying realistic traffic (see BTHIDConfig.record_path).
+#
+# A recording is a RECORDING_HEADER followed by one record per report:
+#   [timestamp: u64 time.monotonic_ns() when the daemon received it][binary protocol frame]
+# so replaying a report is copying its frame straight out of the file.  The header
+# holds the wall clock and monotonic times when recording started, to line
+# timestamps up with logs.  A record cut short (the daemon died mid-write) ends the recording.
+
+RECORDING_MAGIC = b'BTHIDREC'
+RECORDING_VERSION = 0x01
+RECORDING_HEADER = struct.Struct('<8sBQQ') # RECORDING_MAGIC, RECORDING_VERSION, time.time_ns(), time.monotonic_ns()
+RECORD_HEADER = struct.Struct('<QBB') # timestamp, report id, payload length
+
+# Bytes of records buffered before they're written out
+RECORD_BUFFER_SIZE = 1 << 16
+
+# Maximum number of frames replayed in a single write
+MAX_REPLAY_BATCH = 256
+
+
+class RecordingWriter:
+    """ Appends reports to a new recording """
+
+    path: Path
+    count: int # reports recorded
+
+    def __init__(self, path: typing.Union[str, Path]) -> None:
+        self.path = Path(path)
+        self.count = 0
+        self._file = open(self.path, 'wb', buffering = RECORD_BUFFER_SIZE)
+        self._file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, time.time_ns(), time.monotonic_ns()))
+
+    def write(self, report: bytes, timestamp: int) -> None:
+        """ Record a report (as sent to hosts: 0xA1, report id, payload) received at timestamp (time.monotonic_ns) """
+        self._file.write(RECORD_HEADER.pack(timestamp, report[1], len(report) - REPORT_HEADER.size) + report[REPORT_HEADER.size:])
+        self.count += 1
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> 'RecordingWriter':
+        return self
+
+    def __exit__(self, *_: typing.Any) -> None:
+        self.close()
+
+
+class Recording:
+    """ A recording, memory mapped read-only so files of any size can be replayed
+    without loading them """
+
+    path: Path
+    started: int # time.time_ns() when recording started
+    started_monotonic: int # time.monotonic_ns() when recording started
+
+    def __init__(self, path: typing.Union[str, Path]) -> None:
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < RECORDING_HEADER.size:
+                raise ValueError(f'{path} is not an ezmsg-bthid recording')
+            self._mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version, self.started, self.started_monotonic = RECORDING_HEADER.unpack_from(self._mmap)
+        if magic != RECORDING_MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not an ezmsg-bthid recording')
+        if version != RECORDING_VERSION:
+            self.close()
+            raise ValueError(f'{path}: unsupported recording version {version}')
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[int, bytes]]:
+        """ (timestamp, binary protocol frame) for every report, read as needed """
+        data = self._mmap
+        size = len(data)
+        unpack_from = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        frame_offset = RECORD_HEADER.size - FRAME_HEADER.size
+        offset = RECORDING_HEADER.size
+        while offset + header_size <= size:
+            timestamp, _, length = unpack_from(data, offset)
+            end = offset + header_size + length
+            if end > size:
+                break
+            yield timestamp, data[offset + frame_offset:end]
+            offset = end
+
+    async def play(self, speed: float = 1.0) -> typing.AsyncIterator[bytes]:
+        """ Yield batches of frames as they come due: at the recorded timing, sped up by
+        speed (0 for as fast as possible).  Reports are scheduled against the start of
+        playback, so a late wakeup doesn't delay every report after it, and reports
+        that are due together (or overdue) are batched into one write. """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first: typing.Optional[int] = None
+        batch: typing.List[bytes] = []
+        for timestamp, frame in self:
+            if first is None:
+                first = timestamp
+            if speed > 0:
+                due = start + (timestamp - first) / 1e9 / speed
+                if batch and due > loop.time():
+                    yield b''.join(batch)
+                    batch = []
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            batch.append(frame)
+            if len(batch) >= MAX_REPLAY_BATCH:
+                yield b''.join(batch)
+                batch = []
+        if batch:
+            yield b''.join(batch)
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def __enter__(self) -> 'Recording':
+        return self
+
+    def __exit__(self, *_: typing.Any) -> None:
+        self.close()
@@ -0,0 +1,81 @@
+import time
+import heapq
+import asyncio
+import typing
+
+# Deadline scheduling of reports in the async daemon.
+#
+# Producers that stamp reports with a deadline (protocol.CONTROL_DEADLINE) and
+# send them a little ahead of time get them released to hosts at exactly that
+# moment, so network jitter between producer and daemon doesn't become input
+# jitter on the host.  Pending reports are kept in one heap ordered by (deadline,
+# arrival), with a single event loop timer armed for the earliest, so reports
+# with equal deadlines keep their order and fanning out to many hosts costs one
+# timer per report rather than one per host.
+
+T = typing.TypeVar('T')
+
+
+class Scheduler(typing.Generic[T]):
+    """ Releases items at their deadlines (time.monotonic_ns), in deadline order """
+
+    heap: typing.List[typing.Tuple[int, int, T]] # (deadline, arrival, item)
+    horizon: int # ns; deadlines further ahead than this are brought forward to it
+    late: int # items whose deadline had already passed when they were scheduled
+
+    def __init__(
+        self,
+        release: typing.Callable[[T], None],
+        horizon: float = 1.0,
+        loop: typing.Optional[asyncio.AbstractEventLoop] = None,
+    ) -> None:
+        self.heap = []
+        self.horizon = int(horizon * 1e9)
+        self.late = 0
+        self._release = release
+        self._loop = loop
+        self._arrivals = 0
+        self._timer: typing.Optional[asyncio.TimerHandle] = None
+        self._timer_deadline = 0
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def schedule(self, deadline: int, item: T) -> None:
+        """ Release item at deadline; right away if it's due and nothing is ahead of it """
+        now = time.monotonic_ns()
+        heap = self.heap
+        if deadline <= now:
+            self.late += deadline < now
+            if not heap:
+                self._release(item)
+                return
+        deadline = min(deadline, now + self.horizon)
+        self._arrivals += 1
+        heapq.heappush(heap, (deadline, self._arrivals, item))
+        if self._timer is None or deadline < self._timer_deadline:
+            self._arm(deadline, now)
+
+    def _arm(self, deadline: int, now: int) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        loop = self._loop or asyncio.get_running_loop()
+        # loop.time() isn't necessarily time.monotonic() (e.g. uvloop), so schedule relative to now
+        self._timer = loop.call_at(loop.time() + (deadline - now) / 1e9, self._fire)
+        self._timer_deadline = deadline
+
+    def _fire(self) -> None:
+        self._timer = None
+        heap = self.heap
+        now = time.monotonic_ns()
+        while heap and heap[0][0] <= now:
+            self._release(heapq.heappop(heap)[2])
+        if heap:
+            self._arm(heap[0][0], now)
+
+    def cancel(self) -> None:
+        """ Forget every pending item """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.heap.clear()
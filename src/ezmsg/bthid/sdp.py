@@ -0,0 +1,10 @@
+from importlib.resources import files
+
+from .device import report_description
+from .device.multitouch import DEFAULT_MAX_CONTACTS
+
+
+def service_record(max_contacts: int = DEFAULT_MAX_CONTACTS) -> str:
+    """ HID SDP record (sdp.xml) advertising every device (see device.report_description) """
+    record = files('ezmsg.bthid').joinpath('sdp.xml').read_text()
+    return record.replace('$REPORT_DESC', report_description(max_contacts).hex().upper())
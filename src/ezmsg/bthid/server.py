@@ -1,105 +1,202 @@
+import time
 import socket
+import functools
 import asyncio
 import typing
-import logging
 
 from pathlib import Path
-from importlib.resources import files
 
-from dbus_next.aio.message_bus import MessageBus
-from dbus_next.constants import BusType
-from dbus_next.signature import Variant
-from dbus_next.service import ServiceInterface, method
-
-from .device import REPORT_DESCRIPTION
-from .device.hid import decode_report
-
-from .config import BTHIDConfig
+from .device import DEVICE_CLASSES
+from .protocol import StreamDecoder, DatagramDecoder, ProtocolError, BINARY_HANDSHAKE, PROTOCOL_BINARY, encode_clock_reply
+from .shmring import accept_ring, RING_POLL_INTERVAL, RING_POLL_MAX
+
+from .config import BTHIDConfig, QUEUE_DROP_NEWEST, QUEUE_BLOCK
+from .stats import LatencyStats, AdapterStats, AdapterCounters
+from .fanout import Ring, Cursor
+from .schedule import Scheduler
+from .dedup import DuplicateFilter
+from .metrics import Metrics, ClientCounters, family, handle_scrape, COUNTER, GAUGE
+from .recording import RecordingWriter
+from .transport import Transport, L2CAPTransport, TRANSPORT_L2CAP, peer_info
+from .util import (
+    daemon_logger, 
+    set_socket_permissions, 
+    notify_state, 
+    STATE_STARTING, 
+    STATE_INGEST, 
+    STATE_BLUETOOTH, 
+    STATE_READY,
+)
 
-logger = logging.getLogger(__name__)
+logger = daemon_logger(__name__)
 
-handler = logging.StreamHandler()
-formatter = logging.Formatter(
-    "%(asctime)s.%(msecs)03d - pid: %(process)d - %(threadName)s "
-    + "- %(levelname)s - %(funcName)s: %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+# Maximum number of bytes read from an ingest client at a time
+READ_SIZE = 4096
 
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
+# Minimum number of seconds between log messages about dropped reports for a host
+DROP_LOG_INTERVAL = 5.0
 
+# Seconds between flushes of the recording to disk
+RECORD_FLUSH_INTERVAL = 1.0
 
-class BTHIDAgent(ServiceInterface):
-    """ This dbus Service Interface handles replying "yes" to incoming pairing requests """
+# Device names for latency statistics, keyed by report ID
+DEVICE_NAMES = {cls.Message.REPORT_ID: cls.__name__ for cls in DEVICE_CLASSES}
 
-    @method()
-    async def Release(self):
-        logger.info("Agent: Release -- Unregistered")
 
-    @method()
-    async def RequestPinCode(self, device: 'o') -> 's': # type: ignore
-        # Return a PIN code here; '0000' is a placeholder
-        pin = "0000"
-        logger.info(f"Agent: Pin Code Requested. Providing {pin}")
-        return pin
+class Packet(typing.NamedTuple):
+    """ A report on its way to the Bluetooth hosts; shared by every host's cursor """
+    report: bytes
+    sent: int # producer enqueue time (time.monotonic_ns), if the producer timestamped it; else 0
+    received: int # time.monotonic_ns() when the daemon received the report
 
-    @method()
-    async def DisplayPinCode(self, device: 'o', pincode: 's'): # type: ignore
-        logger.info(f"Agent: Pin Code for {device}: {pincode}")
 
-    @method()
-    async def RequestPasskey(self, device: 'o') -> 'u': # type: ignore
-        passkey = 123456
-        logger.info(f"Agent: Passkey Requested. Providing {passkey}")
-        return passkey
+class HIDClient:
+    """ Forwarding state for a Bluetooth host connected to the interrupt port """
 
-    @method()
-    async def DisplayPasskey(self, device: 'o', passkey: 'u', entered: 'q'): # type: ignore
-        logger.info(f"Agent: Passkey for {device}: {passkey}, entered: {entered}")
+    info: typing.Tuple[str, int]
+    adapter: str
+    counters: AdapterCounters
+    cursor: Cursor[Packet]
+    queue_size: int # maximum number of pending reports; 0 for no limit
+    ready: asyncio.Event # set when there may be reports to send
+    room: asyncio.Event # set when reports have been sent (for producers waiting on a full host)
+    duplicates: typing.Optional[DuplicateFilter]
+    dropped: int
+    sent: int # reports sent
+    sent_bytes: int
+    send_errors: int
+    
+    def __init__(
+        self, 
+        info: typing.Tuple[str, int], 
+        cursor: Cursor[Packet],
+        queue_size: int = 0, 
+        adapter: str = '', 
+        counters: typing.Optional[AdapterCounters] = None,
+        duplicates: typing.Optional[DuplicateFilter] = None,
+    ) -> None:
+        self.info = info
+        self.adapter = adapter
+        self.counters = counters if counters is not None else AdapterCounters()
+        self.cursor = cursor
+        self.queue_size = queue_size
+        self.ready = asyncio.Event()
+        self.room = asyncio.Event()
+        self.duplicates = duplicates
+        self.dropped = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.send_errors = 0
+        self._dropped_logged = 0
+        self._drop_log_time = 0.0
+
+    def full(self) -> bool:
+        return 0 < self.queue_size <= self.cursor.pending()
+
+    def drop(self) -> None:
+        """ Count a dropped report, periodically logging the running total """
+        self.dropped += 1
+        now = time.monotonic()
+        if now - self._drop_log_time >= DROP_LOG_INTERVAL:
+            logger.warning(
+                f'Bluetooth client {self.info}: queue full; dropped '
+                f'{self.dropped - self._dropped_logged} reports ({self.dropped} total)'
+            )
+            self._dropped_logged = self.dropped
+            self._drop_log_time = now
 
-    @method()
-    async def RequestConfirmation(self, device: 'o', passkey: 'u'): # type: ignore
-        logger.info(f"Agent: Auto-Confirm passkey for {device}: {passkey} -- YES")
-        # Automatically confirm without additional action
 
-    @method()
-    async def RequestAuthorization(self, device: 'o'): # type: ignore
-        # Automatically authorize without additional action
-        logger.info(f"Agent: Authorization requested; Authorizing")
+class DatagramIngest(asyncio.DatagramProtocol):
+    """ Receives datagram protocol reports from any number of producers """
 
-    @method()
-    async def AuthorizeService(self, device: 'o', uuid: 's'): # type: ignore
-        # Automatically authorize the service without additional action
-        logger.info(f"Agent: Service authorization requested; Authorizing")
+    def __init__(self, server: 'BTHIDServer', source_timeout: float, counters: ClientCounters) -> None:
+        self.server = server
+        self.decoder = DatagramDecoder(source_timeout)
+        self.counters = counters
 
-    @method()
-    async def Cancel(self):
-        logger.info(f"Agent: Cancelled")
+    def datagram_received(self, data: bytes, addr: typing.Tuple[str, int]) -> None:
+        received = time.monotonic_ns()
+        decoder = self.decoder
+        counters = self.counters
+        counters.bytes += len(data)
+        try:
+            for report in decoder.feed_datagram(data, addr, received):
+                counters.reports += 1
+                if decoder.deadline:
+                    self.server.scheduler.schedule(decoder.deadline, (Packet(report, decoder.sent, received), decoder.target))
+                else:
+                    self.server.forward_nowait(Packet(report, decoder.sent, received), decoder.target)
+        except ProtocolError as e:
+            logger.warning(f'Dropping datagram from {addr}: {e}')
 
 
 class BTHIDServer:
     """ This is the ezmsg-bthid daemon server.  It:
     * uses dbus to create a bluetooth profile advertising a HID SDP record
     * binds Bluetooth L2CAP HID ports 0x0011 (control) and 0x0013 (interrupt) (which requires root)
-    * exposes the interrupt ports on a tcp port that local (or even remote) clients can connect to
+    * exposes the interrupt ports on a tcp port that local (or even remote) clients can connect to,
+      and optionally a unix socket for clients on the same machine
     * handles incoming pairing requests with a bluez agent via dbus
-    * TODO: makes the bluetooth adapter discoverable?
+    * makes the configured bluetooth adapters discoverable
+    * reports readiness (`state`) to systemd as it starts up
+    * releases reports that producers send ahead of time at their deadlines (see schedule)
+    * optionally serves metrics in Prometheus text format (see render_metrics)
+    * optionally records the reports producers send for replay (see recording)
     """
 
     loop: asyncio.AbstractEventLoop
-    hid_clients: typing.Dict[asyncio.Task, asyncio.Queue[bytes]]
+    state: str # see util.STATE_*
+    hid_clients: typing.Dict[asyncio.Task, HIDClient]
+    ring: Ring[Packet] # broadcast reports, read by every host's cursor
+    routes: typing.Dict[str, HIDClient] # connected hosts by address, for targeted reports
+    unrouted: int # targeted reports dropped because their host wasn't connected
+    scheduler: Scheduler[typing.Tuple[Packet, typing.Optional[str]]] # reports with deadlines, and their targets
     tcp_server: asyncio.Task
+    unix_server: typing.Optional[asyncio.Task] = None
+    udp_transport: typing.Optional[asyncio.DatagramTransport] = None
+    shm_server: typing.Optional[asyncio.Task] = None
+    metrics_server: typing.Optional[asyncio.Task] = None
+    lag_task: typing.Optional[asyncio.Task] = None
+    tcp_addr: typing.Tuple[str, int]
     config: BTHIDConfig
+    queue_size: int
+    queue_policy: str
+    suppress_duplicates: bool
+    idle_interval: float
+    latency: typing.Optional[LatencyStats]
+    latency_task: asyncio.Task
+    adapter_stats: AdapterStats
+    stats_task: asyncio.Task
+    metrics: Metrics
+    recorder: typing.Optional[RecordingWriter] = None
+    record_task: typing.Optional[asyncio.Task] = None
 
     def __init__(self, config: BTHIDConfig, loop: asyncio.AbstractEventLoop) -> None:
         """ Don't use this constructor to create a server; instead use BTHIDServer.start """
         self.loop = loop
+        self.state = STATE_STARTING
         self.hid_clients = {}
+        self.ring = Ring()
+        self.routes = {}
+        self.unrouted = 0
+        self.scheduler = Scheduler(self.release, config.schedule_horizon, loop)
         self.config = config
+        self.queue_size = config.queue_size
+        self.queue_policy = config.queue_policy
+        self.suppress_duplicates = config.suppress_duplicates
+        self.idle_interval = config.idle_interval
+        self.latency = LatencyStats() if config.latency_interval > 0 else None
+        self.adapter_stats = AdapterStats()
+        self.metrics = Metrics()
 
     @classmethod
-    async def start(cls, config_path: typing.Optional[Path] = None, loop: typing.Optional[asyncio.AbstractEventLoop] = None) -> "BTHIDServer":
+    async def start(
+        cls, 
+        config_path: typing.Optional[Path] = None, 
+        loop: typing.Optional[asyncio.AbstractEventLoop] = None,
+        record_path: typing.Optional[Path] = None,
+    ) -> "BTHIDServer":
+        """ Start the ingest servers; record_path overrides [server] record_path """
 
         config = BTHIDConfig(config_path)
 
@@ -110,126 +207,416 @@ class BTHIDServer:
         host, port = config.server_addr
         server = await asyncio.start_server(hid_server.handle_tcp_client, host = host, port = port)
         hid_server.tcp_server = loop.create_task(server.serve_forever(), name = 'bthid_tcp_server')
-        logger.info(f'ezmsg-bthid daemon listening on {host}:{port}/tcp')
+        hid_server.tcp_addr = server.sockets[0].getsockname()[:2]
+        logger.info(f'ezmsg-bthid daemon listening on {host}:{hid_server.tcp_addr[1]}/tcp')
+
+        unix_path = config.unix_path
+        if unix_path is not None:
+            # Same protocol as tcp; asyncio takes care of stale sockets from previous runs
+            unix_server = await asyncio.start_unix_server(hid_server.handle_tcp_client, path = unix_path)
+            set_socket_permissions(unix_path, config.unix_mode, config.unix_group)
+            hid_server.unix_server = loop.create_task(unix_server.serve_forever(), name = 'bthid_unix_server')
+            logger.info(f'ezmsg-bthid daemon listening on {unix_path}')
+
+        shm_path = config.shm_path
+        if shm_path is not None:
+            if shm_path.is_socket():
+                shm_path.unlink() # Stale socket from a previous run
+            shm_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            shm_socket.bind(str(shm_path))
+            set_socket_permissions(shm_path, config.unix_mode, config.unix_group)
+            shm_socket.listen()
+            hid_server.shm_server = loop.create_task(
+                serve_seqpacket_socket(hid_server.handle_shm_client, shm_socket, loop = loop),
+                name = 'bthid_shm_server'
+            )
+            logger.info(f'ezmsg-bthid daemon accepting shared memory rings on {shm_path}')
+
+        if config.udp_port:
+            udp_counters = hid_server.metrics.connect(f'udp:{config.udp_port}')
+            hid_server.udp_transport, _ = await loop.create_datagram_endpoint(
+                lambda: DatagramIngest(hid_server, config.udp_source_timeout, udp_counters),
+                local_addr = (host, config.udp_port)
+            )
+            logger.info(f'ezmsg-bthid daemon listening on {host}:{config.udp_port}/udp')
+
+        if hid_server.latency is not None:
+            hid_server.latency_task = loop.create_task(
+                hid_server.log_latency(config.latency_interval), 
+                name = 'bthid_latency_stats'
+            )
+
+        if config.stats_interval > 0:
+            hid_server.stats_task = loop.create_task(
+                hid_server.log_adapter_stats(config.stats_interval), 
+                name = 'bthid_adapter_stats'
+            )
+
+        record_path = record_path or config.record_path
+        if record_path is not None:
+            hid_server.recorder = RecordingWriter(record_path)
+            hid_server.record_task = loop.create_task(hid_server.flush_recording(), name = 'bthid_recording')
+            logger.info(f'ezmsg-bthid daemon recording reports to {record_path}')
+
+        if config.metrics_port:
+            metrics_server = await asyncio.start_server(
+                functools.partial(handle_scrape, hid_server.render_metrics), 
+                host = host, 
+                port = config.metrics_port
+            )
+            hid_server.metrics_server = loop.create_task(metrics_server.serve_forever(), name = 'bthid_metrics_server')
+            hid_server.lag_task = loop.create_task(hid_server.metrics.monitor_lag(), name = 'bthid_loop_lag')
+            logger.info(f'ezmsg-bthid daemon serving metrics on {host}:{config.metrics_port}/tcp')
+
+        hid_server.set_state(STATE_INGEST)
         return hid_server
 
+    def set_state(self, state: str) -> None:
+        self.state = state
+        logger.info(f'ezmsg-bthid daemon state: {state}')
+        notify_state(state)
+
     async def handle_tcp_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
         """ This is where tcp client reports are received and queued for forwarding to bluetooth interrupt """
+        decoder = StreamDecoder(
+            on_binary = lambda: writer.write(BINARY_HANDSHAKE),
+            on_clock = lambda sent: writer.write(encode_clock_reply(sent, time.monotonic_ns())),
+        )
+        peer = writer.get_extra_info('peername')
+        counters = self.metrics.connect(f'{peer[0]}:{peer[1]}' if isinstance(peer, tuple) else 'unix')
+        recorder = self.recorder
         try:
             while True:
-                data = await reader.readline()
+                data = await reader.read(READ_SIZE)
                 if not data: break
-                report = decode_report(data)
-                for queue in self.hid_clients.values():
-                    queue.put_nowait(report)
+                received = time.monotonic_ns()
+                counters.bytes += len(data)
+                for report in decoder.feed(data):
+                    counters.reports += 1
+                    if recorder is not None:
+                        recorder.write(report, received)
+                    if decoder.deadline:
+                        self.scheduler.schedule(decoder.deadline, (Packet(report, decoder.sent, received), decoder.target))
+                    else:
+                        await self.forward(Packet(report, decoder.sent, received), decoder.target)
+        except ProtocolError as e:
+            logger.warning(f'Dropping tcp client: {e}')
         finally:
+            self.metrics.disconnect(counters)
             writer.close()
     
-    async def serve_forever(self) -> None:
-
-        # Use dbus to create the HID bluetooth profile / SDP record
-        bus = await MessageBus(
-            bus_type = BusType.SYSTEM,
-            negotiate_unix_fd = True,
-        ).connect()
-
-        data_files = files('ezmsg.bthid')
-        service_record = data_files.joinpath('sdp.xml').read_text()
-        service_record = service_record.replace('$REPORT_DESC', REPORT_DESCRIPTION.hex().upper())
-
-        introspection = await bus.introspect("org.bluez", "/org/bluez")
-        bluez = bus.get_proxy_object("org.bluez", "/org/bluez", introspection)
-        manager = bluez.get_interface("org.bluez.ProfileManager1")
-        await manager.call_register_profile( # type: ignore
-            self.config.bluetooth_profile, 
-            self.config.bluetooth_uuid, 
-            {
-                "Role": Variant('s', "server"),
-                "RequireAuthentication": Variant('b', False),
-                "RequireAuthorization": Variant('b', False),
-                "AutoConnect": Variant('b', True),
-                "ServiceRecord": Variant('s', service_record),
-            }
-        ) 
-
-        introspection = await bus.introspect("org.bluez", "/org/bluez/hci0")
-        hci0 = bus.get_proxy_object("org.bluez", "/org/bluez/hci0", introspection)
-        adapter_property = hci0.get_interface("org.freedesktop.DBus.Properties")
-        address = await adapter_property.call_get("org.bluez.Adapter1", "Address") # type: ignore
-
-        # Make sure adapter is discoverable and pairable forever
-        # await adapter_property.call_set("org.bluez.Adapter1", "Powered", Variant('b', True)) # type: ignore
-        await adapter_property.call_set("org.bluez.Adapter1", "DiscoverableTimeout", Variant('u', 0)) # type: ignore
-        await adapter_property.call_set("org.bluez.Adapter1", "PairableTimeout", Variant('u', 0)) # type: ignore
-        await adapter_property.call_set("org.bluez.Adapter1", "Pairable", Variant('b', True)) # type: ignore
-        await adapter_property.call_set("org.bluez.Adapter1", "Discoverable", Variant('b', True)) # type: ignore
-
-        # Register a dbus agent to handle automatic pairing
-        agent = BTHIDAgent('org.bluez.Agent1')
-        bus.export(self.config.bluetooth_agent, agent)
-
-        introspection = await bus.introspect("org.bluez", "/org/bluez")
-        bluez = bus.get_proxy_object("org.bluez", "/org/bluez", introspection)
-        agent_manager = bluez.get_interface("org.bluez.AgentManager1")
-        
-        # We must tell dbus that we can confirm to pair
-        await agent_manager.call_register_agent(self.config.bluetooth_agent, 'DisplayYesNo') # type: ignore
-        await agent_manager.call_request_default_agent(self.config.bluetooth_agent) # type: ignore
-
-        logger.info(f'Pairing Agent {self.config.bluetooth_agent}: Registered')
-
-        # Bind and handle bluetooth HID ports
-        async def handle_control_port(conn: socket.socket, _: typing.Tuple[str, int]) -> None:
-            """ Not sure what the control port is for; we just keep it alive for now """
-            try:
-                while True:
-                    data = await self.loop.sock_recv(conn, 1024)
-                    if not data: break
-            finally:
-                conn.close()
-
-        async def handle_interrupt_port(conn: socket.socket, info: typing.Tuple[str, int]) -> None:
-            """ Interrupt port is where we send reports """
-            queue: asyncio.Queue[bytes] = asyncio.Queue()
-            client_task = self.loop.create_task(self.handle_hid_client(conn, queue, info))
-            client_task.add_done_callback(self.hid_clients.pop)
-            self.hid_clients[client_task] = queue
-
-        control_task = self.loop.create_task(
-            serve_l2cap_socket(
-                handle_control_port, 
-                address.value, 
-                self.config.P_CTRL, 
-                loop = self.loop
-            )
-        )
-
-        interrupt_task = self.loop.create_task(
-            serve_l2cap_socket(
-                handle_interrupt_port, 
-                address.value, 
-                self.config.P_INTR, 
-                loop = self.loop
-            )
-        )
-
-        await bus.wait_for_disconnect()
+    async def handle_shm_client(self, conn: socket.socket, info: typing.Tuple[str, int]) -> None:
+        """ Consume binary protocol frames from a producer's shared memory ring (see shmring) """
+        try:
+            ring = await accept_ring(conn)
+        except (ValueError, OSError) as e:
+            logger.warning(f'Dropping shared memory client: {e}')
+            conn.close()
+            return
+
+        decoder = StreamDecoder()
+        decoder.protocol = PROTOCOL_BINARY
+        counters = self.metrics.connect('shm')
+        closed = False
+        poll = RING_POLL_INTERVAL
+        try:
+            while True:
+                data = ring.read()
+                if data:
+                    poll = RING_POLL_INTERVAL
+                    received = time.monotonic_ns()
+                    counters.bytes += len(data)
+                    for report in decoder.feed(data):
+                        counters.reports += 1
+                        if decoder.deadline:
+                            self.scheduler.schedule(decoder.deadline, (Packet(report, decoder.sent, received), decoder.target))
+                        else:
+                            await self.forward(Packet(report, decoder.sent, received), decoder.target)
+                    # A busy producer could otherwise keep us from ever sending to hosts
+                    await asyncio.sleep(0)
+                elif closed:
+                    break
+                elif ring.arm():
+                    # Out of data; sleep until the producer rings the doorbell (or leaves),
+                    # polling the ring again in case the doorbell was lost, less often the
+                    # longer it stays empty
+                    try:
+                        closed = not await asyncio.wait_for(self.loop.sock_recv(conn, READ_SIZE), poll)
+                        poll = RING_POLL_INTERVAL
+                    except asyncio.TimeoutError:
+                        poll = min(poll * 2, RING_POLL_MAX)
+        except ProtocolError as e:
+            logger.warning(f'Dropping shared memory client: {e}')
+        finally:
+            self.metrics.disconnect(counters)
+            ring.close()
+            conn.close()
+
+    def destinations(self, target: typing.Optional[str]) -> typing.Tuple[HIDClient, ...]:
+        """ Hosts a report is forwarded to: the target host (if connected), or every host """
+        if target is None:
+            return tuple(self.hid_clients.values())
+        client = self.routes.get(target)
+        if client is None:
+            self.unrouted += 1
+            return ()
+        return (client,)
+
+    async def forward(self, packet: Packet, target: typing.Optional[str] = None) -> None:
+        """ Queue a report for the target Bluetooth host (default: every connected host), 
+        applying the queue policy to full queues """
+        clients = self.destinations(target)
+        policy = self.queue_policy
+        if policy == QUEUE_BLOCK:
+            # Stop reading from this producer until every host has room
+            for client in clients:
+                while client.full():
+                    client.room.clear()
+                    await client.room.wait()
+        self.enqueue(packet, clients, target, policy == QUEUE_DROP_NEWEST)
+
+    def forward_nowait(self, packet: Packet, target: typing.Optional[str] = None) -> None:
+        """ Like forward, but without waiting; for producers that can't be backpressured 
+        (datagrams), a full queue drops its oldest report (or the incoming one, under the 
+        drop-newest policy) """
+        self.enqueue(packet, self.destinations(target), target, self.queue_policy == QUEUE_DROP_NEWEST)
+
+    def release(self, scheduled: typing.Tuple[Packet, typing.Optional[str]]) -> None:
+        """ Forward a report whose deadline has come; a full queue is handled as for datagrams, 
+        since blocking would make every report after it late """
+        self.forward_nowait(*scheduled)
+
+    def enqueue(self, packet: Packet, clients: typing.Tuple[HIDClient, ...], target: typing.Optional[str], drop_newest: bool) -> None:
+        """ Hand a report to clients' cursors, dropping a report for every client that's full """
+        ring = self.ring
+        for client in clients:
+            cursor = client.cursor
+            if client.full():
+                client.drop()
+                if drop_newest:
+                    if target is None:
+                        cursor.skip(ring.head) # The position packet is about to be appended at
+                    continue
+                cursor.pop()
+            if target is not None:
+                cursor.push(packet)
+            client.ready.set()
+        if target is None:
+            ring.append(packet)
+
+    def retire(self, client: HIDClient) -> None:
+        """ Fold a departing host's counts into the daemon-wide metrics """
+        metrics = self.metrics
+        metrics.sent_reports += client.sent
+        metrics.sent_bytes += client.sent_bytes
+        metrics.send_errors += client.send_errors
+        metrics.dropped += client.dropped
+        if client.duplicates is not None:
+            metrics.suppressed += client.duplicates.suppressed
+
+    def render_metrics(self) -> str:
+        """ Current metrics in Prometheus text format; totals include disconnected producers and hosts """
+        metrics = self.metrics
+        clients = list(metrics.clients.values())
+        hosts = list(self.hid_clients.values())
+        host_labels = [{'host': host.info[0], 'adapter': host.adapter} for host in hosts]
+        suppressed = metrics.suppressed + sum(host.duplicates.suppressed for host in hosts if host.duplicates is not None)
+        lag_max, metrics.lag_max = metrics.lag_max, metrics.lag
+
+        lines = [
+            *family('ezmsg_bthid_received_reports_total', COUNTER, 'Reports received from producers', 
+                [({}, metrics.received_reports + sum(c.reports for c in clients))]),
+            *family('ezmsg_bthid_received_bytes_total', COUNTER, 'Bytes received from producers', 
+                [({}, metrics.received_bytes + sum(c.bytes for c in clients))]),
+            *family('ezmsg_bthid_sent_reports_total', COUNTER, 'Reports sent to Bluetooth hosts', 
+                [({}, metrics.sent_reports + sum(h.sent for h in hosts))]),
+            *family('ezmsg_bthid_sent_bytes_total', COUNTER, 'Bytes sent to Bluetooth hosts', 
+                [({}, metrics.sent_bytes + sum(h.sent_bytes for h in hosts))]),
+            *family('ezmsg_bthid_send_errors_total', COUNTER, 'Failed sends to Bluetooth hosts', 
+                [({}, metrics.send_errors + sum(h.send_errors for h in hosts))]),
+            *family('ezmsg_bthid_dropped_reports_total', COUNTER, 'Reports dropped from full host queues', 
+                [({}, metrics.dropped + sum(h.dropped for h in hosts))]),
+            *family('ezmsg_bthid_unrouted_reports_total', COUNTER, 'Targeted reports dropped because their host was not connected', 
+                [({}, self.unrouted)]),
+            *family('ezmsg_bthid_suppressed_reports_total', COUNTER, 'Duplicate reports not sent', 
+                [({}, suppressed)]),
+            *family('ezmsg_bthid_scheduled_reports', GAUGE, 'Reports waiting for their deadline', 
+                [({}, len(self.scheduler))]),
+            *family('ezmsg_bthid_late_reports_total', COUNTER, 'Reports whose deadline had passed when they arrived', 
+                [({}, self.scheduler.late)]),
+            *family('ezmsg_bthid_clients', GAUGE, 'Connected producers (the UDP listener counts as one)', 
+                [({}, len(clients))]),
+            *family('ezmsg_bthid_client_connections_total', COUNTER, 'Producers ever connected', 
+                [({}, metrics.connections)]),
+            *family('ezmsg_bthid_hosts', GAUGE, 'Connected Bluetooth hosts', 
+                [({'adapter': adapter}, c.connected) for adapter, c in self.adapter_stats.adapters.items()]),
+            *family('ezmsg_bthid_host_connections_total', COUNTER, 'Bluetooth hosts ever connected', 
+                [({'adapter': adapter}, c.connections) for adapter, c in self.adapter_stats.adapters.items()]),
+            *family('ezmsg_bthid_client_received_reports_total', COUNTER, 'Reports received from a connected producer', 
+                [({'client': c.name}, c.reports) for c in clients]),
+            *family('ezmsg_bthid_client_received_bytes_total', COUNTER, 'Bytes received from a connected producer', 
+                [({'client': c.name}, c.bytes) for c in clients]),
+            *family('ezmsg_bthid_host_sent_reports_total', COUNTER, 'Reports sent to a connected Bluetooth host', 
+                [(labels, h.sent) for labels, h in zip(host_labels, hosts)]),
+            *family('ezmsg_bthid_host_sent_bytes_total', COUNTER, 'Bytes sent to a connected Bluetooth host', 
+                [(labels, h.sent_bytes) for labels, h in zip(host_labels, hosts)]),
+            *family('ezmsg_bthid_host_send_errors_total', COUNTER, 'Failed sends to a connected Bluetooth host', 
+                [(labels, h.send_errors) for labels, h in zip(host_labels, hosts)]),
+            *family('ezmsg_bthid_host_dropped_reports_total', COUNTER, 'Reports dropped from a connected host\'s full queue', 
+                [(labels, h.dropped) for labels, h in zip(host_labels, hosts)]),
+            *family('ezmsg_bthid_host_queue_depth', GAUGE, 'Reports waiting to be sent to a connected host', 
+                [(labels, h.cursor.pending()) for labels, h in zip(host_labels, hosts)]),
+            *family('ezmsg_bthid_loop_lag_seconds', GAUGE, 'How late the event loop ran a timer, last measurement', 
+                [({}, metrics.lag)]),
+            *family('ezmsg_bthid_loop_lag_max_seconds', GAUGE, 'How late the event loop ran a timer, worst since the last scrape', 
+                [({}, lag_max)]),
+        ]
+        return '\n'.join(lines) + '\n'
+
+    async def flush_recording(self, interval: float = RECORD_FLUSH_INTERVAL) -> None:
+        """ Periodically write buffered reports to the recording, so little is lost if the daemon dies """
+        assert self.recorder is not None
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self.recorder.flush()
+        finally:
+            self.recorder.close()
+            logger.info(f'Recorded {self.recorder.count} reports to {self.recorder.path}')
+
+    async def log_latency(self, interval: float) -> None:
+        """ Periodically log and reset latency histograms """
+        assert self.latency is not None
+        while True:
+            await asyncio.sleep(interval)
+            for line in self.latency.summary(DEVICE_NAMES):
+                logger.info(f'Latency {line}')
+            self.latency.reset()
+
+    async def log_adapter_stats(self, interval: float) -> None:
+        """ Periodically log and reset per-adapter connection and throughput stats """
+        while True:
+            await asyncio.sleep(interval)
+            for line in self.adapter_stats.summary(interval):
+                logger.info(f'Adapter {line}')
+            self.adapter_stats.reset()
 
-    async def handle_hid_client(self, 
-        interrupt: socket.socket, 
-        queue: asyncio.Queue[bytes],
-        info: typing.Tuple[str, int]
-    ) -> None:
+    async def serve_forever(self) -> None:
+        """ Serve Bluetooth hosts on the configured transport; for L2CAP, this first
+        registers the HID profile and pairing agent with BlueZ over dbus, then serves
+        hosts on every configured adapter.  The daemon is ready once the ports are listening """
+        if self.config.transport_type == TRANSPORT_L2CAP:
+            from .bluez import setup_bluez
+            bus, adapters = await setup_bluez(self.config)
+            self.set_state(STATE_BLUETOOTH)
+            port_tasks = [
+                task for adapter in adapters
+                for task in self.serve_transport(self.config.transport(adapter.address, adapter.name))
+            ]
+            self.set_state(STATE_READY)
+            await bus.wait_for_disconnect()
+            for task in port_tasks:
+                task.cancel()
+        else:
+            port_tasks = self.serve_transport(self.config.transport())
+            self.set_state(STATE_READY)
+            await asyncio.gather(*port_tasks)
+
+    def serve_transport(self, transport: Transport) -> typing.List[asyncio.Task]:
+        """ Bind and handle HID control and interrupt ports on transport """
+        logger.info(f'Serving Bluetooth HID ports on {transport}')
+        self.adapter_stats.get(transport.name)
+        return [
+            self.loop.create_task(
+                serve_seqpacket_socket(
+                    self.handle_control_port, 
+                    transport.listen(self.config.P_CTRL), 
+                    loop = self.loop
+                ),
+                name = f'bthid_control_port_{transport.name}'
+            ),
+            self.loop.create_task(
+                serve_seqpacket_socket(
+                    functools.partial(self.handle_interrupt_port, adapter = transport.name), 
+                    transport.listen(self.config.P_INTR), 
+                    loop = self.loop
+                ),
+                name = f'bthid_interrupt_port_{transport.name}'
+            ),
+        ]
+
+    async def handle_control_port(self, conn: socket.socket, _: typing.Tuple[str, int]) -> None:
+        """ Not sure what the control port is for; we just keep it alive for now """
+        try:
+            while True:
+                data = await self.loop.sock_recv(conn, 1024)
+                if not data: break
+        finally:
+            conn.close()
+
+    async def handle_interrupt_port(self, conn: socket.socket, info: typing.Tuple[str, int], adapter: str = '') -> None:
+        """ Interrupt port is where we send reports """
+        duplicates = DuplicateFilter(self.idle_interval) if self.suppress_duplicates else None
+        client = HIDClient(info, self.ring.cursor(), self.queue_size, adapter, self.adapter_stats.get(adapter), duplicates)
+        client_task = self.loop.create_task(self.handle_hid_client(conn, client))
+        client_task.add_done_callback(lambda task: self.hid_clients.pop(task, None))
+        self.hid_clients[client_task] = client
+        # A host that reconnects (e.g. on another adapter) takes over its route
+        self.routes[info[0]] = client
+
+    async def handle_hid_client(self, interrupt: socket.socket, client: HIDClient) -> None:
         """ This is where we handle connections with new devices that connect via bluetooth """
-        logger.info(f'Bluetooth client connected: {info=}')
+        info, cursor, ready, room, counters = client.info, client.cursor, client.ready, client.room, client.counters
+        duplicates = client.duplicates
+        logger.info(f'Bluetooth client connected: {info=} adapter={client.adapter}')
+        counters.connected += 1
+        counters.connections += 1
+        latency = self.latency
+        interrupt.setblocking(False)
         try:
             while True:
-                packet = await queue.get()
-                await self.loop.sock_sendall(interrupt, packet)
-        except ConnectionResetError:
-            pass
+                await ready.wait()
+                ready.clear()
+                # Send everything pending in one wakeup; only wait for the socket when it's full
+                while True:
+                    packet = cursor.pop()
+                    if packet is None: break
+                    if duplicates is not None and not duplicates.check(packet.report, time.monotonic_ns()):
+                        continue
+                    dequeued = time.monotonic_ns() if latency is not None else 0
+                    try:
+                        interrupt.send(packet.report)
+                    except BlockingIOError:
+                        room.set()
+                        await self.loop.sock_sendall(interrupt, packet.report)
+                    if latency is not None:
+                        latency.record(info[0], packet.report[1], packet.sent, packet.received, dequeued, time.monotonic_ns())
+                    counters.reports += 1
+                    counters.bytes += len(packet.report)
+                    client.sent += 1
+                    client.sent_bytes += len(packet.report)
+                room.set()
+        except OSError as e:
+            client.send_errors += 1
+            if not isinstance(e, ConnectionError):
+                logger.warning(f'Bluetooth client {info}: send failed: {e}')
         finally:
+            counters.connected -= 1
+            self.retire(client)
             interrupt.close()
+            self.ring.remove(cursor)
+            if latency is not None:
+                latency.remove_host(info[0])
+            self.hid_clients.pop(asyncio.current_task(), None) # type: ignore
+            if self.routes.get(info[0]) is client:
+                del self.routes[info[0]]
+            if client.dropped:
+                logger.info(f'Bluetooth client {info} disconnected; {client.dropped} reports dropped')
+            if duplicates is not None and duplicates.suppressed:
+                logger.info(f'Bluetooth client {info} disconnected; {duplicates.suppressed} duplicate reports suppressed')
+            # Release any producers blocked on this host
+            client.queue_size = 0
+            room.set()
     
 
 ConnectionCallbackType = typing.Callable[[socket.socket,typing.Tuple[str, int]], typing.Coroutine[None, None, None]]
@@ -240,25 +627,31 @@ async def serve_l2cap_socket(
     port: int, 
     loop: typing.Optional[asyncio.AbstractEventLoop] = None
 ) -> None:
-    """ Spiritual equivalent of asyncio.start_server for L2CAP HID sockets.
+    """ Spiritual equivalent of asyncio.start_server for L2CAP HID sockets. """
+    await serve_seqpacket_socket(callback, L2CAPTransport(address).listen(port), loop = loop)
+
+async def serve_seqpacket_socket(
+    callback: ConnectionCallbackType, 
+    sock: socket.socket, 
+    loop: typing.Optional[asyncio.AbstractEventLoop] = None
+) -> None:
+    """ Accept connections on a listening socket (e.g. from a Transport), calling callback for each.
     asyncio.start_server isn't currently compatible with socket.SOCK_SEQPACKET sockets 
     """
 
     if loop is None:
         loop = asyncio.get_running_loop()
 
-    sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP) # type: ignore
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind((address, port))
-    sock.listen(1)
     sock.setblocking(False)
 
     # If all references to a task are lost, the task may be cancelled at any time
     # so we hold onto all of the references until the task is done.
     all_connection_tasks = set()
-    while True:
-        conn, info = await loop.sock_accept(sock)
-        task = loop.create_task(callback(conn, info))
-        task.add_done_callback(all_connection_tasks.remove)
-        all_connection_tasks.add(task)
-
+    try:
+        while True:
+            conn, info = await loop.sock_accept(sock)
+            task = loop.create_task(callback(conn, peer_info(conn, info)))
+            task.add_done_callback(all_connection_tasks.remove)
+            all_connection_tasks.add(task)
+    finally:
+        sock.close()
@@ -1,224 +1,410 @@
+import time
 import socket
 import typing
-import logging
-import threading
+import asyncio
+import selectors
 
-from queue import Queue
+from collections import deque
+from functools import partial
 from pathlib import Path
-from importlib.resources import files
 
-from dbus_next.aio import MessageBus
-from dbus_next.constants import BusType
-from dbus_next.signature import Variant
-from dbus_next.service import ServiceInterface, method
-
-from .device import REPORT_DESCRIPTION
-from .device.hid import decode_report
-
-from .config import BTHIDConfig
-
-logger = logging.getLogger(__name__)
-
-handler = logging.StreamHandler()
-formatter = logging.Formatter(
-    "%(asctime)s.%(msecs)03d - pid: %(process)d - %(threadName)s "
-    + "- %(levelname)s - %(funcName)s: %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
+from .protocol import StreamDecoder, DatagramDecoder, ProtocolError, BINARY_HANDSHAKE, CLOCK_UNSCHEDULED, encode_clock_reply
+
+from .config import BTHIDConfig, QUEUE_BLOCK, QUEUE_DROP_NEWEST, QUEUE_DROP_OLDEST
+from .dedup import DuplicateFilter
+from .transport import Transport, TRANSPORT_L2CAP, peer_info
+from .util import (
+    daemon_logger, 
+    set_socket_permissions, 
+    notify_state, 
+    STATE_STARTING, 
+    STATE_INGEST, 
+    STATE_BLUETOOTH, 
+    STATE_READY,
 )
 
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
-
-class BTHIDAgent(ServiceInterface):
-    """ This dbus Service Interface handles replying "yes" to incoming pairing requests """
-
-    @method()
-    def Release(self):
-        logger.info("Agent: Release -- Unregistered")
+logger = daemon_logger(__name__)
 
-    @method()
-    def RequestPinCode(self, device: 'o') -> 's':
-        pin = "0000"
-        logger.info(f"Agent: Pin Code Requested. Providing {pin}")
-        return pin
+# Maximum number of bytes read from a socket at a time
+READ_SIZE = 4096
 
-    @method()
-    def DisplayPinCode(self, device: 'o', pincode: 's'):
-        logger.info(f"Agent: Pin Code for {device}: {pincode}")
+# Called with a ready socket and the selectors events it's ready for
+Handler = typing.Callable[[socket.socket, int], None]
 
-    @method()
-    def RequestPasskey(self, device: 'o') -> 'u':
-        passkey = 123456
-        logger.info(f"Agent: Passkey Requested. Providing {passkey}")
-        return passkey
 
-    @method()
-    def DisplayPasskey(self, device: 'o', passkey: 'u', entered: 'q'):
-        logger.info(f"Agent: Passkey for {device}: {passkey}, entered: {entered}")
+class HIDHost:
+    """ A Bluetooth host connected to the interrupt port, and the reports waiting to be sent to it """
 
-    @method()
-    def RequestConfirmation(self, device: 'o', passkey: 'u'):
-        logger.info(f"Agent: Auto-Confirm passkey for {device}: {passkey} -- YES")
+    conn: socket.socket
+    info: typing.Tuple[str, int]
+    pending: typing.Deque[bytes]
+    duplicates: typing.Optional[DuplicateFilter]
+    dropped: int
 
-    @method()
-    def RequestAuthorization(self, device: 'o'):
-        logger.info(f"Agent: Authorization requested; Authorizing")
-
-    @method()
-    def AuthorizeService(self, device: 'o', uuid: 's'):
-        logger.info(f"Agent: Service authorization requested; Authorizing")
-
-    @method()
-    def Cancel(self):
-        logger.info(f"Agent: Cancelled")
+    def __init__(self, conn: socket.socket, info: typing.Tuple[str, int], duplicates: typing.Optional[DuplicateFilter] = None) -> None:
+        self.conn = conn
+        self.info = info
+        self.pending = deque()
+        self.duplicates = duplicates
+        self.dropped = 0
 
 
 class BTHIDServer:
-    hid_clients_lock: threading.Lock
-    hid_clients: typing.Dict[socket.socket, Queue[bytes]]
+    """ Synchronous alternative to server.BTHIDServer.  Every socket is non-blocking
+    and serviced by a single thread in `run` with a selectors event loop, so the
+    fanout needs no locks and the number of threads doesn't depend on the number
+    of connected clients.  Other threads interact with the server through
+    `call_soon_threadsafe` (and `listen`/`stop`, which use it).
+    """
+
     config: BTHIDConfig
-    
+    state: str # see util.STATE_*
+    selector: selectors.BaseSelector
+    hid_clients: typing.Dict[socket.socket, HIDHost]
+    routes: typing.Dict[str, HIDHost] # connected hosts by address, for targeted reports
+    unrouted: int # targeted reports dropped because their host wasn't connected
+    paused: typing.Dict[socket.socket, Handler] # producers we've stopped reading from until hosts catch up
+    queue_size: int
+    queue_policy: str
+
     def __init__(self, config_path: typing.Optional[Path] = None):
-        self.hid_clients_lock = threading.Lock()
-        self.hid_clients = {}
         self.config = BTHIDConfig(config_path)
+        self.state = STATE_STARTING
+        self.selector = selectors.DefaultSelector()
+        self.hid_clients = {}
+        self.routes = {}
+        self.unrouted = 0
+        self.paused = {}
+        self.queue_size = self.config.queue_size
+        self.queue_policy = self.config.queue_policy
+        self._running = False
+        self._calls: typing.Deque[typing.Callable[[], None]] = deque()
+        self._wakeup, self._wakeup_send = socket.socketpair()
+        self._wakeup_send.setblocking(False)
+        self.register(self._wakeup, self._handle_wakeup)
 
     async def serve_forever(self) -> None:
-        # Use dbus to create the HID bluetooth profile / SDP record
-        bus = await MessageBus(
-            bus_type = BusType.SYSTEM,
-            negotiate_unix_fd = True,
-        ).connect()
-
-        data_files = files('ezmsg.bthid')
-        service_record = data_files.joinpath('sdp.xml').read_text()
-        service_record = service_record.replace('$REPORT_DESC', REPORT_DESCRIPTION.hex().upper())
-
-        introspection = await bus.introspect("org.bluez", "/org/bluez")
-        bluez = bus.get_proxy_object("org.bluez", "/org/bluez", introspection)
-        manager = bluez.get_interface("org.bluez.ProfileManager1")
-        await manager.call_register_profile( # type: ignore
-            self.config.bluetooth_profile, 
-            self.config.bluetooth_uuid, 
-            {
-                "Role": Variant('s', "server"),
-                "RequireAuthentication": Variant('b', False),
-                "RequireAuthorization": Variant('b', False),
-                "AutoConnect": Variant('b', True),
-                "ServiceRecord": Variant('s', service_record),
-            }
-        ) 
-
-        introspection = await bus.introspect("org.bluez", "/org/bluez/hci0")
-        hci0 = bus.get_proxy_object("org.bluez", "/org/bluez/hci0", introspection)
-        adapter_property = hci0.get_interface("org.freedesktop.DBus.Properties")
-        address = await adapter_property.call_get("org.bluez.Adapter1", "Address") # type: ignore
-
-        # Make sure adapter is discoverable and pairable forever
-        # await adapter_property.call_set("org.bluez.Adapter1", "Powered", Variant('b', True)) # type: ignore
-        await adapter_property.call_set("org.bluez.Adapter1", "DiscoverableTimeout", Variant('u', 0)) # type: ignore
-        await adapter_property.call_set("org.bluez.Adapter1", "PairableTimeout", Variant('u', 0)) # type: ignore
-        await adapter_property.call_set("org.bluez.Adapter1", "Pairable", Variant('b', True)) # type: ignore
-        await adapter_property.call_set("org.bluez.Adapter1", "Discoverable", Variant('b', True)) # type: ignore
-
-        # Register a dbus agent to handle automatic pairing
-        agent = BTHIDAgent('org.bluez.Agent1')
-        bus.export(self.config.bluetooth_agent, agent)
-
-        introspection = await bus.introspect("org.bluez", "/org/bluez")
-        bluez = bus.get_proxy_object("org.bluez", "/org/bluez", introspection)
-        agent_manager = bluez.get_interface("org.bluez.AgentManager1")
-        
-        # We must tell dbus that we can confirm to pair
-        await agent_manager.call_register_agent(self.config.bluetooth_agent, 'DisplayYesNo') # type: ignore
-        await agent_manager.call_request_default_agent(self.config.bluetooth_agent) # type: ignore
-
-        logger.info(f'Pairing Agent {self.config.bluetooth_agent}: Registered')
-        
-        # Bind Bluetooth HID ports
-        control_thread = threading.Thread(
-            target=self.serve_l2cap_socket, 
-            args=(self.handle_control_port, address.value, self.config.P_CTRL)
-        )
-        interrupt_thread = threading.Thread(
-            target=self.serve_l2cap_socket, 
-            args=(self.handle_interrupt_port, address.value, self.config.P_INTR)
-        )
+        bus = None
+        if self.config.transport_type == TRANSPORT_L2CAP:
+            # Use dbus to create the HID bluetooth profile / SDP record and pairing agent
+            from .bluez import setup_bluez
+            bus, adapters = await setup_bluez(self.config)
+            self.set_state(STATE_BLUETOOTH)
+            transports = [self.config.transport(adapter.address, adapter.name) for adapter in adapters]
+        else:
+            transports = [self.config.transport()]
 
-        control_thread.start()
-        interrupt_thread.start()
+        # Bind Bluetooth HID ports
+        for transport in transports:
+            self.serve_transport(transport)
 
         host, port = self.config.server_addr
-        tcp_server_socket = socket.create_server((host, port))
-        tcp_server_socket.listen()
+        self.serve_ingest(socket.create_server((host, port)))
+        self.set_state(STATE_INGEST)
 
-        tcp_server_thread = threading.Thread(
-            target = self.accept_tcp_clients,
-            args = (tcp_server_socket,)
-        )
-        tcp_server_thread.start()
-        logger.info(f'ezmsg-bthid daemon listening on {host}:{port}/tcp')
+        # Every socket is listening; the engine thread accepts connections as soon as it starts
+        self.set_state(STATE_READY)
 
-        await bus.wait_for_disconnect()
+        # dbus (if used) stays on this asyncio loop; everything else runs on the engine thread
+        engine = asyncio.get_running_loop().run_in_executor(None, self.run)
+        try:
+            if bus is not None:
+                await asyncio.wait(
+                    [engine, asyncio.ensure_future(bus.wait_for_disconnect())],
+                    return_when = asyncio.FIRST_COMPLETED
+                )
+            else:
+                await engine
+        finally:
+            self.stop()
 
-    def accept_tcp_clients(self, tcp_server_socket: socket.socket) -> None:
-        # Listen for TCP connections
-        tcp_clients = []
-        while True:
-            conn, addr = tcp_server_socket.accept()
-            tcp_client_thread = threading.Thread(target = self.handle_tcp_client, args = (conn, addr))
-            tcp_clients.append(tcp_client_thread)
-            tcp_client_thread.start()
+    def set_state(self, state: str) -> None:
+        self.state = state
+        logger.info(f'ezmsg-bthid daemon state: {state}')
+        notify_state(state)
 
-    def handle_tcp_client(self, conn: socket.socket, addr: typing.Tuple[str, int]) -> None:
-        """ Handle TCP client connections """
+    def run(self) -> None:
+        """ Service sockets until stop is called """
+        self._running = True
         try:
-            while True:
-                data = conn.recv(1024)
-                if not data:
-                    break
-                data = decode_report(data)
-                with self.hid_clients_lock:
-                    for queue in self.hid_clients.values():
-                        queue.put_nowait(data)
+            while self._running:
+                for key, events in self.selector.select():
+                    key.data(key.fileobj, events)
         finally:
-            conn.close()
+            for key in list(self.selector.get_map().values()):
+                self.selector.unregister(key.fileobj)
+                key.fileobj.close() # type: ignore
+            for conn in self.paused:
+                conn.close()
+            self.paused.clear()
+            self.selector.close()
+            self._wakeup_send.close()
+
+    def stop(self) -> None:
+        self.call_soon_threadsafe(self._stop)
+
+    def _stop(self) -> None:
+        self._running = False
+
+    def call_soon_threadsafe(self, callback: typing.Callable[..., None], *args: typing.Any) -> None:
+        """ Call callback(*args) from the thread running the server """
+        self._calls.append(partial(callback, *args))
+        try:
+            self._wakeup_send.send(b'\x00')
+        except (BlockingIOError, OSError):
+            pass # Already awake (or stopped)
+
+    def _handle_wakeup(self, sock: socket.socket, _: int) -> None:
+        try:
+            sock.recv(READ_SIZE)
+        except BlockingIOError:
+            pass
+        calls = self._calls
+        while calls:
+            calls.popleft()()
+
+    def register(self, sock: socket.socket, handler: Handler, events: int = selectors.EVENT_READ) -> None:
+        sock.setblocking(False)
+        self.selector.register(sock, events, handler)
+
+    def close(self, sock: socket.socket) -> None:
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        self.paused.pop(sock, None)
+        sock.close()
+
+    def listen(self, sock: socket.socket, callback: typing.Callable[[socket.socket, typing.Tuple[str, int]], None]) -> None:
+        """ Accept connections on a listening socket, calling callback for each """
+        def accept(sock: socket.socket, _: int) -> None:
+            try:
+                conn, info = sock.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # e.g. ECONNABORTED or EMFILE; the listener stays registered
+                logger.warning(f'Error accepting connection: {e}')
+                return
+            try:
+                callback(conn, peer_info(conn, info))
+            except OSError as e:
+                logger.warning(f'Dropping connection {info}: {e}')
+                self.close(conn)
+        self.call_soon_threadsafe(self.register, sock, accept)
+
+    def serve_ingest(self, tcp_server_socket: socket.socket) -> None:
+        """ Accept producers on tcp_server_socket and the configured unix and udp ingest sockets """
+        self.listen(tcp_server_socket, self.handle_tcp_client)
+        host, port = tcp_server_socket.getsockname()[:2]
+        logger.info(f'ezmsg-bthid daemon listening on {host}:{port}/tcp')
 
-    def serve_l2cap_socket(self, callback, address, port):
-        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((address, port))
-        sock.listen(1)
+        unix_server_socket = self.bind_unix_socket()
+        if unix_server_socket is not None:
+            self.listen(unix_server_socket, self.handle_tcp_client)
+            logger.info(f'ezmsg-bthid daemon listening on {self.config.unix_path}')
+
+        udp_socket = self.bind_udp_socket()
+        if udp_socket is not None:
+            decoder = DatagramDecoder(self.config.udp_source_timeout)
+            self.call_soon_threadsafe(self.register, udp_socket, partial(self.handle_datagrams, decoder))
+            logger.info(f'ezmsg-bthid daemon listening on {host}:{self.config.udp_port}/udp')
+
+    def bind_unix_socket(self) -> typing.Optional[socket.socket]:
+        """ Listen on the configured unix ingest socket, if any; clients speak the same protocol as tcp """
+        unix_path = self.config.unix_path
+        if unix_path is None:
+            return None
+        if unix_path.is_socket():
+            unix_path.unlink() # Stale socket from a previous run
+        unix_server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix_server_socket.bind(str(unix_path))
+        set_socket_permissions(unix_path, self.config.unix_mode, self.config.unix_group)
+        unix_server_socket.listen()
+        return unix_server_socket
+
+    def bind_udp_socket(self) -> typing.Optional[socket.socket]:
+        """ Bind the configured datagram ingest port, if any """
+        if not self.config.udp_port:
+            return None
+        host, _ = self.config.server_addr
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind((host, self.config.udp_port))
+        return udp_socket
 
-        threads: typing.List[threading.Thread] = []
+    def handle_tcp_client(self, conn: socket.socket, addr: typing.Tuple[str, int]) -> None:
+        """ Handle TCP client connections """
+        decoder = StreamDecoder(
+            on_binary = lambda: conn.send(BINARY_HANDSHAKE),
+            # Reports are sent as soon as they arrive; tell producers not to schedule them
+            on_clock = lambda sent: conn.send(encode_clock_reply(sent, CLOCK_UNSCHEDULED)),
+        )
+        self.register(conn, partial(self.read_producer, decoder, addr))
 
+    def read_producer(self, decoder: StreamDecoder, addr: typing.Tuple[str, int], conn: socket.socket, _: int) -> None:
+        try:
+            data = conn.recv(READ_SIZE)
+            if not data:
+                self.close(conn)
+                return
+            full = False
+            for report in decoder.feed(data):
+                full = self.forward(report, self.queue_policy, decoder.target) or full
+        except BlockingIOError:
+            return
+        except (ProtocolError, OSError) as e:
+            # OSError includes sending the binary handshake to a producer that already left
+            logger.warning(f'Dropping tcp client {addr}: {e}')
+            self.close(conn)
+            return
+
+        if full:
+            # Stop reading from this producer until every host has room (tcp backpressure)
+            self.paused[conn] = self.selector.unregister(conn).data
+
+    def handle_datagrams(self, decoder: DatagramDecoder, udp_socket: socket.socket, _: int) -> None:
+        """ Handle datagram protocol reports from any number of producers """
+        # Datagrams can't be backpressured
+        policy = QUEUE_DROP_OLDEST if self.queue_policy == QUEUE_BLOCK else self.queue_policy
         while True:
-            conn, info = sock.accept()
-            handler = threading.Thread(target = callback, args = (conn, info))
-            threads.append(handler)
-            handler.start()
+            try:
+                data, addr = udp_socket.recvfrom(65535)
+            except BlockingIOError:
+                return
+            try:
+                for report in decoder.feed_datagram(data, addr, time.monotonic_ns()):
+                    self.forward(report, policy, decoder.target)
+            except ProtocolError as e:
+                logger.warning(f'Dropping datagram from {addr}: {e}')
+
+    def destinations(self, target: typing.Optional[str]) -> typing.Tuple[HIDHost, ...]:
+        """ Hosts a report is forwarded to: the target host (if connected), or every host """
+        if target is None:
+            return tuple(self.hid_clients.values())
+        host = self.routes.get(target)
+        if host is None:
+            self.unrouted += 1
+            return ()
+        return (host,)
+
+    def forward(self, report: bytes, policy: str, target: typing.Optional[str] = None) -> bool:
+        """ Send (or queue) a report for the target Bluetooth host (default: every connected 
+        host), applying policy to full queues; returns True if a host's queue is full under QUEUE_BLOCK """
+        full = False
+        queue_size = self.queue_size
+        for host in self.destinations(target):
+            pending = host.pending
+            if not pending:
+                # Nothing queued; try to skip the queue entirely
+                duplicates = host.duplicates
+                if duplicates is not None:
+                    now = time.monotonic_ns()
+                    if duplicates.redundant(report, now):
+                        continue
+                try:
+                    host.conn.send(report)
+                    if duplicates is not None:
+                        duplicates.sent(report, now)
+                    continue
+                except BlockingIOError:
+                    self.selector.modify(host.conn, selectors.EVENT_READ | selectors.EVENT_WRITE, partial(self.handle_host, host))
+                except OSError:
+                    self.close_host(host)
+                    continue
+            elif queue_size and len(pending) >= queue_size:
+                if policy == QUEUE_BLOCK:
+                    full = True
+                else:
+                    host.dropped += 1
+                    if policy == QUEUE_DROP_NEWEST:
+                        continue
+                    pending.popleft()
+            pending.append(report)
+        return full
+
+    def serve_transport(self, transport: Transport) -> None:
+        """ Bind HID control and interrupt ports on transport """
+        logger.info(f'Serving Bluetooth HID ports on {transport}')
+        self.listen(transport.listen(self.config.P_CTRL), self.handle_control_port)
+        self.listen(transport.listen(self.config.P_INTR), self.handle_interrupt_port)
 
     def handle_control_port(self, conn: socket.socket, info: typing.Tuple[str, int]) -> None:
-        try:
-            while True:
-                data = conn.recv(1024)
-                if not data:
-                    break
-        finally:
-            conn.close()
+        """ Not sure what the control port is for; we just keep it alive for now """
+        def discard(conn: socket.socket, _: int) -> None:
+            try:
+                if conn.recv(READ_SIZE): return
+            except BlockingIOError:
+                return
+            except OSError:
+                pass
+            self.close(conn)
+        self.register(conn, discard)
 
     def handle_interrupt_port(self, conn: socket.socket, info: typing.Tuple[str, int]) -> None:
-        incoming: Queue[bytes] = Queue()
-        with self.hid_clients_lock:
-            self.hid_clients[conn] = incoming
-        try:
-            while True:
-                packet = incoming.get()
-                conn.sendall(packet)
-        except ConnectionResetError:
-            pass
-        finally:
-            with self.hid_clients_lock:
-                del self.hid_clients[conn]
-            conn.close()
\ No newline at end of file
+        """ Interrupt port is where we send reports """
+        logger.info(f'Bluetooth client connected: {info=}')
+        duplicates = DuplicateFilter(self.config.idle_interval) if self.config.suppress_duplicates else None
+        host = HIDHost(conn, info, duplicates)
+        self.hid_clients[conn] = host
+        # A host that reconnects (e.g. on another adapter) takes over its route
+        self.routes[info[0]] = host
+        # Hosts don't send us anything we use, but reading tells us when they disconnect
+        self.register(conn, partial(self.handle_host, host))
+
+    def handle_host(self, host: HIDHost, conn: socket.socket, events: int) -> None:
+        if events & selectors.EVENT_READ:
+            try:
+                if not conn.recv(READ_SIZE):
+                    self.close_host(host)
+                    return
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.close_host(host)
+                return
+
+        if events & selectors.EVENT_WRITE:
+            pending = host.pending
+            duplicates = host.duplicates
+            try:
+                while pending:
+                    report = pending[0]
+                    if duplicates is not None:
+                        now = time.monotonic_ns()
+                        if duplicates.redundant(report, now):
+                            pending.popleft()
+                            continue
+                        conn.send(report)
+                        duplicates.sent(report, now)
+                    else:
+                        conn.send(report)
+                    pending.popleft()
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.close_host(host)
+                return
+            if not pending:
+                self.selector.modify(conn, selectors.EVENT_READ, partial(self.handle_host, host))
+            self.resume_producers()
+
+    def close_host(self, host: HIDHost) -> None:
+        self.hid_clients.pop(host.conn, None)
+        if self.routes.get(host.info[0]) is host:
+            del self.routes[host.info[0]]
+        if host.dropped:
+            logger.info(f'Bluetooth client {host.info} disconnected; {host.dropped} reports dropped')
+        if host.duplicates is not None and host.duplicates.suppressed:
+            logger.info(f'Bluetooth client {host.info} disconnected; {host.duplicates.suppressed} duplicate reports suppressed')
+        self.close(host.conn)
+        self.resume_producers()
+
+    def resume_producers(self) -> None:
+        """ Start reading from paused producers again once every host has room """
+        if not self.paused or not self.queue_size:
+            return
+        if any(len(host.pending) >= self.queue_size for host in self.hid_clients.values()):
+            return
+        paused, self.paused = self.paused, {}
+        for conn, handler in paused.items():
+            self.register(conn, handler)
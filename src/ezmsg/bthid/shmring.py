@@ -0,0 +1,233 @@
+import os
+import mmap
+import socket
+import struct
+import typing
+import asyncio
+
+from .protocol import ProtocolError
+
+# Shared-memory ingest for producers on the same machine as the daemon.
+#
+# A producer creates a SharedRing (an anonymous memfd) and passes its file descriptor
+# to the daemon over the daemon's shm_path unix socket along with SHM_HANDSHAKE.
+# From then on, the producer appends binary protocol frames to the ring and the daemon
+# consumes them; that unix socket is only used as a doorbell to wake the daemon when
+# it has run out of data and gone to sleep (it "arms" the ring), so bursts of reports
+# cost no syscalls at all.  Closing the socket detaches the ring.
+#
+# Each ring has exactly one producer and one consumer, so no locks are needed:
+# only the producer advances head and only the consumer advances tail.  Counters
+# are 8-byte aligned and on separate cache lines; data is copied before the counter
+# that publishes it is updated.
+#
+# The doorbell handshake (consumer: set armed, then check head; producer: publish
+# head, then check armed) needs a full memory barrier between each side's store and
+# load, which Python can't issue.  Without one, the store can be reordered after the
+# load (even on x86, and more readily on weakly ordered CPUs like ARM), and both
+# sides can miss each other's update, losing the wakeup.  So this is only an
+# optimization: consumers must not sleep on the doorbell indefinitely, but poll
+# the ring again now and then (see RING_POLL_INTERVAL).
+#
+# The daemon maps memory its producers control, so it only accepts rings sealed
+# against resizing (a shrunk memfd would fault on access), and treats counters
+# that don't describe a valid ring as a protocol error.
+SHM_HANDSHAKE = b'\x00BTHID\x02'
+
+COUNTER = struct.Struct('<Q')
+HEAD_OFFSET = 0 # total bytes ever written by the producer
+TAIL_OFFSET = 64 # total bytes ever read by the consumer
+ARMED_OFFSET = 128 # nonzero while the consumer is waiting for the doorbell
+HEADER_SIZE = 192
+
+DEFAULT_RING_CAPACITY = 1 << 16 # bytes
+
+# Producers wait this long (sec) for the daemon to make room in a full ring
+RING_FULL_RETRY = 0.001
+
+# Consumers re-poll an armed ring (sec) in case a doorbell was lost: first after
+# RING_POLL_INTERVAL, doubling up to RING_POLL_MAX while the ring stays empty, so an
+# idle ring costs about one wakeup per second.  A lost doorbell therefore delays a
+# report by up to RING_POLL_MAX (though usually far less: lost doorbells need the
+# producer to write right as the consumer arms, when the interval has just been reset)
+RING_POLL_INTERVAL = 0.01
+RING_POLL_MAX = 1.0
+
+
+def ring_seals() -> int:
+    """ Seals a ring must carry before the daemon maps it (Linux only, like memfds) """
+    import fcntl
+    return fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW | fcntl.F_SEAL_SEAL # type: ignore
+
+
+class SharedRing:
+    """ Single-producer/single-consumer byte ring in shared memory """
+
+    fd: int
+    capacity: int
+
+    def __init__(self, fd: int) -> None:
+        """ Map an existing ring; takes ownership of fd """
+        self.fd = fd
+        size = os.fstat(fd).st_size
+        self.capacity = size - HEADER_SIZE
+        if self.capacity <= 0:
+            raise ValueError(f'Shared memory ring too small: {size} bytes')
+        self._mmap = mmap.mmap(fd, size)
+        self._view = memoryview(self._mmap)
+        self._data = self._view[HEADER_SIZE:]
+
+    @classmethod
+    def create(cls, capacity: int = DEFAULT_RING_CAPACITY) -> 'SharedRing':
+        fd = os.memfd_create('ezmsg-bthid-ring', os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING) # type: ignore
+        try:
+            os.ftruncate(fd, HEADER_SIZE + capacity)
+            import fcntl
+            fcntl.fcntl(fd, fcntl.F_ADD_SEALS, ring_seals()) # type: ignore
+        except BaseException:
+            os.close(fd)
+            raise
+        return cls(fd)
+
+    def _get(self, offset: int) -> int:
+        return COUNTER.unpack_from(self._view, offset)[0]
+
+    def _set(self, offset: int, value: int) -> None:
+        COUNTER.pack_into(self._view, offset, value)
+
+    def pending(self) -> int:
+        """ Bytes written but not yet read """
+        return self._get(HEAD_OFFSET) - self._get(TAIL_OFFSET)
+
+    def write(self, data: bytes) -> bool:
+        """ Producer: append data if there's room for all of it """
+        head = self._get(HEAD_OFFSET)
+        if self.capacity - (head - self._get(TAIL_OFFSET)) < len(data):
+            return False
+        start = head % self.capacity
+        first = min(len(data), self.capacity - start)
+        self._data[start:start + first] = data[:first]
+        if first < len(data):
+            self._data[:len(data) - first] = data[first:]
+        self._set(HEAD_OFFSET, head + len(data))
+        return True
+
+    def read(self) -> bytes:
+        """ Consumer: everything written since the last read """
+        head, tail = self._get(HEAD_OFFSET), self._get(TAIL_OFFSET)
+        if head == tail:
+            return b''
+        if not 0 < head - tail <= self.capacity:
+            raise ProtocolError(f'Shared memory ring corrupt: head {head}, tail {tail}, capacity {self.capacity}')
+        start, end = tail % self.capacity, head % self.capacity
+        if start < end:
+            data = bytes(self._data[start:end])
+        else:
+            data = bytes(self._data[start:]) + bytes(self._data[:end])
+        self._set(TAIL_OFFSET, head)
+        return data
+
+    def arm(self) -> bool:
+        """ Consumer: ask for the doorbell on the next write; returns False (and
+        stays disarmed) if data arrived in the meantime.  A wakeup can still be
+        missed without a memory barrier (see above), so don't wait for the
+        doorbell longer than RING_POLL_MAX """
+        self._set(ARMED_OFFSET, 1)
+        if self.pending():
+            self._set(ARMED_OFFSET, 0)
+            return False
+        return True
+
+    def disarm(self) -> bool:
+        """ Producer: returns True if the consumer is waiting for the doorbell """
+        if self._get(ARMED_OFFSET):
+            self._set(ARMED_OFFSET, 0)
+            return True
+        return False
+
+    def close(self) -> None:
+        self._data.release()
+        self._view.release()
+        self._mmap.close()
+        os.close(self.fd)
+
+
+class RingWriter:
+    """ Producer end of a shared memory ring with an asyncio.StreamWriter-like interface """
+
+    ring: SharedRing
+    doorbell: socket.socket
+
+    def __init__(self, ring: SharedRing, doorbell: socket.socket) -> None:
+        self.ring = ring
+        self.doorbell = doorbell
+        self._pending: typing.List[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        self._pending.append(data)
+
+    def writelines(self, data: typing.Iterable[bytes]) -> None:
+        self._pending.extend(data)
+
+    async def drain(self) -> None:
+        data = b''.join(self._pending)
+        self._pending.clear()
+        ring = self.ring
+        offset, capacity = 0, ring.capacity
+        while offset < len(data):
+            # Frames are atomic units for the daemon's decoder, but it copes with partial
+            # frames, so data larger than the ring is simply written in pieces
+            chunk = data[offset:offset + capacity]
+            while not ring.write(chunk):
+                await asyncio.sleep(RING_FULL_RETRY)
+            offset += len(chunk)
+            if ring.disarm():
+                try:
+                    self.doorbell.send(b'\x01')
+                except OSError as e:
+                    raise ConnectionResetError('ezmsg-bthid daemon detached shared memory ring') from e
+
+    def close(self) -> None:
+        self.doorbell.close()
+        self.ring.close()
+
+
+async def open_ring_connection(path: str, capacity: int = DEFAULT_RING_CAPACITY) -> RingWriter:
+    """ Create a ring and attach it to the daemon listening on path """
+    loop = asyncio.get_running_loop()
+    doorbell = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    doorbell.setblocking(False)
+    try:
+        await loop.sock_connect(doorbell, path)
+        ring = SharedRing.create(capacity)
+        socket.send_fds(doorbell, [SHM_HANDSHAKE], [ring.fd]) # type: ignore
+    except BaseException:
+        doorbell.close()
+        raise
+    return RingWriter(ring, doorbell)
+
+
+async def accept_ring(conn: socket.socket) -> SharedRing:
+    """ Daemon: receive the ring a producer sends after connecting to the shm_path socket """
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(conn.fileno(), readable.set_result, None)
+    try:
+        await readable
+    finally:
+        loop.remove_reader(conn.fileno())
+    msg, fds, _, _ = socket.recv_fds(conn, len(SHM_HANDSHAKE), 1) # type: ignore
+    if msg != SHM_HANDSHAKE or len(fds) != 1:
+        for fd in fds:
+            os.close(fd)
+        raise ValueError(f'Invalid shared memory handshake: {msg!r}')
+    fd = fds[0]
+    try:
+        import fcntl
+        required = ring_seals()
+        if fcntl.fcntl(fd, fcntl.F_GET_SEALS) & required != required: # type: ignore
+            raise ValueError('Shared memory ring is not sealed against resizing')
+        return SharedRing(fd)
+    except BaseException:
+        os.close(fd)
+        raise
@@ -0,0 +1,175 @@
+import typing
+
+# Latencies are tracked in nanoseconds in log-linear buckets: SUB_BUCKETS buckets
+# per power of two between MIN_NS and MAX_NS, so relative error is bounded
+# (~1/SUB_BUCKETS) and memory is fixed no matter how many samples are recorded.
+SUB_BUCKETS = 4
+MIN_EXPONENT = 10 # 2**10 ns ~= 1 us; everything faster shares the first bucket
+MAX_EXPONENT = 36 # 2**36 ns ~= 69 s; everything slower shares the last bucket
+N_BUCKETS = (MAX_EXPONENT - MIN_EXPONENT) * SUB_BUCKETS + 1
+
+_SUB_BITS = SUB_BUCKETS.bit_length() - 1
+
+
+def _bucket(value: int) -> int:
+    exponent = value.bit_length() - 1
+    if exponent < MIN_EXPONENT:
+        return 0
+    if exponent >= MAX_EXPONENT:
+        return N_BUCKETS - 1
+    sub = (value >> (exponent - _SUB_BITS)) & (SUB_BUCKETS - 1)
+    return (exponent - MIN_EXPONENT) * SUB_BUCKETS + sub + 1
+
+
+def _bucket_limit(bucket: int) -> int:
+    """ Upper bound (ns) of values counted in bucket """
+    if bucket == 0:
+        return 1 << MIN_EXPONENT
+    exponent, sub = divmod(bucket - 1, SUB_BUCKETS)
+    exponent += MIN_EXPONENT
+    return (1 << exponent) + ((sub + 1) << (exponent - _SUB_BITS))
+
+
+class LatencyHistogram:
+    """ Fixed-memory histogram of latencies (in nanoseconds) with percentile estimates """
+
+    counts: typing.List[int]
+    count: int
+    max: int
+
+    def __init__(self) -> None:
+        self.counts = [0] * N_BUCKETS
+        self.count = 0
+        self.max = 0
+
+    def record(self, latency: int) -> None:
+        if latency < 0: latency = 0
+        self.counts[_bucket(latency)] += 1
+        self.count += 1
+        if latency > self.max:
+            self.max = latency
+
+    def percentile(self, q: float) -> int:
+        """ Upper bound estimate (ns) of the q-th (0 - 100) percentile """
+        if not self.count:
+            return 0
+        target = self.count * q / 100.0
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(_bucket_limit(bucket), self.max)
+        return self.max
+
+    def reset(self) -> None:
+        for i in range(N_BUCKETS):
+            self.counts[i] = 0
+        self.count = 0
+        self.max = 0
+
+    def summary(self) -> str:
+        return (
+            f'n={self.count} p50={self.percentile(50) / 1e6:.3f}ms '
+            f'p99={self.percentile(99) / 1e6:.3f}ms max={self.max / 1e6:.3f}ms'
+        )
+
+
+# Stages of a report's trip through the daemon
+STAGE_INGEST = 'ingest' # producer enqueue (HIDOutput) -> received by daemon
+STAGE_QUEUE = 'queue' # received by daemon -> dequeued for a Bluetooth host
+STAGE_SEND = 'send' # dequeued -> L2CAP send completed
+STAGE_TOTAL = 'total' # producer enqueue (or daemon receipt) -> L2CAP send completed
+STAGES = (STAGE_INGEST, STAGE_QUEUE, STAGE_SEND, STAGE_TOTAL)
+
+
+class LatencyStats:
+    """ Per-stage latency histograms keyed by (bluetooth host, report id).
+    Memory is bounded by the number of connected hosts and device types. """
+
+    histograms: typing.Dict[typing.Tuple[str, int], typing.Dict[str, LatencyHistogram]]
+
+    def __init__(self) -> None:
+        self.histograms = {}
+
+    def record(self, host: str, report_id: int, sent: int, received: int, dequeued: int, completed: int) -> None:
+        """ Record the timeline of one report; sent is 0 if the producer didn't timestamp it """
+        key = (host, report_id)
+        histograms = self.histograms.get(key)
+        if histograms is None:
+            histograms = {stage: LatencyHistogram() for stage in STAGES}
+            self.histograms[key] = histograms
+
+        if sent:
+            histograms[STAGE_INGEST].record(received - sent)
+        histograms[STAGE_QUEUE].record(dequeued - received)
+        histograms[STAGE_SEND].record(completed - dequeued)
+        histograms[STAGE_TOTAL].record(completed - (sent or received))
+
+    def remove_host(self, host: str) -> None:
+        for key in [key for key in self.histograms if key[0] == host]:
+            del self.histograms[key]
+
+    def summary(self, device_names: typing.Optional[typing.Dict[int, str]] = None) -> typing.List[str]:
+        """ One line per (host, device) with recorded samples """
+        device_names = device_names or {}
+        lines = []
+        for (host, report_id), histograms in self.histograms.items():
+            if not histograms[STAGE_TOTAL].count:
+                continue
+            device = device_names.get(report_id, f'{report_id:#04x}')
+            stages = ' | '.join(
+                f'{stage}: {hist.summary()}'
+                for stage, hist in histograms.items() if hist.count
+            )
+            lines.append(f'{host} {device}: {stages}')
+        return lines
+
+    def reset(self) -> None:
+        for histograms in self.histograms.values():
+            for hist in histograms.values():
+                hist.reset()
+
+
+class AdapterCounters:
+    """ Connection and throughput counters for one adapter (transport); 
+    held by each connected host so counting a report is just an increment """
+
+    connected: int # hosts currently connected
+    connections: int # hosts ever connected
+    reports: int # reports sent since the last reset
+    bytes: int # bytes sent since the last reset
+
+    def __init__(self) -> None:
+        self.connected = 0
+        self.connections = 0
+        self.reports = 0
+        self.bytes = 0
+
+
+class AdapterStats:
+    """ AdapterCounters keyed by adapter name """
+
+    adapters: typing.Dict[str, AdapterCounters]
+
+    def __init__(self) -> None:
+        self.adapters = {}
+
+    def get(self, adapter: str) -> AdapterCounters:
+        counters = self.adapters.get(adapter)
+        if counters is None:
+            counters = AdapterCounters()
+            self.adapters[adapter] = counters
+        return counters
+
+    def summary(self, elapsed: float) -> typing.List[str]:
+        """ One line per adapter; throughput is averaged over elapsed seconds """
+        return [
+            f'{adapter}: {c.connected} hosts connected ({c.connections} total) '
+            f'{c.reports / elapsed:.1f} reports/s {c.bytes / elapsed / 1e3:.2f} kB/s'
+            for adapter, c in self.adapters.items()
+        ]
+
+    def reset(self) -> None:
+        for counters in self.adapters.values():
+            counters.reports = 0
+            counters.bytes = 0
@@ -0,0 +1,121 @@
+import os
+import socket
+import typing
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+# Transports carry HID control/interrupt channels between the daemon and Bluetooth hosts.
+# In production that's L2CAP via BlueZ; the other transports have the same reliable,
+# message-oriented (SOCK_SEQPACKET) semantics, and stand in for hosts in tests and simulation.
+TRANSPORT_L2CAP = 'l2cap'
+TRANSPORT_UNIX = 'unix' # Unix domain sockets in a directory
+TRANSPORT_MEMORY = 'memory' # Unix domain sockets in the (Linux) abstract namespace; no filesystem
+TRANSPORTS = (TRANSPORT_L2CAP, TRANSPORT_UNIX, TRANSPORT_MEMORY)
+
+
+def peer_info(conn: socket.socket, info: typing.Any) -> typing.Tuple[str, int]:
+    """ Normalize an accepted connection's peer address to L2CAP's (host address, psm).
+    Unix domain peers are usually unnamed, so they're told apart by file descriptor """
+    if isinstance(info, tuple):
+        return info
+    return (info or f'unix:{conn.fileno()}', 0)
+
+
+class Transport(ABC):
+    """ Factory for listening sockets that Bluetooth hosts (or stand-ins) connect to """
+
+    @property
+    @abstractmethod
+    def name(self) -> str:
+        """ Identifies the transport (e.g. adapter) hosts are connected over, in logs and stats """
+        raise NotImplementedError
+
+    @abstractmethod
+    def listen(self, port: int, backlog: int = 1) -> socket.socket:
+        """ Bind and listen on a SOCK_SEQPACKET socket for the given HID PSM (port) """
+        raise NotImplementedError
+
+
+class L2CAPTransport(Transport):
+    """ Bluetooth L2CAP on a local adapter; binding HID PSMs requires root """
+
+    address: str
+
+    def __init__(self, address: str, name: typing.Optional[str] = None) -> None:
+        self.address = address
+        self._name = name if name is not None else address
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def listen(self, port: int, backlog: int = 1) -> socket.socket:
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP) # type: ignore
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.address, port))
+        sock.listen(backlog)
+        return sock
+
+    def __repr__(self) -> str:
+        return f'L2CAPTransport({self._name}, {self.address})'
+
+
+class UnixTransport(Transport):
+    """ Unix domain SOCK_SEQPACKET sockets named after the port they stand in for """
+
+    path: Path
+
+    def __init__(self, path: typing.Union[str, Path]) -> None:
+        self.path = Path(path)
+
+    @property
+    def name(self) -> str:
+        return str(self.path)
+
+    def address(self, port: int) -> str:
+        return str(self.path / f'{port:#06x}')
+
+    def listen(self, port: int, backlog: int = 1) -> socket.socket:
+        address = self.address(port)
+        self.path.mkdir(parents = True, exist_ok = True)
+        if os.path.exists(address):
+            os.unlink(address) # Stale socket from a previous run
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.bind(address)
+        sock.listen(backlog)
+        return sock
+
+    def connect(self, port: int) -> socket.socket:
+        """ Connect to the daemon as a (stand-in) Bluetooth host would """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.connect(self.address(port))
+        return sock
+
+    def __repr__(self) -> str:
+        return f'UnixTransport({self.path})'
+
+
+class MemoryTransport(UnixTransport):
+    """ Like UnixTransport, but in the Linux abstract socket namespace, so nothing
+    touches the filesystem and sockets disappear with the process """
+
+    def __init__(self, name: typing.Optional[str] = None) -> None:
+        self._name = name if name is not None else f'ezmsg-bthid-{os.getpid()}-{id(self):x}'
+        super().__init__(self._name)
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def address(self, port: int) -> str:
+        return f'\0{self.name}/{port:#06x}'
+
+    def listen(self, port: int, backlog: int = 1) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.bind(self.address(port))
+        sock.listen(backlog)
+        return sock
+
+    def __repr__(self) -> str:
+        return f'MemoryTransport({self.name})'
@@ -1,3 +1,14 @@
+import os
+import sys
+import socket
+import typing
+import asyncio
+import logging
+
+from functools import partial
+from pathlib import Path
+from dataclasses import dataclass
+
 _scales = {
     1: 127,
     2: 32767,
@@ -5,4 +16,88 @@ _scales = {
 
 def float_to_signed_bytes(value: float, length: int = 1) -> bytes:
     return int(value * _scales.get(length, (1 << ((length * 8) - 1)) - 1)) \
-        .to_bytes(length = length, byteorder = 'big', signed = True)
\ No newline at end of file
+        .to_bytes(length = length, byteorder = 'big', signed = True)
+
+# Slotted dataclasses (no per-instance __dict__) where the interpreter supports them
+message_dataclass = partial(dataclass, slots = True) if sys.version_info >= (3, 10) else dataclass
+
+
+if typing.TYPE_CHECKING:
+    from numpy.typing import ArrayLike
+else:
+    ArrayLike = typing.Any
+
+
+def daemon_logger(name: str) -> logging.Logger:
+    """ Logger for daemon modules; logs INFO and above to stderr (the journal, under systemd) """
+    logger = logging.getLogger(name)
+
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter(
+        "%(asctime)s.%(msecs)03d - pid: %(process)d - %(threadName)s "
+        + "- %(levelname)s - %(funcName)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def set_socket_permissions(path: Path, mode: int, group: typing.Optional[str] = None) -> None:
+    """ Let (unprivileged) clients connect to a unix socket bound by the daemon """
+    if group is not None:
+        import grp # Unix only; producers importing this module may not be
+        os.chown(path, -1, grp.getgrnam(group).gr_gid)
+    os.chmod(path, mode)
+
+
+def set_event_loop_policy(event_loop: str) -> str:
+    """ Make asyncio.run use the named event loop implementation (see config.EVENT_LOOPS);
+    returns the implementation selected """
+    from .config import EVENT_LOOP_ASYNCIO, EVENT_LOOP_UVLOOP, EVENT_LOOPS
+
+    if event_loop == EVENT_LOOP_ASYNCIO:
+        asyncio.set_event_loop_policy(None)
+        return EVENT_LOOP_ASYNCIO
+
+    if event_loop not in EVENT_LOOPS:
+        raise ValueError(f'Unknown event loop: {event_loop}; expected one of {EVENT_LOOPS}')
+
+    try:
+        import uvloop # type: ignore
+    except ImportError:
+        if event_loop == EVENT_LOOP_UVLOOP:
+            raise
+        asyncio.set_event_loop_policy(None)
+        return EVENT_LOOP_ASYNCIO
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return EVENT_LOOP_UVLOOP
+
+
+# Daemon readiness, in the order the daemon starts up; reported to systemd with sd_notify
+STATE_STARTING = 'starting'
+STATE_INGEST = 'ingest' # accepting reports from producers
+STATE_BLUETOOTH = 'bluetooth' # HID profile, pairing agent and adapters set up with BlueZ
+STATE_READY = 'ready' # Bluetooth HID ports listening; hosts can connect
+
+
+def sd_notify(state: str) -> bool:
+    """ Send state (e.g. 'READY=1') to systemd if it started us as a Type=notify service;
+    returns False if it didn't.  See sd_notify(3) """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address[0] == '@':
+        address = '\0' + address[1:] # Abstract namespace
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+        sock.connect(address)
+        sock.sendall(state.encode())
+    return True
+
+
+def notify_state(state: str) -> None:
+    """ Tell systemd about a step in daemon readiness; READY=1 once it's STATE_READY """
+    sd_notify(f'READY=1\nSTATUS={state}' if state == STATE_READY else f'STATUS={state}')
@@ -0,0 +1,54 @@
+import pytest
+
+from ezmsg.bthid.device import Mouse, Touch
+
+from benchutil import timeit, record
+
+np = pytest.importorskip('numpy')
+
+N_REPORTS = 10000
+
+@pytest.mark.benchmark
+def test_bench_touch_batch() -> None:
+    t = np.linspace(0.0, 10.0, N_REPORTS)
+    abs_x = (np.cos(t) + 1.0) / 2.0
+    abs_y = (np.sin(t) + 1.0) / 2.0
+
+    def per_message():
+        return b''.join(Touch.Message(0x02, x, y).frame() for x, y in zip(abs_x.tolist(), abs_y.tolist()))
+
+    def batch():
+        return Touch.encode_batch(0x02, abs_x, abs_y)
+
+    assert per_message() == batch()
+
+    per_message_t = timeit(per_message, 3)
+    batch_t = timeit(batch, 3)
+    record(
+        'batch.touch', 
+        per_message_ns = per_message_t / N_REPORTS * 1e9, 
+        batch_ns = batch_t / N_REPORTS * 1e9, 
+        speedup = per_message_t / batch_t
+    )
+
+@pytest.mark.benchmark
+def test_bench_mouse_batch() -> None:
+    t = np.linspace(0.0, 10.0, N_REPORTS)
+    rel_x, rel_y = np.cos(t) * 0.1, np.sin(t) * 0.1
+
+    def per_message():
+        return b''.join(Mouse.Message(False, False, x, y).frame() for x, y in zip(rel_x.tolist(), rel_y.tolist()))
+
+    def batch():
+        return Mouse.encode_batch(0, rel_x, rel_y)
+
+    assert per_message() == batch()
+
+    per_message_t = timeit(per_message, 3)
+    batch_t = timeit(batch, 3)
+    record(
+        'batch.mouse', 
+        per_message_ns = per_message_t / N_REPORTS * 1e9, 
+        batch_ns = batch_t / N_REPORTS * 1e9, 
+        speedup = per_message_t / batch_t
+    )
@@ -0,0 +1,101 @@
+import random
+
+import pytest
+
+from ezmsg.bthid.device import Keyboard, Mouse, Touch, MultiTouch
+
+from benchutil import timeit, record
+
+# Reference implementations of the original per-field payload builders
+
+def _float_to_signed_bytes(value: float) -> bytes:
+    return int(value * 127).to_bytes(length = 1, byteorder = 'big', signed = True)
+
+def legacy_keyboard_report(msg: Keyboard.Message) -> bytes:
+    return bytes([0xA1, 0x01]) + bytes([
+        0xFF & msg.mod_keys, 0x00,
+        0xFF & msg.key1, 0xFF & msg.key2, 0xFF & msg.key3,
+        0xFF & msg.key4, 0xFF & msg.key5, 0xFF & msg.key6,
+    ])
+
+def legacy_mouse_report(msg: Mouse.Message) -> bytes:
+    return bytes([0xA1, 0x02]) + (
+        bytes([msg.left_button | (msg.right_button << 1)]) +
+        _float_to_signed_bytes(msg.rel_x) +
+        _float_to_signed_bytes(msg.rel_y) +
+        _float_to_signed_bytes(msg.wheel) +
+        b'\x00\x00'
+    )
+
+def legacy_touch_report(msg: Touch.Message) -> bytes:
+    x = int(msg.abs_x * 10000).to_bytes(2, 'little', signed = True)
+    y = int(msg.abs_y * 10000).to_bytes(2, 'little', signed = True)
+    return bytes([0xA1, 0x03]) + bytes([msg.touch & 0xFF, *x, *y])
+
+def _random_messages(n: int = 1000):
+    rng = random.Random(0)
+    return [
+        (
+            Keyboard.Message(mod_keys = rng.randrange(256), key1 = rng.randrange(0x66), key2 = rng.randrange(0x66)),
+            Mouse.Message(rng.random() < 0.5, rng.random() < 0.5, rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1)),
+            Touch.Message(rng.randrange(4), rng.random(), rng.random()),
+        ) for _ in range(n)
+    ]
+
+CASES = [
+    ('keyboard', 0, legacy_keyboard_report),
+    ('mouse', 1, legacy_mouse_report),
+    ('touch', 2, legacy_touch_report),
+]
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('name, index, legacy', CASES)
+def test_bench_report(name, index, legacy) -> None:
+    msgs = [m[index] for m in _random_messages()]
+    assert [msg.report for msg in msgs] == [legacy(msg) for msg in msgs]
+
+    def run_legacy():
+        for msg in msgs: legacy(msg)
+
+    def run_codec():
+        for msg in msgs: msg.report
+
+    buffer = bytearray(len(msgs) * len(msgs[0].report))
+    def run_pack_into():
+        offset = 0
+        for msg in msgs: offset = msg.pack_into(buffer, offset)
+
+    legacy_t = timeit(run_legacy, 20) / len(msgs)
+    codec_t = timeit(run_codec, 20) / len(msgs)
+    pack_t = timeit(run_pack_into, 20) / len(msgs)
+
+    record(
+        f'encode.{name}', 
+        legacy_ns = legacy_t * 1e9, 
+        report_ns = codec_t * 1e9, 
+        pack_into_ns = pack_t * 1e9,
+        speedup = legacy_t / codec_t,
+    )
+
+@pytest.mark.benchmark
+def test_bench_multitouch() -> None:
+    # A five finger gesture frame: one Touch report per finger vs one MultiTouch report
+    rng = random.Random(0)
+    frames = [[(idx, rng.random(), rng.random()) for idx in range(MultiTouch.MAX_CONTACTS)] for _ in range(1000)]
+
+    def run_touch():
+        return [[Touch.Message(0x03, x, y).report for _, x, y in contacts] for contacts in frames]
+
+    def run_multitouch():
+        return [MultiTouch.Message([MultiTouch.Contact(idx, True, x, y) for idx, x, y in contacts]).report for contacts in frames]
+
+    touch_t = timeit(run_touch, 5) / len(frames)
+    multitouch_t = timeit(run_multitouch, 5) / len(frames)
+    record(
+        'encode.multitouch',
+        touch_frame_ns = touch_t * 1e9,
+        multitouch_frame_ns = multitouch_t * 1e9,
+        touch_packets_per_frame = len(run_touch()[0]),
+        multitouch_packets_per_frame = 1,
+        speedup = touch_t / multitouch_t,
+    )
@@ -0,0 +1,21 @@
+import asyncio
+
+import pytest
+
+from benchutil import record
+from fakehost import AsyncDaemon, SyncDaemon, run_forwarding, INGEST_TCP, INGEST_UNIX, INGEST_SHM
+
+N_REPORTS = 2000
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('daemon_cls', [AsyncDaemon, SyncDaemon], ids = ['async', 'sync'])
+@pytest.mark.parametrize('n_producers', [1, 4])
+@pytest.mark.parametrize('n_hosts', [1, 4])
+@pytest.mark.parametrize('ingest', [INGEST_TCP, INGEST_UNIX, INGEST_SHM])
+def test_bench_forwarding(daemon_cls, n_producers: int, n_hosts: int, ingest: str) -> None:
+    if ingest == INGEST_SHM and daemon_cls is SyncDaemon:
+        pytest.skip('shared memory ingest is only served by the async daemon')
+    result = asyncio.run(run_forwarding(daemon_cls(), n_producers, n_hosts, N_REPORTS, ingest = ingest))
+    assert result.n_reports == n_producers * n_hosts * N_REPORTS
+    suffix = '' if ingest == INGEST_TCP else f'.{ingest}'
+    record(f'forwarding.{daemon_cls.__name__}.p{n_producers}.h{n_hosts}{suffix}', **result.metrics())
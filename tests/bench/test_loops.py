@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+from benchutil import record
+from fakehost import AsyncDaemon, run_forwarding
+
+from ezmsg.bthid.config import EVENT_LOOP_ASYNCIO, EVENT_LOOP_UVLOOP
+from ezmsg.bthid.util import set_event_loop_policy
+
+N_REPORTS = 2000
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('event_loop', [EVENT_LOOP_ASYNCIO, EVENT_LOOP_UVLOOP])
+@pytest.mark.parametrize('n_hosts', [1, 4])
+def test_bench_event_loop(event_loop: str, n_hosts: int) -> None:
+    if event_loop == EVENT_LOOP_UVLOOP:
+        pytest.importorskip('uvloop')
+    set_event_loop_policy(event_loop)
+    try:
+        result = asyncio.run(run_forwarding(AsyncDaemon(), 1, n_hosts, N_REPORTS))
+    finally:
+        set_event_loop_policy(EVENT_LOOP_ASYNCIO)
+    assert result.n_reports == n_hosts * N_REPORTS
+    record(f'loop.{event_loop}.h{n_hosts}', **result.metrics())
@@ -0,0 +1,70 @@
+import time
+import random
+import socket
+import asyncio
+import tempfile
+import statistics
+import typing
+
+import pytest
+
+from fakehost import AsyncDaemon, bench_config, SEQ_FRAME, SEQ_REPORT_ID
+from benchutil import record
+
+from ezmsg.bthid.protocol import BINARY_HANDSHAKE, encode_deadline
+
+N_REPORTS = 200
+REPORT_INTERVAL = 0.01 # sec; a 100 Hz producer
+MAX_JITTER = 0.008 # sec; random delay between producing a report and it reaching the daemon
+SCHEDULE_DELAY = 0.02 # sec; how far ahead scheduled reports are sent
+
+async def _intervals(schedule: bool) -> typing.List[float]:
+    """ Intervals (sec) between reports reaching a host from a jittery 100 Hz producer """
+    daemon = AsyncDaemon()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        await daemon.start(bench_config(tmpdir))
+    loop = asyncio.get_running_loop()
+    daemon_end, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    host.setblocking(False)
+    await daemon.attach_host(daemon_end, ('FA:KE:00:00:00:00', 0x13))
+    reader, writer = await asyncio.open_connection(*daemon.tcp_addr)
+    writer.write(BINARY_HANDSHAKE)
+    await reader.readexactly(len(BINARY_HANDSHAKE))
+
+    rng = random.Random(0)
+    async def produce() -> None:
+        start = time.monotonic_ns()
+        for i in range(N_REPORTS):
+            produced = start + int(i * REPORT_INTERVAL * 1e9)
+            arrival = produced + int(rng.uniform(0, MAX_JITTER) * 1e9)
+            await asyncio.sleep(max(0.0, (arrival - time.monotonic_ns()) / 1e9))
+            deadline = encode_deadline(produced + int(SCHEDULE_DELAY * 1e9)) if schedule else b''
+            writer.write(deadline + SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, i))
+
+    async def consume() -> typing.List[int]:
+        arrivals = []
+        for _ in range(N_REPORTS):
+            await loop.sock_recv(host, 64)
+            arrivals.append(time.monotonic_ns())
+        return arrivals
+
+    try:
+        _, arrivals = await asyncio.gather(produce(), consume())
+    finally:
+        writer.close()
+        host.close()
+        await daemon.stop()
+    return [(b - a) / 1e9 for a, b in zip(arrivals, arrivals[1:])]
+
+@pytest.mark.benchmark
+def test_bench_schedule_jitter() -> None:
+    # Standard deviation of report spacing at the host, with and without deadlines
+    immediate = asyncio.run(_intervals(schedule = False))
+    scheduled = asyncio.run(_intervals(schedule = True))
+    immediate_us = statistics.pstdev(immediate) * 1e6
+    scheduled_us = statistics.pstdev(scheduled) * 1e6
+    record('schedule.jitter', immediate_jitter_us = immediate_us, scheduled_jitter_us = scheduled_us)
+    assert scheduled_us < immediate_us
+
+if __name__ == '__main__':
+    test_bench_schedule_jitter()
@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import asyncio
+import socket
+import tempfile
+import subprocess
+
+from pathlib import Path
+
+import pytest
+
+from benchutil import record
+
+from ezmsg.bthid.config import BTHIDConfig
+from ezmsg.bthid.protocol import BINARY_HANDSHAKE
+
+N_RUNS = 5
+
+# Run a daemon with stand-in hosts (no BlueZ or root), the way `ezmsg-bthid serve` would
+SERVE = """
+import asyncio
+from pathlib import Path
+from ezmsg.bthid.server import BTHIDServer
+
+async def main():
+    server = await BTHIDServer.start(Path({config!r}))
+    await server.serve_forever()
+
+asyncio.run(main())
+"""
+
+def _env() -> dict:
+    return dict(os.environ, PYTHONPATH = os.pathsep.join(sys.path))
+
+def _import_time(module: str) -> float:
+    """ Cumulative import time of module in a fresh interpreter (python -X importtime), in us """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'], 
+        env = _env(), capture_output = True, text = True, check = True
+    )
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return float(fields[1])
+    raise ValueError(f'{module} not in importtime output')
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('module', ['ezmsg.bthid.command', 'ezmsg.bthid.server'])
+def test_bench_import(module: str) -> None:
+    import_us = min(_import_time(module) for _ in range(N_RUNS))
+    record(f'startup.import.{module}', import_us = import_us)
+
+def _ready_time(config_path: Path, port: int) -> float:
+    """ Seconds from spawning the daemon until it acknowledges a producer's handshake """
+    start = time.perf_counter()
+    daemon = subprocess.Popen([sys.executable, '-c', SERVE.format(config = str(config_path))], env = _env())
+    try:
+        while True:
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout = 5.0) as producer:
+                    producer.sendall(BINARY_HANDSHAKE)
+                    assert producer.recv(len(BINARY_HANDSHAKE)) == BINARY_HANDSHAKE
+                    return time.perf_counter() - start
+            except ConnectionRefusedError:
+                assert daemon.poll() is None, 'daemon exited'
+                time.sleep(0.001)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+@pytest.mark.benchmark
+def test_bench_ready() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        config_path = Path(tmpdir) / 'startup.conf'
+        config_path.write_text(f'[server]\nhost = 127.0.0.1\nport = {port}\n[transport]\ntype = memory\n')
+        ready_s = min(_ready_time(config_path, port) for _ in range(N_RUNS))
+    record('startup.ready', ready_ms = ready_s * 1e3)
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('n_adapters', [1, 4])
+def test_bench_bluez_ready(n_adapters: int) -> None:
+    # D-Bus bring-up against a stand-in BlueZ on a private session bus, 
+    # concurrently (setup_bluez) and with every call made one after another
+    pytest.importorskip('dbus_next')
+    from fakebluez import FakeBlueZ, session_bus, dbus_available
+    from dbus_next.aio.message_bus import MessageBus
+    from ezmsg.bthid.bluez import setup_bluez, find_adapters, setup_adapter, register_profile, register_agent
+    if not dbus_available():
+        pytest.skip('requires dbus-daemon')
+
+    config = BTHIDConfig()
+
+    async def sequential(bus_address: str) -> MessageBus:
+        bus = await MessageBus(bus_address = bus_address).connect()
+        await register_profile(bus, config)
+        for adapter in await find_adapters(bus):
+            await setup_adapter(bus, adapter)
+        await register_agent(bus, config)
+        return bus
+
+    async def concurrent(bus_address: str) -> MessageBus:
+        bus, _ = await setup_bluez(config, bus_address)
+        return bus
+
+    async def run(bus_address: str, bring_up) -> float:
+        bluez = FakeBlueZ()
+        await bluez.start(bus_address, n_adapters)
+        try:
+            start = time.perf_counter()
+            bus = await bring_up(bus_address)
+            elapsed = time.perf_counter() - start
+            bus.disconnect()
+            return elapsed
+        finally:
+            bluez.stop()
+
+    with session_bus() as bus_address:
+        sequential_s = min(asyncio.run(run(bus_address, sequential)) for _ in range(N_RUNS))
+        concurrent_s = min(asyncio.run(run(bus_address, concurrent)) for _ in range(N_RUNS))
+    record(
+        f'startup.bluez.a{n_adapters}', 
+        ready_ms = concurrent_s * 1e3, 
+        sequential_ms = sequential_s * 1e3, 
+        speedup = sequential_s / concurrent_s
+    )
@@ -0,0 +1,66 @@
+import os
+import json
+import time
+import typing
+
+from pathlib import Path
+
+# Benchmark results are appended (one JSON object per line) to this file if set,
+# so results can be tracked across commits and compared against a baseline
+BENCH_OUTPUT_ENV = 'EZMSG_BTHID_BENCH_OUTPUT'
+
+def timeit(fn: typing.Callable[[], typing.Any], number: int, repeat: int = 5) -> float:
+    """ Best-of-repeat time per call of fn, in seconds """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return best / number
+
+def record(name: str, **metrics: typing.Any) -> None:
+    """ Print benchmark results and append them to $EZMSG_BTHID_BENCH_OUTPUT """
+    print(f'{name}: ' + ', '.join(f'{k}={v:.4g}' if isinstance(v, float) else f'{k}={v}' for k, v in metrics.items()))
+    output = os.environ.get(BENCH_OUTPUT_ENV)
+    if output:
+        with open(Path(output), 'a') as f:
+            f.write(json.dumps({'name': name, 'time': time.time(), **metrics}) + '\n')
+    check_regressions(name, metrics)
+
+# Baseline results (a previous $EZMSG_BTHID_BENCH_OUTPUT file); if set, record()
+# fails benchmarks whose metrics regress by more than BENCH_TOLERANCE
+BENCH_BASELINE_ENV = 'EZMSG_BTHID_BENCH_BASELINE'
+BENCH_TOLERANCE = 0.25
+
+# Metric name suffixes where larger values are better; for everything else smaller is better
+HIGHER_IS_BETTER = ('_per_s', 'speedup')
+UNCOMPARED = ('n_', 'count')
+
+def _baseline(name: str) -> typing.Dict[str, typing.Any]:
+    baseline = os.environ.get(BENCH_BASELINE_ENV)
+    if not baseline or not Path(baseline).exists():
+        return {}
+    result: typing.Dict[str, typing.Any] = {}
+    with open(Path(baseline)) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get('name') == name:
+                result = entry # Most recent entry wins
+    return result
+
+def check_regressions(name: str, metrics: typing.Dict[str, typing.Any]) -> None:
+    baseline = _baseline(name)
+    regressions = []
+    for key, value in metrics.items():
+        old = baseline.get(key)
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or old == 0:
+            continue
+        if key.startswith(UNCOMPARED) or key.endswith(UNCOMPARED):
+            continue
+        change = (value - old) / abs(old)
+        if key.endswith(HIGHER_IS_BETTER):
+            change = -change
+        if change > BENCH_TOLERANCE:
+            regressions.append(f'{key}: {old:.4g} -> {value:.4g}')
+    assert not regressions, f'{name} regressed: ' + ', '.join(regressions)
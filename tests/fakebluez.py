@@ -0,0 +1,136 @@
+import os
+import shutil
+import typing
+import subprocess
+import contextlib
+
+from dbus_next.aio.message_bus import MessageBus
+from dbus_next.service import ServiceInterface, method, dbus_property
+from dbus_next.constants import PropertyAccess
+
+# Stand-in for BlueZ on a private session bus: just enough of org.bluez for
+# bluez.setup_bluez, so D-Bus bring-up can be tested and timed without Bluetooth
+# hardware, root, or the system bus.
+
+FAKE_ADAPTER = 'FA:KE:AD:AP:00:{:02X}'
+
+
+class FakeProfileManager(ServiceInterface):
+
+    def __init__(self) -> None:
+        super().__init__('org.bluez.ProfileManager1')
+        self.profiles: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+    @method()
+    def RegisterProfile(self, profile: 'o', uuid: 's', options: 'a{sv}'): # type: ignore
+        self.profiles[profile] = {key: value.value for key, value in options.items()}
+
+
+class FakeAgentManager(ServiceInterface):
+
+    def __init__(self) -> None:
+        super().__init__('org.bluez.AgentManager1')
+        self.agents: typing.List[str] = []
+        self.default_agent: typing.Optional[str] = None
+
+    @method()
+    def RegisterAgent(self, agent: 'o', capability: 's'): # type: ignore
+        self.agents.append(agent)
+
+    @method()
+    def RequestDefaultAgent(self, agent: 'o'): # type: ignore
+        assert agent in self.agents
+        self.default_agent = agent
+
+
+class FakeAdapter(ServiceInterface):
+
+    def __init__(self, address: str) -> None:
+        super().__init__('org.bluez.Adapter1')
+        self.address = address
+        self.discoverable = False
+        self.discoverable_timeout = 180
+        self.pairable = False
+        self.pairable_timeout = 0
+
+    @dbus_property(access = PropertyAccess.READ)
+    def Address(self) -> 's': # type: ignore
+        return self.address
+
+    @dbus_property()
+    def Discoverable(self) -> 'b': # type: ignore
+        return self.discoverable
+
+    @Discoverable.setter
+    def Discoverable(self, value: 'b'): # type: ignore
+        self.discoverable = value
+
+    @dbus_property()
+    def DiscoverableTimeout(self) -> 'u': # type: ignore
+        return self.discoverable_timeout
+
+    @DiscoverableTimeout.setter
+    def DiscoverableTimeout(self, value: 'u'): # type: ignore
+        self.discoverable_timeout = value
+
+    @dbus_property()
+    def Pairable(self) -> 'b': # type: ignore
+        return self.pairable
+
+    @Pairable.setter
+    def Pairable(self, value: 'b'): # type: ignore
+        self.pairable = value
+
+    @dbus_property()
+    def PairableTimeout(self) -> 'u': # type: ignore
+        return self.pairable_timeout
+
+    @PairableTimeout.setter
+    def PairableTimeout(self, value: 'u'): # type: ignore
+        self.pairable_timeout = value
+
+
+class FakeBlueZ:
+    """ Owns org.bluez on the bus at bus_address """
+
+    bus: MessageBus
+    profile_manager: FakeProfileManager
+    agent_manager: FakeAgentManager
+    adapters: typing.Dict[str, FakeAdapter]
+
+    async def start(self, bus_address: str, n_adapters: int = 1) -> None:
+        self.bus = await MessageBus(bus_address = bus_address).connect()
+        self.profile_manager = FakeProfileManager()
+        self.agent_manager = FakeAgentManager()
+        self.bus.export('/org/bluez', self.profile_manager)
+        self.bus.export('/org/bluez', self.agent_manager)
+        self.adapters = {}
+        for idx in range(n_adapters):
+            adapter = FakeAdapter(FAKE_ADAPTER.format(idx))
+            self.bus.export(f'/org/bluez/hci{idx}', adapter)
+            self.adapters[f'hci{idx}'] = adapter
+        await self.bus.request_name('org.bluez')
+
+    def stop(self) -> None:
+        self.bus.disconnect()
+
+
+def dbus_available() -> bool:
+    return shutil.which('dbus-daemon') is not None
+
+
+@contextlib.contextmanager
+def session_bus() -> typing.Iterator[str]:
+    """ Run a private dbus-daemon; yields its address """
+    daemon = subprocess.Popen(
+        ['dbus-daemon', '--session', '--nofork', '--nopidfile', '--print-address'],
+        stdout = subprocess.PIPE,
+        text = True,
+        env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS = ''),
+    )
+    try:
+        assert daemon.stdout is not None
+        yield daemon.stdout.readline().strip()
+    finally:
+        daemon.terminate()
+        daemon.wait()
@@ -0,0 +1,210 @@
+import time
+import socket
+import struct
+import asyncio
+import tempfile
+import threading
+import typing
+
+from pathlib import Path
+
+from ezmsg.bthid.protocol import BINARY_HANDSHAKE
+from ezmsg.bthid.shmring import open_ring_connection
+
+# Hardware-free forwarding harness: Bluetooth hosts are stood in for by AF_UNIX
+# SOCK_SEQPACKET socketpairs (same packet semantics as L2CAP), handed straight to the
+# daemon's interrupt port handler, so no BlueZ/D-Bus is needed.
+
+FAKE_HOST = 'FA:KE:00:00:00:{:02X}'
+
+# Touch-shaped report frame whose x/y fields carry a sequence number, so hosts can
+# match every received report to the time its producer sent it
+SEQ_FRAME = struct.Struct('<BBBI') # report id, length, touch, sequence
+SEQ_REPORT = struct.Struct('<BBBI') # 0xA1, report id, touch, sequence
+SEQ_REPORT_ID = 0x03
+
+# How producers reach the daemon
+INGEST_TCP = 'tcp'
+INGEST_UNIX = 'unix'
+INGEST_SHM = 'shm' # async daemon only
+
+DEFAULT_BENCH_CONFIG = """
+[server]
+host = 127.0.0.1
+port = 0
+queue_policy = block
+"""
+
+
+def bench_config(directory: str, text: str = DEFAULT_BENCH_CONFIG) -> Path:
+    config_path = Path(directory) / 'bench.conf'
+    config_path.write_text(text)
+    return config_path
+
+
+class Daemon(typing.Protocol):
+    tcp_addr: typing.Tuple[str, int]
+    unix_path: typing.Optional[Path]
+    shm_path: typing.Optional[Path]
+    async def start(self, config_path: Path) -> None: ...
+    async def attach_host(self, conn: socket.socket, info: typing.Tuple[str, int]) -> None: ...
+    async def stop(self) -> None: ...
+
+
+class AsyncDaemon:
+    """ server.BTHIDServer without the D-Bus bring-up """
+
+    async def start(self, config_path: Path) -> None:
+        from ezmsg.bthid.server import BTHIDServer
+        self.server = await BTHIDServer.start(config_path)
+        self.tcp_addr = self.server.tcp_addr
+        self.unix_path = self.server.config.unix_path
+        self.shm_path = self.server.config.shm_path
+
+    async def attach_host(self, conn: socket.socket, info: typing.Tuple[str, int]) -> None:
+        conn.setblocking(False)
+        await self.server.handle_interrupt_port(conn, info)
+
+    async def stop(self) -> None:
+        self.server.tcp_server.cancel()
+        if self.server.unix_server is not None:
+            self.server.unix_server.cancel()
+        if self.server.shm_server is not None:
+            self.server.shm_server.cancel()
+        if self.server.udp_transport is not None:
+            self.server.udp_transport.close()
+        if self.server.metrics_server is not None:
+            self.server.metrics_server.cancel()
+        if self.server.lag_task is not None:
+            self.server.lag_task.cancel()
+        if self.server.record_task is not None:
+            self.server.record_task.cancel()
+        for task in list(self.server.hid_clients):
+            task.cancel()
+        await asyncio.sleep(0)
+
+
+class SyncDaemon:
+    """ server_sync.BTHIDServer without the D-Bus bring-up """
+
+    async def start(self, config_path: Path) -> None:
+        from ezmsg.bthid.server_sync import BTHIDServer
+        self.server = BTHIDServer(config_path)
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.tcp_addr = listener.getsockname()[:2]
+        self.unix_path = self.server.config.unix_path
+        self.shm_path = self.server.config.shm_path
+        self.server.serve_ingest(listener)
+        self.thread = threading.Thread(target = self.server.run, daemon = True)
+        self.thread.start()
+
+    async def attach_host(self, conn: socket.socket, info: typing.Tuple[str, int]) -> None:
+        self.server.call_soon_threadsafe(self.server.handle_interrupt_port, conn, info)
+        while conn not in self.server.hid_clients:
+            await asyncio.sleep(0.001)
+
+    async def stop(self) -> None:
+        self.server.stop()
+        await asyncio.get_running_loop().run_in_executor(None, self.thread.join)
+
+
+class ForwardingResult(typing.NamedTuple):
+    n_reports: int # reports received, summed over all hosts
+    elapsed: float # sec
+    cpu: float # process CPU sec (daemon, producers and hosts all run in this process)
+    latencies: typing.List[int] # ns; producer write -> host receive
+
+    @property
+    def reports_per_s(self) -> float:
+        return self.n_reports / self.elapsed
+
+    def percentile(self, q: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+    def metrics(self) -> typing.Dict[str, float]:
+        return dict(
+            n_reports = self.n_reports,
+            reports_per_s = self.reports_per_s,
+            p50_us = self.percentile(50) / 1e3,
+            p99_us = self.percentile(99) / 1e3,
+            max_us = max(self.latencies) / 1e3,
+            cpu_us_per_report = self.cpu / self.n_reports * 1e6,
+        )
+
+
+async def run_forwarding(
+    daemon: Daemon,
+    n_producers: int = 1,
+    n_hosts: int = 1,
+    n_reports: int = 1000,
+    config_text: str = DEFAULT_BENCH_CONFIG,
+    ingest: str = INGEST_TCP,
+) -> ForwardingResult:
+    """ Push n_reports from each of n_producers clients through the daemon to n_hosts fake hosts """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if ingest == INGEST_UNIX:
+            config_text += f'unix_path = {Path(tmpdir) / "ingest.sock"}\n'
+        elif ingest == INGEST_SHM:
+            config_text += f'shm_path = {Path(tmpdir) / "shm.sock"}\n'
+        await daemon.start(bench_config(tmpdir, config_text))
+        return await _run_forwarding(daemon, n_producers, n_hosts, n_reports, ingest)
+
+
+async def connect_producer(daemon: Daemon, ingest: str) -> typing.Any:
+    """ A StreamWriter-like connection to the daemon that speaks the binary protocol """
+    if ingest == INGEST_SHM:
+        return await open_ring_connection(str(daemon.shm_path))
+    if ingest == INGEST_UNIX:
+        reader, writer = await asyncio.open_unix_connection(daemon.unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(*daemon.tcp_addr)
+    writer.write(BINARY_HANDSHAKE)
+    await reader.readexactly(len(BINARY_HANDSHAKE))
+    return writer
+
+
+async def _run_forwarding(daemon: Daemon, n_producers: int, n_hosts: int, n_reports: int, ingest: str) -> ForwardingResult:
+    loop = asyncio.get_running_loop()
+
+    hosts: typing.List[socket.socket] = []
+    for host_idx in range(n_hosts):
+        daemon_end, host_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        host_end.setblocking(False)
+        await daemon.attach_host(daemon_end, (FAKE_HOST.format(host_idx), 0x13))
+        hosts.append(host_end)
+
+    total = n_producers * n_reports
+    sent = [0] * total
+    latencies: typing.List[int] = []
+
+    async def produce(producer_idx: int, writer: typing.Any) -> None:
+        for i in range(n_reports):
+            seq = producer_idx * n_reports + i
+            sent[seq] = time.perf_counter_ns()
+            writer.write(SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, seq))
+            await writer.drain()
+            await asyncio.sleep(0) # Interleave producers with forwarding
+
+    async def consume(host: socket.socket) -> None:
+        for _ in range(total):
+            data = await loop.sock_recv(host, 64)
+            latencies.append(time.perf_counter_ns() - sent[SEQ_REPORT.unpack(data)[-1]])
+
+    connections = [await connect_producer(daemon, ingest) for _ in range(n_producers)]
+
+    try:
+        start, cpu_start = time.perf_counter(), time.process_time()
+        await asyncio.gather(
+            *[produce(idx, writer) for idx, writer in enumerate(connections)],
+            *[consume(host) for host in hosts],
+        )
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    finally:
+        for writer in connections:
+            writer.close()
+        for host in hosts:
+            host.close()
+        await daemon.stop()
+
+    return ForwardingResult(len(latencies), elapsed, cpu, latencies)
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('dbus_next')
+
+from fakebluez import FakeBlueZ, session_bus, dbus_available, FAKE_ADAPTER
+
+from ezmsg.bthid.bluez import setup_bluez, Adapter
+from ezmsg.bthid.config import BTHIDConfig
+from ezmsg.bthid.sdp import service_record
+
+pytestmark = pytest.mark.skipif(not dbus_available(), reason = 'requires dbus-daemon')
+
+def test_setup_bluez() -> None:
+    async def run(bus_address: str) -> None:
+        bluez = FakeBlueZ()
+        await bluez.start(bus_address, n_adapters = 2)
+        config = BTHIDConfig()
+        config.parser.read_string('[bluetooth]\nadapters = hci1\n')
+        try:
+            bus, adapters = await setup_bluez(config, bus_address)
+            bus.disconnect()
+        finally:
+            bluez.stop()
+
+        assert adapters == [Adapter('hci1', '/org/bluez/hci1', FAKE_ADAPTER.format(1))]
+        assert bluez.adapters['hci1'].discoverable and bluez.adapters['hci1'].discoverable_timeout == 0
+        assert bluez.adapters['hci1'].pairable
+        assert not bluez.adapters['hci0'].discoverable
+        assert bluez.profile_manager.profiles[config.bluetooth_profile]['ServiceRecord'] == service_record()
+        assert bluez.agent_manager.default_agent == config.bluetooth_agent
+
+    with session_bus() as bus_address:
+        asyncio.run(run(bus_address))
+
+if __name__ == '__main__':
+    test_setup_bluez()
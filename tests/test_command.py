@@ -0,0 +1,24 @@
+import os
+import sys
+import subprocess
+
+from ezmsg.bthid.device import REPORT_DESCRIPTION
+from ezmsg.bthid.sdp import service_record
+
+# Modules the CLI shouldn't import until a command needs them
+LAZY_MODULES = ('ezmsg.bthid.server', 'ezmsg.bthid.server_sync', 'ezmsg.bthid.device', 'ezmsg.bthid.install', 'dbus_next')
+
+def test_lazy_imports() -> None:
+    check = f'import sys, ezmsg.bthid.command; print([m for m in {LAZY_MODULES!r} if m in sys.modules])'
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(sys.path))
+    result = subprocess.run([sys.executable, '-c', check], env = env, capture_output = True, text = True, check = True)
+    assert result.stdout.strip() == '[]'
+
+def test_service_record() -> None:
+    record = service_record()
+    assert REPORT_DESCRIPTION.hex().upper() in record
+    assert '$REPORT_DESC' not in record
+
+if __name__ == '__main__':
+    test_lazy_imports()
+    test_service_record()
@@ -4,7 +4,9 @@ from importlib.resources import files
 
 import pytest
 
-from ezmsg.bthid.config import BTHIDConfig
+from ezmsg.bthid.config import BTHIDConfig, EVENT_LOOP_AUTO, EVENT_LOOP_ASYNCIO, EVENT_LOOP_UVLOOP
+from ezmsg.bthid.device.multitouch import DEFAULT_MAX_CONTACTS
+from ezmsg.bthid.util import set_event_loop_policy
 
 def test_config() -> None:
     config_text = files('ezmsg.bthid').joinpath('ezmsg-bthid.conf').read_text()
@@ -22,6 +24,39 @@ def test_config() -> None:
         
     assert config.bluetooth_uuid == BTHIDConfig.DEFAULT_UUID
     assert config.server_addr == (BTHIDConfig.DEFAULT_HOST, BTHIDConfig.DEFAULT_PORT)
+    assert config.queue_size == BTHIDConfig.DEFAULT_QUEUE_SIZE
+    assert config.queue_policy == BTHIDConfig.DEFAULT_QUEUE_POLICY
+    assert config.unix_path is None
+    assert config.event_loop == BTHIDConfig.DEFAULT_EVENT_LOOP
+    assert config.unix_mode == BTHIDConfig.DEFAULT_UNIX_MODE
+    assert config.bluetooth_adapters == []
+    assert config.stats_interval == BTHIDConfig.DEFAULT_STATS_INTERVAL
+    assert not config.suppress_duplicates
+    assert config.idle_interval == BTHIDConfig.DEFAULT_IDLE_INTERVAL
+
+    config.parser.read_string('[bluetooth]\nadapters = hci0, AA:BB:CC:DD:EE:FF hci2')
+    assert config.bluetooth_adapters == ['hci0', 'AA:BB:CC:DD:EE:FF', 'hci2']
+
+    assert config.max_contacts == DEFAULT_MAX_CONTACTS
+    config.parser.read_string('[bluetooth]\nmax_contacts = 100')
+    with pytest.raises(ValueError):
+        config.max_contacts
+
+def test_event_loop_policy() -> None:
+    try:
+        import uvloop # noqa: F401
+        expected = EVENT_LOOP_UVLOOP
+    except ImportError:
+        expected = EVENT_LOOP_ASYNCIO
+        with pytest.raises(ImportError):
+            set_event_loop_policy(EVENT_LOOP_UVLOOP)
+    try:
+        assert set_event_loop_policy(EVENT_LOOP_AUTO) == expected
+        with pytest.raises(ValueError):
+            set_event_loop_policy('trio')
+    finally:
+        assert set_event_loop_policy(EVENT_LOOP_ASYNCIO) == EVENT_LOOP_ASYNCIO
 
 if __name__ == '__main__':
-    test_config()
\ No newline at end of file
+    test_config()
+    test_event_loop_policy()
\ No newline at end of file
@@ -0,0 +1,31 @@
+from ezmsg.bthid.device import Keyboard, Mouse, Touch
+from ezmsg.bthid.dedup import DuplicateFilter
+
+def _sent(duplicates: DuplicateFilter, msgs, now: int = 0):
+    return [msg for msg in msgs if duplicates.check(msg.report, now)]
+
+def test_duplicate_filter() -> None:
+    duplicates = DuplicateFilter()
+    press, release = Keyboard.Message(key1 = Keyboard.KEYCODE_A), Keyboard.Message()
+    assert _sent(duplicates, [press, press, release, release, press]) == [press, release, press]
+
+    # Duplicates are per report ID; repeated movement still moves the pointer
+    still, moving = Mouse.Message(), Mouse.Message(rel_x = 0.5)
+    touch = Touch.Message(touch = 0x03, abs_x = 0.5)
+    assert _sent(duplicates, [still, touch, still, moving, moving, touch, still, still]) == [still, touch, moving, moving, still]
+    assert duplicates.suppressed == 5
+
+def test_idle_interval() -> None:
+    duplicates = DuplicateFilter(idle_interval = 0.5)
+    release = Keyboard.Message()
+    assert _sent(duplicates, [release, release], now = 0) == [release]
+    assert _sent(duplicates, [release], now = int(0.4e9)) == []
+    # Unchanged reports are resent once the host has been idle for idle_interval
+    assert _sent(duplicates, [release, release], now = int(0.5e9)) == [release]
+
+    # Reports that weren't actually sent don't count
+    assert not duplicates.redundant(Keyboard.Message(key1 = Keyboard.KEYCODE_B).report, int(0.6e9))
+
+if __name__ == '__main__':
+    test_duplicate_filter()
+    test_idle_interval()
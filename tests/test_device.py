@@ -0,0 +1,129 @@
+import sys
+
+import pytest
+
+from ezmsg.bthid.device import Keyboard, Mouse, Touch, MultiTouch, report_description
+from ezmsg.bthid.device.multitouch import MAX_CONTACTS_LIMIT
+
+def test_reports() -> None:
+    assert Keyboard.Message(mod_keys = Keyboard.MODIFIER_LEFT_SHIFT, key1 = Keyboard.KEYCODE_A).report \
+        == bytes([0xA1, 0x01, 0x02, 0x00, 0x04, 0x00, 0x00, 0x00, 0x00, 0x00])
+    assert Mouse.Message(left_button = True, rel_x = 1.0, rel_y = -0.5, wheel = 2.0).report \
+        == bytes([0xA1, 0x02, 0x01, 0x7F, 0xC1, 0x7F, 0x00, 0x00])
+    assert Touch.Message(touch = 0x03, abs_x = 0.5, abs_y = 1.5).report \
+        == bytes([0xA1, 0x03, 0x03, 0x88, 0x13, 0x10, 0x27])
+
+@pytest.mark.parametrize('msg', [
+    Keyboard.Message(key1 = Keyboard.KEYCODE_Z, key6 = Keyboard.KEYCODE_ENTER),
+    Mouse.Message(right_button = True, rel_y = 0.25),
+    Touch.Message(touch = 0x02, abs_x = 0.1, abs_y = 0.9),
+    MultiTouch.Message([MultiTouch.Contact(3, True, 0.2, 0.4), MultiTouch.Contact(7, False, 0.6, 0.8)]),
+])
+def test_pack_into(msg) -> None:
+    buffer = bytearray(128)
+    end = msg.pack_into(buffer, 3)
+    assert buffer[3:end] == msg.report
+    end = msg.pack_frame_into(buffer, end)
+    assert buffer[3 + len(msg.report):end] == msg.frame()
+    assert msg.frame()[2:] == msg.payload == msg.report[2:]
+
+@pytest.mark.skipif(sys.version_info < (3, 10), reason = 'slotted dataclasses require python 3.10')
+def test_slots() -> None:
+    for msg in (Keyboard.Message(), Mouse.Message(), Touch.Message(), MultiTouch.Message(), MultiTouch.with_max_contacts(2).Message()):
+        assert not hasattr(msg, '__dict__')
+
+
+def _input_bits(description: bytes, report_id: int) -> int:
+    """ Bits of Input items the report descriptor declares for report_id """
+    bits, current_id, size, count, offset = 0, None, 0, 0, 0
+    while offset < len(description):
+        prefix = description[offset]
+        length = (0, 1, 2, 4)[prefix & 0x03]
+        value = int.from_bytes(description[offset + 1:offset + 1 + length], 'little')
+        tag = prefix & 0xFC
+        if tag == 0x84: current_id = value # Report ID
+        elif tag == 0x74: size = value # Report Size
+        elif tag == 0x94: count = value # Report Count
+        elif tag == 0x80 and current_id == report_id: bits += size * count # Input
+        offset += 1 + length
+    return bits
+
+def test_descriptions() -> None:
+    # The digitizer's descriptor matches the size of its reports, whatever the maximum contacts
+    assert _input_bits(MultiTouch.REPORT_DESCRIPTION, MultiTouch.Message.REPORT_ID) == 8 * len(MultiTouch.Message().payload)
+    multitouch = MultiTouch.with_max_contacts(MAX_CONTACTS_LIMIT)
+    assert _input_bits(multitouch.REPORT_DESCRIPTION, multitouch.Message.REPORT_ID) == 8 * len(multitouch.Message().payload)
+    assert multitouch.REPORT_DESCRIPTION in report_description(MAX_CONTACTS_LIMIT)
+    assert MultiTouch.REPORT_DESCRIPTION in report_description()
+
+def test_multitouch() -> None:
+    # Every finger goes in one report; unused contacts are zeroed
+    two = MultiTouch.with_max_contacts(2)
+    assert two.Message([two.Contact(5, True, 0.5, 1.5)]).report == bytes([
+        0xA1, 0x04, 0x01, 
+        0x01, 0x05, 0x88, 0x13, 0x10, 0x27, 
+        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+    ])
+    assert MultiTouch.with_max_contacts(2) is two
+    assert MultiTouch.with_max_contacts(MultiTouch.MAX_CONTACTS) is MultiTouch
+    assert len(MultiTouch.Message().payload) == 1 + 6 * MultiTouch.MAX_CONTACTS
+    with pytest.raises(ValueError):
+        two.Message([two.Contact(idx) for idx in range(3)])
+    with pytest.raises(ValueError):
+        MultiTouch.with_max_contacts(MAX_CONTACTS_LIMIT + 1)
+
+def test_encode_batch() -> None:
+    np = pytest.importorskip('numpy')
+    rng = np.random.default_rng(0)
+
+    touch = rng.integers(0, 4, 100)
+    abs_x, abs_y = rng.uniform(-0.5, 1.5, (2, 100))
+    assert Touch.encode_batch(touch, abs_x, abs_y) == b''.join(
+        Touch.Message(int(t), float(x), float(y)).frame() for t, x, y in zip(touch, abs_x, abs_y)
+    )
+
+    buttons = rng.integers(0, 4, 100)
+    rel_x, rel_y, wheel = rng.uniform(-1.5, 1.5, (3, 100))
+    assert Mouse.encode_batch(buttons, rel_x, rel_y, wheel) == b''.join(
+        Mouse.Message(bool(b & 1), bool(b & 2), float(x), float(y), float(w)).frame() 
+        for b, x, y, w in zip(buttons, rel_x, rel_y, wheel)
+    )
+
+    # Scalars broadcast
+    assert Touch.encode_batch(0x02, 0.5, np.linspace(0, 1, 3)) == b''.join(
+        Touch.Message(0x02, 0.5, y).frame() for y in np.linspace(0, 1, 3)
+    )
+
+def test_compile_text() -> None:
+    release = Keyboard.Message()
+    shift = Keyboard.MODIFIER_LEFT_SHIFT
+    assert Keyboard.compile_text('aAb!') == (
+        Keyboard.Message(key1 = Keyboard.KEYCODE_A),
+        release, # Repeated key must be released
+        Keyboard.Message(mod_keys = shift, key1 = Keyboard.KEYCODE_A),
+        Keyboard.Message(key1 = Keyboard.KEYCODE_B),
+        Keyboard.Message(mod_keys = shift, key1 = Keyboard.KEYCODE_NUMBER_1),
+        release,
+    )
+    assert Keyboard.compile_text('ab', release_each = True) == (
+        Keyboard.Message(key1 = Keyboard.KEYCODE_A), release,
+        Keyboard.Message(key1 = Keyboard.KEYCODE_B), release,
+    )
+    assert Keyboard.compile_text('') == ()
+
+    # Every printable US ASCII character has a key
+    printable = ''.join(chr(c) for c in range(0x20, 0x7F))
+    assert sum(msg != release for msg in Keyboard.compile_text(printable)) == len(printable)
+    assert Keyboard.compile_text_frames(printable) == b''.join(m.frame() for m in Keyboard.compile_text(printable))
+
+    with pytest.raises(ValueError):
+        Keyboard.compile_text('\u00e9')
+    with pytest.raises(ValueError):
+        Keyboard.compile_text('a', layout = 'klingon')
+
+if __name__ == '__main__':
+    test_reports()
+    test_descriptions()
+    test_multitouch()
+    test_encode_batch()
+    test_compile_text()
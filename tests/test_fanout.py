@@ -0,0 +1,47 @@
+from ezmsg.bthid.fanout import Ring, TRIM_INTERVAL
+
+def _drain(cursor):
+    packets = []
+    while (packet := cursor.pop()) is not None:
+        packets.append(packet)
+    return packets
+
+def test_fanout() -> None:
+    ring = Ring()
+    ring.append('before')
+    a, b = ring.cursor(), ring.cursor()
+    assert a.pop() is None
+
+    ring.append('broadcast 1')
+    b.push('for b')
+    b.skip(ring.head)
+    ring.append('broadcast 2')
+    ring.append('broadcast 3')
+    assert (a.pending(), b.pending()) == (3, 3)
+
+    # Broadcasts are shared; private packets keep their place in arrival order
+    assert _drain(a) == ['broadcast 1', 'broadcast 2', 'broadcast 3']
+    assert _drain(b) == ['broadcast 1', 'for b', 'broadcast 3']
+    assert (a.pending(), b.pending()) == (0, 0)
+    assert not b.skipped
+
+def test_trim() -> None:
+    ring = Ring()
+    fast, slow = ring.cursor(), ring.cursor()
+    for idx in range(4 * TRIM_INTERVAL):
+        ring.append(idx)
+        fast.pop()
+    # Packets are kept until every cursor has read them
+    assert ring.base == 0
+    assert _drain(slow) == list(range(4 * TRIM_INTERVAL))
+
+    ring.remove(slow)
+    for idx in range(TRIM_INTERVAL):
+        ring.append(idx)
+        fast.pop()
+    assert len(ring.packets) < TRIM_INTERVAL
+    assert ring.head == 5 * TRIM_INTERVAL
+
+if __name__ == '__main__':
+    test_fanout()
+    test_trim()
@@ -0,0 +1,336 @@
+import os
+import sys
+import time
+import socket
+import typing
+import asyncio
+import tempfile
+import subprocess
+
+import pytest
+
+pytest.importorskip('ezmsg.core')
+
+from fakehost import AsyncDaemon, SyncDaemon, Daemon, bench_config, DEFAULT_BENCH_CONFIG
+
+from ezmsg.bthid.device import Keyboard, Mouse, Touch
+from ezmsg.bthid.device.keyboard import KEYBOARD_ID
+from ezmsg.bthid.device.mouse import MOUSE_ID
+from ezmsg.bthid.device.touch import TOUCH_ID
+from ezmsg.bthid.protocol import StreamDecoder, BINARY_HANDSHAKE, PROTOCOL_BINARY, PROTOCOL_HEX, encode_timestamp, encode_deadline
+from ezmsg.bthid.stats import STAGE_INGEST, STAGE_TOTAL
+from ezmsg.bthid.hidoutput import (
+    HIDOutput,
+    HIDOutputSettings,
+    HIDQueue,
+    encode_stamped,
+    QUEUE_FIFO,
+    QUEUE_LATEST,
+    QUEUE_ACCUMULATE,
+)
+
+async def _start_output(**settings: typing.Any) -> typing.Tuple[HIDOutput, asyncio.Task]:
+    """ An HIDOutput running its connection loop outside of an ezmsg pipeline """
+    output = HIDOutput(HIDOutputSettings(**settings))
+    await output.setup()
+    return output, asyncio.get_running_loop().create_task(output.handle_connection())
+
+async def _attach_host(daemon: Daemon) -> socket.socket:
+    """ A Bluetooth host attached to daemon; recv() returns the reports sent to it """
+    daemon_end, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    host.setblocking(False)
+    await daemon.attach_host(daemon_end, ('FA:KE:00:00:00:00', 0x13))
+    return host
+
+async def _receive(host: socket.socket, n_reports: int, timeout: float = 5.0) -> typing.List[bytes]:
+    loop = asyncio.get_running_loop()
+    return [await asyncio.wait_for(loop.sock_recv(host, 64), timeout) for _ in range(n_reports)]
+
+def _drain(queue: HIDQueue):
+    msgs = []
+    while not queue.empty():
+        msgs.append(queue.get_nowait())
+    return msgs
+
+def test_queue_policies() -> None:
+
+    async def run() -> None:
+        queue = HIDQueue({
+            KEYBOARD_ID: QUEUE_FIFO,
+            MOUSE_ID: QUEUE_ACCUMULATE,
+            TOUCH_ID: QUEUE_LATEST,
+        })
+
+        queue.put_nowait(Touch.Message(abs_x = 0.1))
+        queue.put_nowait(Keyboard.Message(key1 = Keyboard.KEYCODE_A))
+        queue.put_nowait(Mouse.Message(rel_x = 0.25))
+        queue.put_nowait(Touch.Message(abs_x = 0.2))
+        queue.put_nowait(Keyboard.Message())
+        queue.put_nowait(Mouse.Message(rel_x = 0.25, wheel = 0.5))
+        queue.put_nowait(Mouse.Message(left_button = True)) # button transition
+        queue.put_nowait(Touch.Message(abs_x = 0.3))
+
+        assert _drain(queue) == [
+            Touch.Message(abs_x = 0.3),
+            Keyboard.Message(key1 = Keyboard.KEYCODE_A),
+            Mouse.Message(rel_x = 0.5, wheel = 0.5),
+            Keyboard.Message(),
+            Mouse.Message(left_button = True),
+        ]
+
+        # Once a report has been dequeued, new reports don't coalesce into it
+        queue.put_nowait(Touch.Message(abs_x = 0.4))
+        assert await queue.get() == Touch.Message(abs_x = 0.4)
+        assert queue.empty()
+
+    asyncio.run(run())
+
+def test_mouse_accumulate() -> None:
+    assert Mouse.Message(rel_x = 0.75).accumulate(Mouse.Message(rel_x = 0.5)) is None
+    assert Mouse.Message(rel_y = -0.5).accumulate(Mouse.Message(rel_y = -0.25)) == Mouse.Message(rel_y = -0.75)
+    assert Mouse.Message().accumulate(Mouse.Message(right_button = True)) is None
+
+def test_touch_accumulate() -> None:
+    assert Touch.Message(1, 0.1).accumulate(Touch.Message(1, 0.2)) == Touch.Message(1, 0.2)
+    assert Touch.Message(1, 0.1).accumulate(Touch.Message(0, 0.1)) is None
+
+    # A tap (down, then up) survives coalescing; moves between touch changes don't
+    queue = HIDQueue({TOUCH_ID: QUEUE_ACCUMULATE})
+    for msg in [
+        Touch.Message(0, 0.1), 
+        Touch.Message(0, 0.2), 
+        Touch.Message(1, 0.2), 
+        Touch.Message(0, 0.2), 
+        Touch.Message(0, 0.3), 
+    ]:
+        queue.put_nowait(msg)
+    assert _drain(queue) == [Touch.Message(0, 0.2), Touch.Message(1, 0.2), Touch.Message(0, 0.3)]
+
+def test_encode_stamped() -> None:
+    # Every frame of a pre-encoded batch is timestamped and scheduled, not just the first
+    frames = b''.join(Touch.Message(1, x, 0.5).frame() for x in (0.1, 0.2, 0.3))
+    stamp = encode_timestamp(12) + encode_deadline(5000)
+    decoder = StreamDecoder()
+    stream = BINARY_HANDSHAKE + encode_stamped(frames, stamp) + encode_stamped(Mouse.Message(), stamp)
+    stamped = [(report, decoder.sent, decoder.deadline) for report in decoder.feed(stream)]
+    assert stamped == [
+        (Touch.Message(1, 0.1, 0.5).report, 12, 5000),
+        (Touch.Message(1, 0.2, 0.5).report, 12, 5000),
+        (Touch.Message(1, 0.3, 0.5).report, 12, 5000),
+        (Mouse.Message().report, 12, 5000),
+    ]
+
+def test_portable_import() -> None:
+    # Producers on platforms without fcntl (Windows) or memfd seals (macOS) can still use tcp
+    check = "import sys; sys.modules['fcntl'] = None; from ezmsg.bthid.hidoutput import HIDOutput; print('ezmsg.bthid.shmring' in sys.modules)"
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(sys.path))
+    result = subprocess.run([sys.executable, '-c', check], env = env, capture_output = True, text = True, check = True)
+    assert result.stdout.strip() == 'False'
+
+def test_handshake_reconnect() -> None:
+    # A connection dropped during the binary handshake says nothing about the daemon's protocols
+    msg = Keyboard.Message(key1 = Keyboard.KEYCODE_A)
+
+    async def run() -> typing.Tuple[bytes, str]:
+        received: asyncio.Queue = asyncio.Queue()
+        connections = 0
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            nonlocal connections
+            connections += 1
+            handshake = await reader.readexactly(len(BINARY_HANDSHAKE))
+            if connections > 1:
+                writer.write(handshake)
+                received.put_nowait(await reader.readexactly(len(msg.frame())))
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        host, port = server.sockets[0].getsockname()[:2]
+        output, task = await _start_output(host = host, port = port)
+        await output.write(msg)
+        try:
+            return await asyncio.wait_for(received.get(), 5.0), output.STATE.protocol
+        finally:
+            task.cancel()
+            server.close()
+
+    assert asyncio.run(run()) == (msg.frame(), PROTOCOL_BINARY)
+
+@pytest.mark.parametrize('protocol', [PROTOCOL_BINARY, PROTOCOL_HEX])
+@pytest.mark.parametrize('daemon_cls', [AsyncDaemon, SyncDaemon], ids = ['async', 'sync'])
+def test_protocols(daemon_cls, protocol) -> None:
+    # Both daemons speak both protocols; reports arrive at the host unchanged
+    msgs = [Keyboard.Message(key1 = Keyboard.KEYCODE_A), Mouse.Message(rel_x = 0.5), Touch.Message(1, 0.25, 0.75)]
+
+    async def run() -> typing.Tuple[typing.List[bytes], str]:
+        daemon = daemon_cls()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir))
+        host = await _attach_host(daemon)
+        host_addr, port = daemon.tcp_addr
+        output, task = await _start_output(host = host_addr, port = port, protocol = protocol)
+        try:
+            for msg in msgs:
+                await output.write(msg)
+            return await _receive(host, len(msgs)), output.STATE.protocol
+        finally:
+            task.cancel()
+            host.close()
+            await daemon.stop()
+
+    assert asyncio.run(run()) == ([msg.report for msg in msgs], protocol)
+
+@pytest.mark.parametrize('ack', [b'\x00BTHID\xff', None], ids = ['wrong_ack', 'timeout'])
+def test_hex_fallback(ack: typing.Optional[bytes]) -> None:
+    # Daemons that don't acknowledge the binary handshake get hex on a fresh connection
+    msg = Keyboard.Message(key1 = Keyboard.KEYCODE_A)
+
+    async def run() -> typing.Tuple[bytes, str]:
+        received: asyncio.Queue = asyncio.Queue()
+        connections = 0
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            nonlocal connections
+            connections += 1
+            if connections == 1:
+                await reader.readexactly(len(BINARY_HANDSHAKE))
+                if ack is not None:
+                    writer.write(ack)
+                await reader.read() # until the producer gives up on this connection
+            else:
+                received.put_nowait(await reader.readline())
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        host, port = server.sockets[0].getsockname()[:2]
+        output, task = await _start_output(host = host, port = port, handshake_timeout = 0.1)
+        await output.write(msg)
+        try:
+            return await asyncio.wait_for(received.get(), 5.0), output.STATE.protocol
+        finally:
+            task.cancel()
+            server.close()
+
+    assert asyncio.run(run()) == (msg.encode(), PROTOCOL_HEX)
+
+def test_next_batch() -> None:
+    # Batches take whatever is queued up to max_batch, waiting up to batch_latency for more
+    async def run() -> typing.List[int]:
+        sizes = []
+        output = HIDOutput(HIDOutputSettings(max_batch = 3, batch_latency = 0.0))
+        await output.setup()
+        for key in range(5):
+            output.STATE.queue.put_nowait(Keyboard.Message(key1 = key))
+        sizes.append(len(await output.next_batch()))
+        sizes.append(len(await output.next_batch()))
+
+        loop = asyncio.get_running_loop()
+        for batch_latency in (0.0, 0.2):
+            output.apply_settings(HIDOutputSettings(max_batch = 3, batch_latency = batch_latency))
+            output.STATE.queue.put_nowait(Keyboard.Message())
+            loop.call_later(0.05, output.STATE.queue.put_nowait, Keyboard.Message())
+            sizes.append(len(await output.next_batch()))
+            await asyncio.sleep(0.1)
+            while not output.STATE.queue.empty():
+                output.STATE.queue.get_nowait()
+        return sizes
+
+    assert asyncio.run(run()) == [3, 2, 1, 2]
+
+@pytest.mark.parametrize('daemon_cls', [AsyncDaemon, SyncDaemon], ids = ['async', 'sync'])
+def test_batched_delivery(daemon_cls) -> None:
+    # Batched writes reach the host as individual reports, in order
+    msgs = [Keyboard.Message(key1 = key) for key in range(50)]
+
+    async def run() -> typing.List[bytes]:
+        daemon = daemon_cls()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir))
+        host = await _attach_host(daemon)
+        host_addr, port = daemon.tcp_addr
+        output, task = await _start_output(host = host_addr, port = port, max_batch = 8, batch_latency = 0.01)
+        try:
+            for msg in msgs:
+                await output.write(msg)
+            return await _receive(host, len(msgs))
+        finally:
+            task.cancel()
+            host.close()
+            await daemon.stop()
+
+    assert asyncio.run(run()) == [msg.report for msg in msgs]
+
+@pytest.mark.parametrize('timestamps', [True, False])
+def test_timestamps(timestamps: bool) -> None:
+    # Timestamped reports give the daemon the producer -> daemon (ingest) stage of their latency
+    msgs = [Keyboard.Message(key1 = key) for key in range(3)]
+
+    async def run() -> int:
+        daemon = AsyncDaemon()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir, DEFAULT_BENCH_CONFIG + 'latency_interval = 60\n'))
+        host = await _attach_host(daemon)
+        host_addr, port = daemon.tcp_addr
+        output, task = await _start_output(host = host_addr, port = port, timestamps = timestamps)
+        try:
+            for msg in msgs:
+                await output.write(msg)
+            assert await _receive(host, len(msgs)) == [msg.report for msg in msgs]
+            latency = daemon.server.latency
+            assert latency is not None
+            histograms = latency.histograms[('FA:KE:00:00:00:00', KEYBOARD_ID)]
+            for _ in range(100):
+                if histograms[STAGE_TOTAL].count == len(msgs):
+                    break
+                await asyncio.sleep(0.01)
+            return histograms[STAGE_INGEST].count
+        finally:
+            task.cancel()
+            host.close()
+            await daemon.stop()
+
+    assert asyncio.run(run()) == (len(msgs) if timestamps else 0)
+
+@pytest.mark.parametrize('daemon_cls', [AsyncDaemon, SyncDaemon], ids = ['async', 'sync'])
+def test_schedule_delay(daemon_cls) -> None:
+    # The async daemon holds reports for schedule_delay; the sync daemon can't, and says so right away
+    msg = Mouse.Message(rel_x = 0.5)
+
+    async def run() -> typing.Tuple[typing.List[bytes], float]:
+        daemon = daemon_cls()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir))
+        host = await _attach_host(daemon)
+        host_addr, port = daemon.tcp_addr
+        output, task = await _start_output(host = host_addr, port = port, schedule_delay = 0.2, handshake_timeout = 5.0)
+        try:
+            start = time.monotonic()
+            await output.write(msg)
+            return await _receive(host, 1), time.monotonic() - start
+        finally:
+            task.cancel()
+            host.close()
+            await daemon.stop()
+
+    reports, elapsed = asyncio.run(run())
+    assert reports == [msg.report]
+    if daemon_cls is AsyncDaemon:
+        assert 0.2 <= elapsed < 1.0
+    else:
+        assert elapsed < 0.2
+
+if __name__ == '__main__':
+    test_queue_policies()
+    test_mouse_accumulate()
+    test_touch_accumulate()
+    test_encode_stamped()
+    test_portable_import()
+    test_handshake_reconnect()
+    test_protocols(AsyncDaemon, PROTOCOL_BINARY)
+    test_protocols(SyncDaemon, PROTOCOL_HEX)
+    test_hex_fallback(None)
+    test_next_batch()
+    test_batched_delivery(AsyncDaemon)
+    test_timestamps(True)
+    test_schedule_delay(AsyncDaemon)
+    test_schedule_delay(SyncDaemon)
@@ -0,0 +1,25 @@
+from ezmsg.bthid.metrics import Metrics, family, COUNTER
+
+def test_family() -> None:
+    assert family('reports_total', COUNTER, 'Reports', [({}, 3), ({'host': 'a"b\\c'}, 4)]) == [
+        '# HELP reports_total Reports',
+        '# TYPE reports_total counter',
+        'reports_total 3',
+        'reports_total{host="a\\"b\\\\c"} 4',
+    ]
+
+def test_client_counters() -> None:
+    metrics = Metrics()
+    a, b, c = metrics.connect('unix'), metrics.connect('unix'), metrics.connect('127.0.0.1:5000')
+    assert [counters.name for counters in (a, b, c)] == ['unix', 'unix#2', '127.0.0.1:5000']
+
+    # Departing producers only live on in the totals
+    a.reports, a.bytes = 2, 10
+    metrics.disconnect(a)
+    metrics.disconnect(a)
+    assert list(metrics.clients) == ['unix#2', '127.0.0.1:5000']
+    assert (metrics.received_reports, metrics.received_bytes) == (2, 10)
+
+if __name__ == '__main__':
+    test_family()
+    test_client_counters()
@@ -0,0 +1,170 @@
+import pytest
+
+from ezmsg.bthid.device import Keyboard, Mouse, Touch
+from ezmsg.bthid.protocol import (
+    StreamDecoder, 
+    ProtocolError, 
+    iter_frames,
+    frames_to_hex,
+    encode_timestamp,
+    encode_deadline,
+    encode_clock,
+    encode_clock_reply,
+    clock_offset,
+    encode_target,
+    encode_datagram,
+    pack_datagrams,
+    split_frames,
+    split_each_frame,
+    DatagramDecoder,
+    DATAGRAM_HEADER,
+    BINARY_HANDSHAKE, 
+    MAX_HEX_LINE,
+    PROTOCOL_HEX, 
+    PROTOCOL_BINARY
+)
+
+MESSAGES = [
+    Keyboard.Message(key1 = Keyboard.KEYCODE_A),
+    Mouse.Message(left_button = True, rel_x = 0.5, rel_y = -0.5),
+    Touch.Message(touch = 0x02, abs_x = 0.25, abs_y = 0.75),
+    Keyboard.Message(),
+]
+
+def _decode_bytewise(decoder: StreamDecoder, stream: bytes):
+    # Worst case fragmentation: every byte arrives in its own read
+    return [report for i in range(len(stream)) for report in decoder.feed(stream[i:i+1])]
+
+def test_hex_protocol() -> None:
+    stream = b''.join(msg.encode() for msg in MESSAGES)
+    decoder = StreamDecoder()
+    assert list(decoder.feed(stream)) == [msg.report for msg in MESSAGES]
+    assert decoder.protocol == PROTOCOL_HEX
+    assert _decode_bytewise(StreamDecoder(), stream) == [msg.report for msg in MESSAGES]
+
+def test_binary_protocol() -> None:
+    acks = []
+    stream = BINARY_HANDSHAKE + b''.join(msg.frame() for msg in MESSAGES)
+    decoder = StreamDecoder(on_binary = lambda: acks.append(True))
+    assert list(decoder.feed(stream)) == [msg.report for msg in MESSAGES]
+    assert decoder.protocol == PROTOCOL_BINARY
+    assert acks == [True]
+    assert _decode_bytewise(StreamDecoder(), stream) == [msg.report for msg in MESSAGES]
+
+def test_timestamps() -> None:
+    decoder = StreamDecoder()
+    stream = BINARY_HANDSHAKE + encode_timestamp(12345) + MESSAGES[0].frame() + MESSAGES[1].frame()
+    stamps = [(report, decoder.sent) for report in decoder.feed(stream)]
+    assert stamps == [(MESSAGES[0].report, 12345), (MESSAGES[1].report, 0)]
+    assert list(iter_frames(encode_timestamp(1) + MESSAGES[2].frame())) == [MESSAGES[2].report]
+
+def test_deadlines() -> None:
+    clocks = []
+    decoder = StreamDecoder(on_clock = clocks.append)
+    stream = BINARY_HANDSHAKE + encode_clock(777) + encode_deadline(5000) + encode_timestamp(12) + MESSAGES[0].frame() + MESSAGES[1].frame()
+    deadlines = [(report, decoder.deadline, decoder.sent) for report in decoder.feed(stream)]
+    assert deadlines == [(MESSAGES[0].report, 5000, 12), (MESSAGES[1].report, 0, 0)]
+    assert clocks == [777]
+
+    # Producer clock 1000 ns behind the daemon's, 200 ns round trip
+    assert clock_offset(encode_clock_reply(500, 1600), 700) == (1000, 200)
+    with pytest.raises(ProtocolError):
+        clock_offset(encode_clock_reply(500, 1600)[:2] + b'\x01' + bytes(16), 700)
+
+def test_targets() -> None:
+    decoder = StreamDecoder()
+    stream = BINARY_HANDSHAKE + MESSAGES[0].frame() + encode_target('AA:BB:CC:DD:EE:FF') 
+    stream += MESSAGES[1].frame() + MESSAGES[2].frame() + encode_target(None) + MESSAGES[3].frame()
+    targets = [(report, decoder.target) for report in decoder.feed(stream)]
+    assert targets == [
+        (MESSAGES[0].report, None),
+        (MESSAGES[1].report, 'AA:BB:CC:DD:EE:FF'),
+        (MESSAGES[2].report, 'AA:BB:CC:DD:EE:FF'),
+        (MESSAGES[3].report, None),
+    ]
+
+    # Targets don't carry over between datagrams
+    decoder = DatagramDecoder()
+    targeted = encode_datagram(0, encode_target('AA:BB:CC:DD:EE:FF') + MESSAGES[0].frame())
+    assert [decoder.target for _ in decoder.feed_datagram(targeted, 'src', 0)] == ['AA:BB:CC:DD:EE:FF']
+    assert [decoder.target for _ in decoder.feed_datagram(encode_datagram(1, MESSAGES[0].frame()), 'src', 1)] == [None]
+
+    with pytest.raises(ProtocolError):
+        list(StreamDecoder().feed(BINARY_HANDSHAKE + encode_target('x')[:-1] + b'\xff'))
+
+def test_frames() -> None:
+    frames = b''.join(msg.frame() for msg in MESSAGES)
+    assert list(iter_frames(frames)) == [msg.report for msg in MESSAGES]
+    assert frames_to_hex(frames) == b''.join(msg.encode() for msg in MESSAGES)
+    with pytest.raises(ProtocolError):
+        list(iter_frames(frames[:-1]))
+
+def test_invalid_streams() -> None:
+    with pytest.raises(ProtocolError):
+        list(StreamDecoder().feed(b'\x00NOTBTHID'))
+    with pytest.raises(ProtocolError):
+        list(StreamDecoder().feed(b'not hex\n'))
+
+    # Hex lines are bounded whether or not their newline has arrived
+    longest = b'ab' * (MAX_HEX_LINE // 2)
+    assert list(StreamDecoder().feed(longest + b'\n')) == [bytes.fromhex(longest.decode())]
+    decoder = StreamDecoder()
+    assert list(decoder.feed(longest)) == []
+    with pytest.raises(ProtocolError):
+        list(decoder.feed(b'ab'))
+    with pytest.raises(ProtocolError):
+        list(StreamDecoder().feed(longest + b'ab\n'))
+
+def test_datagrams() -> None:
+    frames = b''.join(msg.frame() for msg in MESSAGES)
+    decoder = DatagramDecoder(source_timeout = 1.0)
+    reports = [msg.report for msg in MESSAGES]
+    src_a, src_b = ('10.0.0.1', 1000), ('10.0.0.2', 1000)
+
+    assert list(decoder.feed_datagram(encode_datagram(5, frames), src_a, 0)) == reports
+    # Stale and duplicate sequences are discarded per source
+    assert list(decoder.feed_datagram(encode_datagram(4, frames), src_a, 1)) == []
+    assert list(decoder.feed_datagram(encode_datagram(5, frames), src_a, 2)) == []
+    assert list(decoder.feed_datagram(encode_datagram(0, frames), src_b, 3)) == reports
+    assert decoder.discarded == 2
+    # Sequence numbers wrap around
+    decoder.sources[src_a] = (0xFFFFFFFF, 4)
+    assert list(decoder.feed_datagram(encode_datagram(0x1_0000_0000, frames), src_a, 5)) == reports
+    # Quiet sources are forgotten, so restarted producers are accepted
+    assert list(decoder.feed_datagram(encode_datagram(0, frames), src_a, int(2e9))) == reports
+    assert src_b not in decoder.sources
+
+    stamped = encode_datagram(1, encode_timestamp(42) + MESSAGES[0].frame())
+    assert [(report, decoder.sent) for report in decoder.feed_datagram(stamped, src_b, int(3e9))] == [(reports[0], 42)]
+
+    with pytest.raises(ProtocolError):
+        list(decoder.feed_datagram(encode_datagram(9, frames[:-1]), src_b, int(3e9)))
+    with pytest.raises(ProtocolError):
+        list(decoder.feed_datagram(b'\x02' + encode_datagram(10, frames)[1:], src_b, int(3e9)))
+
+def test_pack_datagrams() -> None:
+    frames = b''.join(msg.frame() for msg in MESSAGES)
+    chunks = list(split_frames(frames * 10, 20))
+    assert b''.join(chunks) == frames * 10
+    assert all(len(chunk) <= 20 for chunk in chunks)
+    assert list(iter_frames(b''.join(chunks))) == [msg.report for msg in MESSAGES] * 10
+    stamped = encode_timestamp(1) + frames
+    assert list(split_each_frame(stamped)) == [encode_timestamp(1)] + [msg.frame() for msg in MESSAGES]
+    with pytest.raises(ProtocolError):
+        list(split_each_frame(stamped[:-1]))
+
+    payloads = list(pack_datagrams([frames] * 100, max_size = 64))
+    assert all(len(payload) + DATAGRAM_HEADER.size <= 64 for payload in payloads)
+    assert b''.join(payloads) == frames * 100
+    assert list(pack_datagrams([frames, frames])) == [frames * 2]
+
+if __name__ == '__main__':
+    test_hex_protocol()
+    test_binary_protocol()
+    test_timestamps()
+    test_deadlines()
+    test_targets()
+    test_frames()
+    test_invalid_streams()
+    test_datagrams()
+    test_pack_datagrams()
@@ -0,0 +1,70 @@
+import time
+import asyncio
+import tempfile
+import typing
+
+from pathlib import Path
+
+import pytest
+
+from ezmsg.bthid.device import Keyboard, Mouse
+from ezmsg.bthid.recording import Recording, RecordingWriter, RECORD_HEADER
+
+REPORTS = [
+    Keyboard.Message(key1 = 0x04).report,
+    Mouse.Message(rel_x = 0.5).report,
+    Keyboard.Message().report,
+]
+
+def _record(path: Path, times: typing.List[int]) -> None:
+    with RecordingWriter(path) as writer:
+        for report, timestamp in zip(REPORTS, times):
+            writer.write(report, timestamp)
+        assert writer.count == len(REPORTS)
+
+def test_roundtrip() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / 'reports.rec'
+        _record(path, [10, 20, 30])
+        with Recording(path) as recording:
+            assert abs(recording.started - time.time_ns()) < 60e9
+            assert [timestamp for timestamp, _ in recording] == [10, 20, 30]
+            # Frames replay as binary protocol frames of the recorded reports
+            assert [frame[2:] for _, frame in recording] == [report[2:] for report in REPORTS]
+            assert [frame[0] for _, frame in recording] == [report[1] for report in REPORTS]
+
+        # A record cut short by a crash ends the recording
+        with open(path, 'ab') as f:
+            f.write(RECORD_HEADER.pack(40, 0x01, 8))
+        with Recording(path) as recording:
+            assert len(list(recording)) == len(REPORTS)
+
+        path.write_bytes(b'not a recording at all')
+        with pytest.raises(ValueError):
+            Recording(path)
+
+def test_play() -> None:
+    # Replay follows the recorded timing, scaled by speed
+    async def play(recording: Recording, speed: float) -> typing.Tuple[typing.List[bytes], float]:
+        start = time.perf_counter()
+        batches = [frames async for frames in recording.play(speed)]
+        return batches, time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / 'reports.rec'
+        _record(path, [0, 100_000_000, 200_000_000])
+        with Recording(path) as recording:
+            frames = b''.join(frame for _, frame in recording)
+
+            batches, elapsed = asyncio.run(play(recording, 2.0))
+            assert len(batches) == 3 and b''.join(batches) == frames
+            assert 0.09 < elapsed < 0.5
+
+            # As fast as possible coalesces everything into one write
+            batches, elapsed = asyncio.run(play(recording, 0.0))
+            assert batches == [frames]
+            assert elapsed < 0.05
+
+if __name__ == '__main__':
+    test_roundtrip()
+    test_play()
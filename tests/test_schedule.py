@@ -0,0 +1,37 @@
+import time
+import asyncio
+import typing
+
+from ezmsg.bthid.schedule import Scheduler
+
+def test_scheduler() -> None:
+    # Items are released at their deadlines, in deadline order, ties in arrival order
+    async def run() -> typing.Tuple[typing.List[typing.Tuple[str, int]], Scheduler]:
+        released: typing.List[typing.Tuple[str, int]] = []
+        scheduler: Scheduler[str] = Scheduler(lambda item: released.append((item, time.monotonic_ns())), horizon = 0.2)
+        now = time.monotonic_ns()
+        deadlines = {'c': now + 60_000_000, 'a': now + 20_000_000, 'b1': now + 40_000_000, 'b2': now + 40_000_000}
+        for item, deadline in deadlines.items():
+            scheduler.schedule(deadline, item)
+        scheduler.schedule(now + 10_000_000_000, 'far') # brought forward to the horizon
+        scheduler.schedule(now - 1, 'late') # behind the others still pending
+        assert len(scheduler) == 6
+        while len(scheduler):
+            await asyncio.sleep(0.01)
+        assert all(t >= deadlines[item] for item, t in released if item in deadlines)
+        return released, scheduler
+
+    released, scheduler = asyncio.run(run())
+    assert [item for item, _ in released] == ['late', 'a', 'b1', 'b2', 'c', 'far']
+    assert scheduler.late == 1
+
+def test_due_now() -> None:
+    # Nothing pending: a due item is released without touching the event loop
+    released: typing.List[str] = []
+    scheduler: Scheduler[str] = Scheduler(released.append)
+    scheduler.schedule(time.monotonic_ns(), 'now')
+    assert released == ['now'] and not len(scheduler)
+
+if __name__ == '__main__':
+    test_scheduler()
+    test_due_now()
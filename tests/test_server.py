@@ -0,0 +1,402 @@
+import time
+import socket
+import typing
+import asyncio
+import tempfile
+import threading
+
+from pathlib import Path
+
+import pytest
+
+from fakehost import (
+    AsyncDaemon, 
+    SyncDaemon, 
+    run_forwarding, 
+    bench_config, 
+    DEFAULT_BENCH_CONFIG, 
+    INGEST_UNIX,
+    INGEST_SHM,
+    SEQ_FRAME, 
+    SEQ_REPORT, 
+    SEQ_REPORT_ID,
+)
+
+from ezmsg.bthid.config import BTHIDConfig
+from ezmsg.bthid.protocol import (
+    BINARY_HANDSHAKE, 
+    CLOCK_REPLY_FRAME, 
+    encode_datagram, 
+    encode_target, 
+    encode_deadline, 
+    encode_clock, 
+    clock_offset,
+)
+from ezmsg.bthid.recording import Recording
+from ezmsg.bthid.transport import MemoryTransport
+from ezmsg.bthid.util import STATE_INGEST, STATE_READY
+
+@pytest.mark.parametrize('daemon_cls', [AsyncDaemon, SyncDaemon], ids = ['async', 'sync'])
+def test_forwarding(daemon_cls) -> None:
+    # Every report from every producer reaches every host
+    result = asyncio.run(run_forwarding(daemon_cls(), n_producers = 2, n_hosts = 2, n_reports = 100))
+    assert result.n_reports == 2 * 2 * 100
+
+def test_sync_reconnects() -> None:
+    # Reconnecting clients don't leave threads or sockets behind in the sync server
+    async def run() -> None:
+        daemon = SyncDaemon()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir))
+        await asyncio.sleep(0.01)
+        threads, sockets = threading.active_count(), len(daemon.server.selector.get_map())
+
+        for idx in range(20):
+            daemon_end, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            await daemon.attach_host(daemon_end, (f'FA:KE:00:00:00:{idx:02X}', 0x13))
+            reader, writer = await asyncio.open_connection(*daemon.tcp_addr)
+            writer.write(BINARY_HANDSHAKE)
+            await reader.readexactly(len(BINARY_HANDSHAKE))
+            writer.write(SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, idx))
+            await writer.drain()
+            assert SEQ_REPORT.unpack(host.recv(64))[-1] == idx
+            writer.close()
+            host.close()
+            await writer.wait_closed()
+
+        for _ in range(100):
+            if not daemon.server.hid_clients and len(daemon.server.selector.get_map()) == sockets:
+                break
+            await asyncio.sleep(0.01)
+        assert not daemon.server.hid_clients
+        assert len(daemon.server.selector.get_map()) == sockets
+        assert threading.active_count() == threads
+        await daemon.stop()
+
+    asyncio.run(run())
+
+def test_sync_producer_errors() -> None:
+    # A producer that leaves before the binary handshake is answered only loses its own connection
+    from ezmsg.bthid.server_sync import BTHIDServer
+    with tempfile.TemporaryDirectory() as tmpdir:
+        server = BTHIDServer(bench_config(tmpdir))
+    sockets = len(server.selector.get_map())
+    daemon_end, producer = socket.socketpair()
+    server.handle_tcp_client(daemon_end, ('producer', 0))
+    producer.send(BINARY_HANDSHAKE)
+    producer.close()
+    handler = server.selector.get_key(daemon_end).data
+    handler(daemon_end, 0) # BrokenPipeError sending the handshake reply
+    assert daemon_end.fileno() == -1
+    assert len(server.selector.get_map()) == sockets
+    server.stop()
+    server.run() # Returns right away, closing the server's sockets
+
+def test_sync_accept_errors() -> None:
+    # Errors handling one new connection don't stop the server accepting more
+    async def run() -> None:
+        daemon = SyncDaemon()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir))
+        accepted: typing.List[socket.socket] = []
+        def on_connect(conn: socket.socket, _: typing.Tuple[str, int]) -> None:
+            accepted.append(conn)
+            raise ConnectionResetError('gone')
+        listener = socket.create_server(('127.0.0.1', 0))
+        daemon.server.listen(listener, on_connect)
+        for _ in range(2):
+            _, writer = await asyncio.open_connection(*listener.getsockname()[:2])
+            count = len(accepted)
+            for _ in range(100):
+                if len(accepted) > count:
+                    break
+                await asyncio.sleep(0.01)
+            writer.close()
+        assert len(accepted) == 2
+        assert all(conn.fileno() == -1 for conn in accepted)
+        assert daemon.thread.is_alive()
+        await daemon.stop()
+
+    asyncio.run(run())
+
+@pytest.mark.parametrize('daemon_cls', [AsyncDaemon, SyncDaemon], ids = ['async', 'sync'])
+def test_unix_ingest(daemon_cls) -> None:
+    result = asyncio.run(run_forwarding(daemon_cls(), n_producers = 2, n_hosts = 1, n_reports = 100, ingest = INGEST_UNIX))
+    assert result.n_reports == 2 * 100
+
+def test_shm_ingest() -> None:
+    result = asyncio.run(run_forwarding(AsyncDaemon(), n_producers = 2, n_hosts = 2, n_reports = 1000, ingest = INGEST_SHM))
+    assert result.n_reports == 2 * 2 * 1000
+
+@pytest.mark.parametrize('daemon_cls', [AsyncDaemon, SyncDaemon], ids = ['async', 'sync'])
+def test_udp_ingest(daemon_cls) -> None:
+    # Out of order datagrams are dropped; the rest reach the host
+    async def run() -> typing.List[int]:
+        daemon = daemon_cls()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+                probe.bind(('127.0.0.1', 0))
+                udp_port = probe.getsockname()[1]
+            await daemon.start(bench_config(tmpdir, DEFAULT_BENCH_CONFIG + f'udp_port = {udp_port}\n'))
+
+        daemon_end, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        host.setblocking(False)
+        await daemon.attach_host(daemon_end, ('FA:KE:00:00:00:00', 0x13))
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as producer:
+            for sequence, value in [(1, 1), (3, 3), (2, 2), (4, 4)]:
+                frame = SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, value)
+                producer.sendto(encode_datagram(sequence, frame), ('127.0.0.1', udp_port))
+            loop = asyncio.get_running_loop()
+            try:
+                return [
+                    SEQ_REPORT.unpack(await asyncio.wait_for(loop.sock_recv(host, 64), 5.0))[-1]
+                    for _ in range(3)
+                ]
+            finally:
+                host.close()
+                await daemon.stop()
+
+    assert asyncio.run(run()) == [1, 3, 4]
+
+@pytest.mark.parametrize('daemon_cls', [AsyncDaemon, SyncDaemon], ids = ['async', 'sync'])
+def test_memory_transport(daemon_cls) -> None:
+    # Hosts connect to the daemon's HID ports over a transport instead of being attached directly
+    async def run() -> bytes:
+        daemon = daemon_cls()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir))
+
+        transport = MemoryTransport()
+        daemon.server.serve_transport(transport)
+        control = transport.connect(BTHIDConfig.P_CTRL)
+        interrupt = transport.connect(BTHIDConfig.P_INTR)
+        interrupt.setblocking(False)
+        while not daemon.server.hid_clients:
+            await asyncio.sleep(0.001)
+
+        reader, writer = await asyncio.open_connection(*daemon.tcp_addr)
+        writer.write(BINARY_HANDSHAKE)
+        await reader.readexactly(len(BINARY_HANDSHAKE))
+        writer.write(SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, 42))
+        await writer.drain()
+
+        try:
+            return await asyncio.wait_for(asyncio.get_running_loop().sock_recv(interrupt, 64), 5.0)
+        finally:
+            writer.close()
+            control.close()
+            interrupt.close()
+            await daemon.stop()
+
+    assert SEQ_REPORT.unpack(asyncio.run(run())) == (0xA1, SEQ_REPORT_ID, 0x02, 42)
+
+@pytest.mark.parametrize('daemon_cls', [AsyncDaemon, SyncDaemon], ids = ['async', 'sync'])
+def test_routing(daemon_cls) -> None:
+    # Targeted reports only reach their host; untargeted reports reach every host
+    async def run() -> typing.List[typing.List[int]]:
+        daemon = daemon_cls()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir))
+
+        hosts = []
+        for idx in range(2):
+            daemon_end, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            host.setblocking(False)
+            await daemon.attach_host(daemon_end, (f'FA:KE:00:00:00:{idx:02X}', 0x13))
+            hosts.append(host)
+
+        reader, writer = await asyncio.open_connection(*daemon.tcp_addr)
+        writer.write(BINARY_HANDSHAKE)
+        await reader.readexactly(len(BINARY_HANDSHAKE))
+        for target, value in [('FA:KE:00:00:00:01', 1), ('FA:KE:00:00:00:99', 2), (None, 3)]:
+            writer.write(encode_target(target) + SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, value))
+        await writer.drain()
+
+        loop = asyncio.get_running_loop()
+        async def receive(host: socket.socket, n: int) -> typing.List[int]:
+            return [SEQ_REPORT.unpack(await asyncio.wait_for(loop.sock_recv(host, 64), 5.0))[-1] for _ in range(n)]
+        try:
+            received = [await receive(hosts[0], 1), await receive(hosts[1], 2)]
+            assert daemon.server.unrouted == 1
+            return received
+        finally:
+            writer.close()
+            for host in hosts:
+                host.close()
+            await daemon.stop()
+
+    assert asyncio.run(run()) == [[3], [1, 3]]
+
+@pytest.mark.parametrize('daemon_cls', [AsyncDaemon, SyncDaemon], ids = ['async', 'sync'])
+def test_suppress_duplicates(daemon_cls) -> None:
+    # Repeated states reach the host once; changes (including releases) always do
+    async def run() -> typing.List[bytes]:
+        daemon = daemon_cls()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir, DEFAULT_BENCH_CONFIG + 'suppress_duplicates = true\n'))
+
+        daemon_end, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        host.setblocking(False)
+        await daemon.attach_host(daemon_end, ('FA:KE:00:00:00:00', 0x13))
+
+        reader, writer = await asyncio.open_connection(*daemon.tcp_addr)
+        writer.write(BINARY_HANDSHAKE)
+        await reader.readexactly(len(BINARY_HANDSHAKE))
+        for value in [1, 1, 1, 0, 0, 0, 2]:
+            writer.write(SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, value))
+        await writer.drain()
+
+        loop = asyncio.get_running_loop()
+        try:
+            return [SEQ_REPORT.unpack(await asyncio.wait_for(loop.sock_recv(host, 64), 5.0))[-1] for _ in range(3)]
+        finally:
+            writer.close()
+            host.close()
+            await daemon.stop()
+
+    assert asyncio.run(run()) == [1, 0, 2]
+
+def test_metrics() -> None:
+    # Scraped counters account for every report in and out
+    async def run() -> str:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            metrics_port = probe.getsockname()[1]
+        daemon = AsyncDaemon()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir, DEFAULT_BENCH_CONFIG + f'metrics_port = {metrics_port}\n'))
+
+        daemon_end, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        host.setblocking(False)
+        await daemon.attach_host(daemon_end, ('FA:KE:00:00:00:00', 0x13))
+
+        reader, writer = await asyncio.open_connection(*daemon.tcp_addr)
+        writer.write(BINARY_HANDSHAKE)
+        await reader.readexactly(len(BINARY_HANDSHAKE))
+        for value in range(3):
+            writer.write(SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, value))
+        await writer.drain()
+
+        loop = asyncio.get_running_loop()
+        try:
+            for _ in range(3):
+                await asyncio.wait_for(loop.sock_recv(host, 64), 5.0)
+            scrape_reader, scrape_writer = await asyncio.open_connection('127.0.0.1', metrics_port)
+            scrape_writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            response = (await asyncio.wait_for(scrape_reader.read(), 5.0)).decode()
+            scrape_writer.close()
+            return response
+        finally:
+            writer.close()
+            host.close()
+            await daemon.stop()
+
+    response = asyncio.run(run())
+    assert response.startswith('HTTP/1.0 200 OK')
+    lines = response.split('\r\n\r\n', 1)[1].splitlines()
+    assert 'ezmsg_bthid_received_reports_total 3' in lines
+    assert f'ezmsg_bthid_received_bytes_total {len(BINARY_HANDSHAKE) + 3 * SEQ_FRAME.size}' in lines
+    assert 'ezmsg_bthid_sent_reports_total 3' in lines
+    assert 'ezmsg_bthid_clients 1' in lines
+    assert 'ezmsg_bthid_host_sent_reports_total{host="FA:KE:00:00:00:00",adapter=""} 3' in lines
+    assert 'ezmsg_bthid_host_queue_depth{host="FA:KE:00:00:00:00",adapter=""} 0' in lines
+
+def test_scheduled_delivery() -> None:
+    # Reports sent ahead with deadlines reach the host at their deadlines, in deadline order
+    async def run() -> typing.List[typing.Tuple[int, int]]:
+        daemon = AsyncDaemon()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir))
+
+        daemon_end, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        host.setblocking(False)
+        await daemon.attach_host(daemon_end, ('FA:KE:00:00:00:00', 0x13))
+
+        reader, writer = await asyncio.open_connection(*daemon.tcp_addr)
+        writer.write(BINARY_HANDSHAKE)
+        await reader.readexactly(len(BINARY_HANDSHAKE))
+        writer.write(encode_clock(time.monotonic_ns()))
+        offset, _ = clock_offset(await reader.readexactly(CLOCK_REPLY_FRAME.size), time.monotonic_ns())
+        # Same machine, same clock
+        assert abs(offset) < 50_000_000
+
+        start = time.monotonic_ns() + offset
+        deadlines = {1: start + 60_000_000, 0: start + 30_000_000, 2: start + 90_000_000}
+        for value, deadline in deadlines.items():
+            writer.write(encode_deadline(deadline) + SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, value))
+        writer.write(SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, 99))
+        await writer.drain()
+
+        loop = asyncio.get_running_loop()
+        try:
+            received = []
+            for _ in range(4):
+                value = SEQ_REPORT.unpack(await asyncio.wait_for(loop.sock_recv(host, 64), 5.0))[-1]
+                received.append((value, time.monotonic_ns() - deadlines.get(value, start)))
+            return received
+        finally:
+            writer.close()
+            host.close()
+            await daemon.stop()
+
+    received = asyncio.run(run())
+    assert [value for value, _ in received] == [99, 0, 1, 2]
+    assert all(0 <= lateness < 20_000_000 for value, lateness in received if value != 99)
+
+def test_record() -> None:
+    # Every report from tcp producers is recorded, in order, with its arrival time
+    async def run(record_path: Path) -> None:
+        daemon = AsyncDaemon()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir, DEFAULT_BENCH_CONFIG + f'record_path = {record_path}\n'))
+        reader, writer = await asyncio.open_connection(*daemon.tcp_addr)
+        writer.write(BINARY_HANDSHAKE)
+        await reader.readexactly(len(BINARY_HANDSHAKE))
+        for value in range(3):
+            writer.write(SEQ_FRAME.pack(SEQ_REPORT_ID, SEQ_FRAME.size - 2, 0x02, value))
+        await writer.drain()
+        writer.close()
+        while daemon.server.metrics.clients:
+            await asyncio.sleep(0.001)
+        await daemon.stop()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        record_path = Path(tmpdir) / 'reports.rec'
+        asyncio.run(run(record_path))
+        with Recording(record_path) as recording:
+            records = list(recording)
+
+    assert [SEQ_FRAME.unpack(frame)[-1] for _, frame in records] == [0, 1, 2]
+    assert all(0 < timestamp <= time.monotonic_ns() for timestamp, _ in records)
+
+def test_readiness(monkeypatch) -> None:
+    # systemd hears about each step of startup, and READY=1 once hosts can connect
+    async def run(notify: socket.socket) -> typing.List[bytes]:
+        daemon = AsyncDaemon()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            await daemon.start(bench_config(tmpdir, DEFAULT_BENCH_CONFIG + '[transport]\ntype = memory\n'))
+        serve_task = asyncio.get_running_loop().create_task(daemon.server.serve_forever())
+        messages = []
+        try:
+            while not messages or b'READY=1' not in messages[-1]:
+                messages.append(await asyncio.wait_for(asyncio.get_running_loop().sock_recv(notify, 256), 5.0))
+            assert daemon.server.state == STATE_READY
+        finally:
+            serve_task.cancel()
+            await daemon.stop()
+        return messages
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify:
+            notify.bind(f'{tmpdir}/notify')
+            notify.setblocking(False)
+            monkeypatch.setenv('NOTIFY_SOCKET', f'{tmpdir}/notify')
+            messages = asyncio.run(run(notify))
+
+    assert messages == [f'STATUS={STATE_INGEST}'.encode(), f'READY=1\nSTATUS={STATE_READY}'.encode()]
+
+if __name__ == '__main__':
+    test_forwarding(AsyncDaemon)
+    test_sync_producer_errors()
+    test_sync_accept_errors()
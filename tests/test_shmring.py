@@ -0,0 +1,89 @@
+import os
+import socket
+import asyncio
+
+import pytest
+
+from ezmsg.bthid.protocol import ProtocolError
+from ezmsg.bthid.shmring import SharedRing, accept_ring, SHM_HANDSHAKE, HEADER_SIZE, HEAD_OFFSET, TAIL_OFFSET
+
+def test_ring() -> None:
+    producer = SharedRing.create(capacity = 16)
+    consumer = SharedRing(os.dup(producer.fd))
+    try:
+        assert consumer.read() == b''
+        assert producer.write(b'0123456789')
+        assert not producer.write(b'abcdefgh') # not enough room
+        assert consumer.read() == b'0123456789'
+        # Wraps around the end of the ring
+        assert producer.write(b'abcdefgh')
+        assert producer.write(b'ijklmnop')
+        assert consumer.pending() == 16
+        assert consumer.read() == b'abcdefghijklmnop'
+
+        # The consumer only arms the doorbell when there's nothing left to read
+        assert not producer.disarm()
+        assert consumer.arm()
+        assert producer.write(b'q')
+        assert producer.disarm()
+        assert not producer.disarm()
+        assert not consumer.arm()
+        assert consumer.read() == b'q'
+    finally:
+        consumer.close()
+        producer.close()
+
+def test_corrupt_counters() -> None:
+    producer = SharedRing.create(capacity = 16)
+    consumer = SharedRing(os.dup(producer.fd))
+    try:
+        # A producer can't make the daemon read past the ring or backwards
+        producer._set(HEAD_OFFSET, 17)
+        with pytest.raises(ProtocolError):
+            consumer.read()
+        producer._set(HEAD_OFFSET, 0)
+        producer._set(TAIL_OFFSET, 4)
+        with pytest.raises(ProtocolError):
+            consumer.read()
+    finally:
+        consumer.close()
+        producer.close()
+
+def _accept(fd: int) -> SharedRing:
+    async def run() -> SharedRing:
+        daemon, client = socket.socketpair()
+        daemon.setblocking(False)
+        try:
+            socket.send_fds(client, [SHM_HANDSHAKE], [fd])
+            return await accept_ring(daemon)
+        finally:
+            daemon.close()
+            client.close()
+    return asyncio.run(run())
+
+def test_accept_sealed() -> None:
+    producer = SharedRing.create(capacity = 16)
+    try:
+        consumer = _accept(producer.fd)
+        assert consumer.capacity == 16
+        consumer.close()
+        # Sealed rings can't be resized out from under the daemon
+        with pytest.raises(PermissionError):
+            os.ftruncate(producer.fd, HEADER_SIZE)
+    finally:
+        producer.close()
+
+def test_reject_unsealed() -> None:
+    fd = os.memfd_create('unsealed', os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+    try:
+        os.ftruncate(fd, HEADER_SIZE + 16)
+        with pytest.raises(ValueError, match = 'sealed'):
+            _accept(fd)
+    finally:
+        os.close(fd)
+
+if __name__ == '__main__':
+    test_ring()
+    test_corrupt_counters()
+    test_accept_sealed()
+    test_reject_unsealed()
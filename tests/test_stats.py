@@ -0,0 +1,56 @@
+import random
+
+from ezmsg.bthid.stats import LatencyHistogram, LatencyStats, AdapterStats, N_BUCKETS, STAGE_INGEST, STAGE_TOTAL
+
+def test_histogram() -> None:
+    rng = random.Random(0)
+    samples = [int(rng.lognormvariate(13, 1.5)) for _ in range(10000)]
+
+    hist = LatencyHistogram()
+    for sample in samples:
+        hist.record(sample)
+
+    assert hist.count == len(samples)
+    assert hist.max == max(samples)
+    assert len(hist.counts) == N_BUCKETS
+
+    samples.sort()
+    for q in (50, 90, 99):
+        exact = samples[int(len(samples) * q / 100) - 1]
+        # Log-linear buckets with 4 sub-buckets have < 25% relative error
+        assert exact <= hist.percentile(q) <= exact * 1.25
+
+    hist.reset()
+    assert hist.count == 0 and hist.percentile(50) == 0
+
+def test_latency_stats() -> None:
+    stats = LatencyStats()
+    stats.record('AA:BB:CC:DD:EE:FF', 0x03, sent = 1000, received = 2000000, dequeued = 3000000, completed = 4000000)
+    stats.record('AA:BB:CC:DD:EE:FF', 0x03, sent = 0, received = 2000000, dequeued = 3000000, completed = 4000000)
+    histograms = stats.histograms[('AA:BB:CC:DD:EE:FF', 0x03)]
+    assert histograms[STAGE_INGEST].count == 1
+    assert histograms[STAGE_TOTAL].count == 2
+    assert len(stats.summary({0x03: 'Touch'})) == 1
+    stats.remove_host('AA:BB:CC:DD:EE:FF')
+    assert not stats.histograms
+
+def test_adapter_stats() -> None:
+    stats = AdapterStats()
+    counters = stats.get('hci0')
+    assert stats.get('hci0') is counters
+    counters.connected += 1
+    counters.connections += 1
+    counters.reports += 10
+    counters.bytes += 100
+    stats.get('hci1')
+    assert stats.summary(2.0) == [
+        'hci0: 1 hosts connected (1 total) 5.0 reports/s 0.05 kB/s',
+        'hci1: 0 hosts connected (0 total) 0.0 reports/s 0.00 kB/s',
+    ]
+    stats.reset()
+    assert (counters.connected, counters.reports, counters.bytes) == (1, 0, 0)
+
+if __name__ == '__main__':
+    test_histogram()
+    test_latency_stats()
+    test_adapter_stats()